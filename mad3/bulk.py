@@ -0,0 +1,182 @@
+"""
+Bulk upserts, flushed in batches on a background thread.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import bson
+
+from mad3.delta import merge
+from mad3.progress import phase
+
+lg = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """Collect upserts for one collection and write them in batches.
+
+    A batch is flushed once it holds `max_ops` operations or `max_bytes`
+    of (bson encoded) updates, or when the oldest pending operation is
+    more than `interval` seconds old (checked by the writer thread, so
+    also when no further operations come in). Batches are written by a
+    background thread, one at a time and in the order they were taken,
+    so new operations can be collected while the previous batch is
+    written. At most one batch waits for the writer; beyond that
+    `upsert` blocks.
+    """
+
+    def __init__(self, app, collection, max_ops: int=10000,
+                 max_bytes: int=16000000, interval: float=60,
+                 governor=None) -> None:
+        """Prepare the writer for a pymongo collection.
+
+        With a `governor`, written operations are charged against its
+        `bulk` limit.
+        """
+        self.app = app
+        self.collection = collection
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.governor = governor
+
+        self.ops = []              # type: list
+        self.index = {}            # type: dict
+        self.nbytes = 0
+        self.since = None          # type: float
+
+        # (no ops, bytes, seconds) per flush
+        self.flushes = []          # type: list
+        self.error = None          # type: Exception
+
+        self._lock = threading.Lock()
+        self._batches = queue.Queue(maxsize=1)     # type: queue.Queue
+        self._thread = threading.Thread(
+            target=self._run, daemon=True,
+            name='bulk-{}'.format(collection.name))
+        self._thread.start()
+
+    def upsert(self, _id, update: dict):
+        """Add an upsert of one record.
+
+        An update of a record that already has a pending operation in
+        the current batch is merged into that operation. If they cannot
+        be merged (see `mad3.delta.merge`), the current batch is handed
+        to the writer first, so the updates are applied in order.
+        """
+        self._raise()
+        size = len(bson.BSON.encode(update))
+        # batches are queued under the lock, so they stay in order
+        with self._lock:
+            i = self.index.get(_id)
+            merged = None if i is None else merge(self.ops[i][1], update)
+            if merged is not None:
+                self.ops[i] = (_id, merged)
+            else:
+                if i is not None:
+                    self._batches.put(self._take())
+                self.index[_id] = len(self.ops)
+                self.ops.append((_id, update))
+            self.nbytes += size
+            if self.since is None:
+                self.since = time.time()
+
+            if len(self.ops) >= self.max_ops \
+                    or self.nbytes >= self.max_bytes \
+                    or time.time() - self.since >= self.interval:
+                self._batches.put(self._take())
+
+    def flush(self):
+        """Write all pending operations, and wait until they are written."""
+        with self._lock:
+            if self.ops:
+                self._batches.put(self._take())
+        self._batches.join()
+        self._raise()
+
+    def close(self):
+        """Flush and stop the background thread."""
+        self.flush()
+        self._batches.put(None)
+        self._thread.join()
+
+    def _take(self):
+        batch = (self.ops, self.nbytes)
+        self.ops, self.index = [], {}
+        self.nbytes = 0
+        self.since = None
+        return batch
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        timeout = max(0.01, self.interval / 4)
+        while True:
+            try:
+                batch = self._batches.get(timeout=timeout)
+            except queue.Empty:
+                self._expire()
+                continue
+            if batch is None:
+                self._batches.task_done()
+                return
+            try:
+                self._write(batch)
+            except Exception as e:
+                lg.exception("bulk write to %s failed", self.collection.name)
+                self.error = e
+            finally:
+                self._batches.task_done()
+
+    def _expire(self):
+        """Queue the pending operations if they are older than interval."""
+        # never wait for the lock: its holder may be waiting for this
+        # thread to take a batch off the queue
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            # the queue is empty and only filled under the lock
+            if self.since is not None and self._batches.empty() \
+                    and time.time() - self.since >= self.interval:
+                self._batches.put_nowait(self._take())
+        finally:
+            self._lock.release()
+
+    def _write(self, batch):
+        ops, nbytes = batch
+        if self.governor is not None:
+            self.governor.take('bulk', len(ops))
+        t0 = time.time()
+        with phase(self.app, 'write'):
+            bulk = self.collection.initialize_unordered_bulk_op()
+            for _id, update in ops:
+                bulk.find({'_id': _id}).upsert().update(update)
+            bulk.execute()
+        runtime = time.time() - t0
+
+        self.flushes.append((len(ops), nbytes, runtime))
+        counter = self.app.counter
+        counter.incr('flush')
+        counter.incr('flush_ops', len(ops))
+        counter['flush_ms'] = int(1000 * runtime)
+        lg.debug("flushed %d ops (%d bytes) to %s in %.3fs",
+                 len(ops), nbytes, self.collection.name, runtime)
+
+    def report(self):
+        """Log a summary of all flushes."""
+        if not self.flushes:
+            lg.info("no bulk data stored to %s", self.collection.name)
+            return
+        runtimes = [x[2] for x in self.flushes]
+        lg.info("%s: %d flushes, %d ops, %d bytes, "
+                "latency mean %.3fs max %.3fs",
+                self.collection.name, len(self.flushes),
+                sum(x[0] for x in self.flushes),
+                sum(x[1] for x in self.flushes),
+                sum(runtimes) / len(runtimes), max(runtimes))
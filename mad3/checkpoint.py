@@ -0,0 +1,86 @@
+"""
+Scan checkpoints.
+
+Scans process changed files in filename order. A checkpoint records the
+last filename of which all work is committed to the database (the
+watermark), plus the scan counters, so an interrupted scan can resume
+after that filename.
+"""
+
+from datetime import datetime
+import hashlib
+import logging
+import time
+
+from mad3.db import get_db
+
+lg = logging.getLogger(__name__)
+
+
+def checkpoint_id(app, basedir: str) -> str:
+    """Return the checkpoint id for a scan of basedir on this host."""
+    sha256 = hashlib.sha256()
+    sha256.update(app.conf['hostname'].encode('UTF8'))
+    sha256.update(basedir.encode('UTF8'))
+    return sha256.hexdigest()
+
+
+def load_checkpoint(app, basedir: str):
+    """Return the checkpoint of an unfinished scan of basedir, or None."""
+    db = get_db(app)
+    return db.scancheckpoint.find_one({'_id': checkpoint_id(app, basedir)})
+
+
+def clear_checkpoint(app, basedir: str):
+    """Remove the checkpoint of basedir (the scan has finished)."""
+    db = get_db(app)
+    db.scancheckpoint.remove({'_id': checkpoint_id(app, basedir)})
+
+
+class Checkpointer:
+    """Periodically store the progress of a scan."""
+
+    def __init__(self, app, basedir: str, interval: float=60,
+                 deleter=None) -> None:
+        """Prepare checkpointing a scan of basedir.
+
+        Pending removals of a `deleter` are applied before a checkpoint
+        is stored, and the position is moved back to before its held
+        records, so a resumed scan still removes them.
+        """
+        self.app = app
+        self.basedir = basedir
+        self.deleter = deleter
+        self.interval = interval
+        self.last = time.time()
+        self.db = get_db(app)
+
+    def update(self, position: str):
+        """Register that all files up to `position` have been processed.
+
+        Once every `interval` seconds, the pending bulk operations are
+        flushed and the checkpoint is stored.
+        """
+        if time.time() - self.last < self.interval:
+            return
+        self.save(position)
+
+    def save(self, position: str):
+        """Flush the bulk operations and removals, store a checkpoint."""
+        self.app.bulk_transient.flush()
+        self.app.bulk_core.flush()
+        # after the writes, which may refer to the removed records
+        if self.deleter is not None:
+            self.deleter.flush()
+            position = self.deleter.resume_position(position)
+        self.db.scancheckpoint.update_one(
+            {'_id': checkpoint_id(self.app, self.basedir)},
+            {'$set': {'basedir': self.basedir,
+                      'hostname': self.app.conf['hostname'],
+                      'position': position,
+                      'counters': dict(self.app.counter),
+                      'time': datetime.now()}},
+            upsert=True)
+        self.app.counter['checkpoint'] += 1
+        self.last = time.time()
+        lg.debug("checkpoint at %s", position)
@@ -0,0 +1,416 @@
+"""
+Checksum engine.
+
+All configured digests (`scan.digests`, sha256 is always included as it
+is the core id) are calculated from a single read of each file. Hashing
+runs in a thread pool (hashlib releases the GIL on large buffers), or
+optionally in a process pool for truly cpu bound workloads. Files with
+more than one link are read only once per (device, inode, size, mtime).
+"""
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import dbm
+import errno
+from functools import partial
+import hashlib
+import logging
+import mmap
+import os
+import threading
+
+from mad3.governor import get_governor
+
+lg = logging.getLogger(__name__)
+
+BLOCKSIZE = 2 ** 20
+
+# supported digests
+DIGESTS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'md5': hashlib.md5,
+    'blake2b': hashlib.blake2b}
+
+DEFAULT_DIGESTS = ('sha1', 'sha256')
+
+# one reusable read buffer per thread (and blocksize)
+_buffers = threading.local()
+
+
+def _buffer(blocksize: int, aligned: bool=False):
+    """Return a reusable buffer of this thread.
+
+    Aligned buffers (anonymous mmaps, page aligned) are required for
+    O_DIRECT reads.
+    """
+    key = (blocksize, aligned)
+    buf = getattr(_buffers, 'cache', {}).get(key)
+    if buf is None:
+        buf = mmap.mmap(-1, blocksize) if aligned else bytearray(blocksize)
+        _buffers.cache = getattr(_buffers, 'cache', {})
+        _buffers.cache[key] = buf
+    return buf
+
+
+def _blocks_read(F, blocksize):
+    """Plain reads, a new bytes object per block."""
+    yield from iter(lambda: F.read(blocksize), b'')
+
+
+def _blocks_readinto(F, blocksize, aligned=False):
+    """Read into one preallocated buffer, yield views on it."""
+    buf = _buffer(blocksize, aligned)
+    with memoryview(buf) as view:
+        while True:
+            n = F.readinto(buf)
+            if not n:
+                return
+            yield view[:n]
+
+
+def _blocks_mmap(F, blocksize):
+    """Map the file, yield views on the mapping."""
+    size = os.fstat(F.fileno()).st_size
+    if size == 0:
+        return
+    with mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, blocksize):
+                with view[offset:offset + blocksize] as block:
+                    yield block
+
+
+# name -> (open flags, block generator)
+BACKENDS = {
+    'read': (0, _blocks_read),
+    'readinto': (0, _blocks_readinto),
+    'mmap': (0, _blocks_mmap),
+    'direct': (getattr(os, 'O_DIRECT', 0),
+               lambda F, blocksize: _blocks_readinto(F, blocksize, True))}
+
+
+def _open(filename: str, backend: str):
+    """Open a file unbuffered, for a backend."""
+    flags = BACKENDS[backend][0]
+    try:
+        fd = os.open(filename, os.O_RDONLY | flags)
+    except OSError:
+        if not flags:
+            raise
+        # no O_DIRECT on this filesystem (e.g. tmpfs), read normally
+        lg.debug("cannot open %s with O_DIRECT", filename)
+        fd = os.open(filename, os.O_RDONLY)
+    return open(fd, 'rb', buffering=0)
+
+
+def parse_digests(names) -> tuple:
+    """Check a list of digest names; return them, sha256 included."""
+    if isinstance(names, str):
+        names = names.replace(',', ' ').split()
+    names = list(names)
+    for name in names:
+        if name not in DIGESTS:
+            raise ValueError("invalid digest: {}".format(name))
+    if 'sha256' not in names:
+        names.append('sha256')
+    return tuple(sorted(set(names), key=names.index))
+
+
+def digest(filename: str, digests=DEFAULT_DIGESTS,
+           blocksize: int=BLOCKSIZE, backend: str='readinto',
+           fadvise: bool=True, throttle=None):
+    """Return ({name: hexdigest}, bytes read) for a file.
+
+    All `digests` are calculated from one read of the file. The
+    `backend` determines how the file is read, see BACKENDS. With
+    `fadvise`, the kernel is told the file is read sequentially, and
+    that its pages are not needed afterwards, so a scan does not evict
+    the page cache other jobs depend on. `throttle(n)` is called for
+    every block of n bytes read (e.g. to charge a rate limit).
+    """
+    hashers = [(name, DIGESTS[name]()) for name in digests]
+    updates = [h.update for _, h in hashers]
+    size = 0
+    fadvise = fadvise and hasattr(os, 'posix_fadvise')
+    with _open(filename, backend) as F:
+        if fadvise:
+            os.posix_fadvise(F.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            for chunk in BACKENDS[backend][1](F, blocksize):
+                for update in updates:
+                    update(chunk)
+                size += len(chunk)
+                if throttle is not None:
+                    throttle(len(chunk))
+        except OSError as e:
+            if size or e.errno != errno.EINVAL or not BACKENDS[backend][0]:
+                raise
+            # O_DIRECT refused on read (an unaligned block size, or a
+            # filesystem that accepts the flag but not the reads)
+            lg.debug("cannot read %s with O_DIRECT", filename)
+            return digest(filename, digests, blocksize=blocksize,
+                          fadvise=fadvise, throttle=throttle)
+        if fadvise:
+            os.posix_fadvise(F.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return {name: h.hexdigest() for name, h in hashers}, size
+
+
+def checksum(filename: str, blocksize: int=BLOCKSIZE,
+             backend: str='readinto', fadvise: bool=True):
+    """Return (sha1, sha256, bytes read) for a file, see `digest`."""
+    digests, size = digest(filename, DEFAULT_DIGESTS, blocksize=blocksize,
+                           backend=backend, fadvise=fadvise)
+    return digests['sha1'], digests['sha256'], size
+
+
+def fingerprint(filename: str, size: int=None, blocksize: int=65536,
+                samples: int=4) -> str:
+    """Return a cheap partial-content fingerprint of a file.
+
+    Digest of the size, the first and last `blocksize` bytes, and
+    `samples` blocks evenly spread in between. Files with different
+    fingerprints differ; equal fingerprints only suggest equal content.
+    """
+    if size is None:
+        size = os.stat(filename).st_size
+    h = hashlib.blake2b(str(size).encode('ascii'), digest_size=16)
+    with open(filename, 'rb') as F:
+        if size <= blocksize * (samples + 2):
+            # small file, the whole file is the fingerprint
+            h.update(F.read())
+        else:
+            step = (size - blocksize) // (samples + 1)
+            offsets = [i * step for i in range(samples + 1)]
+            for offset in offsets + [size - blocksize]:
+                F.seek(offset)
+                h.update(F.read(blocksize))
+    return h.hexdigest()
+
+
+class InodeCache:
+    """Digests of hardlinked files, by (device, inode, size, mtime).
+
+    The first link to an inode is hashed, all other links reuse its
+    digests. Concurrent requests for the same inode wait for the first
+    one. With a `path`, digests are also stored in a dbm file, so they
+    are reused across runs; `prefix` keeps the dbm entries of different
+    digest sets apart.
+    """
+
+    def __init__(self, path: str=None, counter=None,
+                 prefix: str='') -> None:
+        """Create the cache, optionally persisted in a dbm file."""
+        self.path = path
+        self.counter = counter
+        self.prefix = prefix
+        self.digests = {}      # type: dict
+        self._pending = {}     # type: dict
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = dbm.open(path, 'c')
+
+    @staticmethod
+    def key(st) -> tuple:
+        """Return the cache key for a stat result."""
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _lookup(self, key):
+        rv = self.digests.get(key)
+        if rv is None and self._db is not None:
+            value = self._db.get(self._dbkey(key))
+            if value is not None:
+                rv = tuple(value.decode('ascii').split())
+                self.digests[key] = rv
+        return rv
+
+    def _dbkey(self, key):
+        return self.prefix + '{}:{}:{}:{}'.format(*key)
+
+    def _store(self, key, digests):
+        self.digests[key] = digests
+        if self._db is not None:
+            self._db[self._dbkey(key)] = ' '.join(digests)
+
+    def checksum(self, st, compute):
+        """Return (*digests, bytes read) for the inode of `st`.
+
+        `compute()` is called to hash the file if the inode is not known
+        yet, and returns a tuple of hex digests plus the bytes read;
+        reused digests have 0 bytes read.
+        """
+        key = self.key(st)
+        with self._lock:
+            digests = self._lookup(key)
+            future = self._pending.get(key) if digests is None else None
+            owner = digests is None and future is None
+            if owner:
+                future = self._pending[key] = Future()
+
+        if digests is None and not owner:
+            digests = future.result()
+
+        if digests is not None:
+            if self.counter is not None:
+                self.counter.incr('linkreuse')
+                self.counter.incr('linksaved_sz', st.st_size)
+            return tuple(digests) + (0,)
+
+        try:
+            *digests, size = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+        digests = tuple(digests)
+        with self._lock:
+            self._store(key, digests)
+            del self._pending[key]
+        future.set_result(digests)
+        return digests + (size,)
+
+    def close(self):
+        """Close the dbm file (if any)."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class ChecksumEngine:
+    """Pool of hashing workers."""
+
+    def __init__(self, workers: int=4, pool: str='thread',
+                 inodes: InodeCache=None, backend: str='readinto',
+                 fadvise: bool=True, governor=None,
+                 digests=DEFAULT_DIGESTS) -> None:
+        """Create the engine; pool is either `thread` or `process`.
+
+        Hardlinked files are hashed once if an `inodes` cache is given.
+        Files are read with `backend` (see `digest`), and `digests` are
+        calculated (sha256 is always included). With a `governor`, the
+        bytes read are charged against its `read` limit, per block (per
+        file with a process pool).
+        """
+        if pool not in ('thread', 'process'):
+            raise ValueError("invalid hash pool: {}".format(pool))
+        if backend not in BACKENDS:
+            raise ValueError("invalid hash backend: {}".format(backend))
+        self.workers = max(1, workers)
+        self.pool = pool
+        self.inodes = inodes
+        self.backend = backend
+        self.fadvise = fadvise
+        self.governor = governor
+        self.digests = parse_digests(digests)
+        self._threads = None
+        self._processes = None
+
+    @property
+    def threads(self):
+        """Thread pool, created on first use."""
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(self.workers)
+        return self._threads
+
+    @property
+    def processes(self):
+        """Process pool, created on first use."""
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(self.workers)
+        return self._processes
+
+    def digest(self, filename: str, st=None, digests=None):
+        """Return ({name: hexdigest}, bytes read) for a file.
+
+        Calculates the engine's digests, or only `digests` if given
+        (e.g. to fill in a digest later). With a process pool the work
+        is shipped to a worker process and the calling thread waits;
+        otherwise it is done in the calling thread (run several of
+        those through `map` for parallelism). If the stat result `st`
+        shows more than one link, the engine's digests are looked up in
+        (or added to) the inode cache.
+        """
+        names = self.digests if digests is None else tuple(digests)
+        size = st.st_size if st else None
+        if st is not None and st.st_nlink > 1 and self.inodes is not None \
+                and names == self.digests:
+            def compute():
+                rv, nbytes = self._digest(filename, size, names)
+                return tuple(rv[n] for n in names) + (nbytes,)
+            *values, nbytes = self.inodes.checksum(st, compute)
+            return dict(zip(names, values)), nbytes
+        return self._digest(filename, size, names)
+
+    def checksum(self, filename: str, st=None):
+        """Return (sha1, sha256, bytes read) for a file.
+
+        sha1 is None if it is not one of the engine's digests.
+        """
+        digests, size = self.digest(filename, st)
+        return digests.get('sha1'), digests['sha256'], size
+
+    def _digest(self, filename, size, names):
+        kwargs = dict(backend=self.backend, fadvise=self.fadvise)
+        if self.pool == 'process':
+            # the governor stays in this process: charge the whole file
+            if self.governor is not None:
+                if size is None:
+                    size = os.path.getsize(filename)
+                self.governor.take('read', size)
+            return self.processes.submit(
+                digest, filename, names, **kwargs).result()
+        if self.governor is not None:
+            kwargs['throttle'] = partial(self.governor.take, 'read')
+        return digest(filename, names, **kwargs)
+
+    def map(self, func, items):
+        """Apply func to all items in the thread pool.
+
+        Results are yielded in input order. At most a few items per
+        worker are in flight, so `items` can be a long lazy iterator.
+        """
+        pending = deque()     # type: deque
+        window = self.workers * 4
+        for item in items:
+            pending.append(self.threads.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def shutdown(self):
+        """Stop the worker pools."""
+        for pool in (self._threads, self._processes):
+            if pool is not None:
+                pool.shutdown()
+        self._threads = self._processes = None
+        if self.inodes is not None:
+            self.inodes.close()
+
+
+def get_engine(app) -> ChecksumEngine:
+    """Return the checksum engine of an app, create it if necessary."""
+    engine = getattr(app, 'checksum_engine', None)
+    if engine is None:
+        conf = app.conf['scan']
+        digests = parse_digests(conf['digests'])
+        # dbm entries of the default digest set are unprefixed
+        prefix = '' if digests == DEFAULT_DIGESTS \
+            else ','.join(digests) + ':'
+        inodes = InodeCache(path=conf['inode_cache'] or None,
+                            counter=app.counter, prefix=prefix)
+        engine = ChecksumEngine(workers=int(conf['hash_workers']),
+                                pool=conf['hash_pool'], inodes=inodes,
+                                backend=conf['hash_backend'],
+                                fadvise=bool(conf['fadvise']),
+                                governor=get_governor(app),
+                                digests=digests)
+        app.checksum_engine = engine
+    return engine
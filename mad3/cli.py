@@ -2,13 +2,15 @@
 Main dispatch code
 """
 
-from collections import Counter
 import sys
 import socket
 
 import leip
 from mad3 import ui
 from mad3 import madfile
+from mad3.exceptions import M3UnknownKey
+from mad3.keywords import get_schema
+from mad3.util import SafeCounter
 
 # add communication functions
 ui.init_app(leip.app)
@@ -16,10 +18,11 @@ ui.init_app(leip.app)
 # bulk operation
 leip.app.bulk_init = madfile.bulk_init
 leip.app.bulk_execute = madfile.bulk_execute
+leip.app.bulk_upsert = madfile.bulk_upsert
 
 
 app = leip.app(name='mad3')
-app.counter = Counter()
+app.counter = SafeCounter()
 
 app.discover(globals())
 
@@ -33,9 +36,22 @@ if not 'hostname' in app.conf:
         app.message("Try: m3 conf set hostname '{hostname}'",
                     hostname = socket.gethostname())
         exit(-1)
-    
+
+# compile the keyword schema
+get_schema(app)
+
 def dispatch():
     """
     Run the mad3 app
     """
-    app.run()
+    try:
+        app.run()
+    except M3UnknownKey as e:
+        app.warning("Bad key: {}".format(e.args[0]))
+        exit(-1)
+    finally:
+        # close the persistent (dbm) caches
+        if getattr(app, 'dirconfig', None) is not None:
+            app.dirconfig.close()
+        if getattr(app, 'checksum_engine', None) is not None:
+            app.checksum_engine.shutdown()
@@ -0,0 +1,202 @@
+"""
+Distributed scans.
+
+A coordinator splits a tree into work units, stored in the `scanunit`
+collection. Workers on any node claim units with a time limited lease,
+scan them and store their counters (also while they run). Units with an
+expired lease (a dead worker) are claimed again, failed units after a
+backoff. The governor limits are shared by the workers
+active on a job.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import os
+import threading
+
+import pymongo
+
+from mad3.db import get_db
+from mad3.governor import get_governor
+from mad3.util import get_random_sha256
+from mad3.walk import Walker, load_ignore
+
+lg = logging.getLogger(__name__)
+
+
+def create_units(app, basedir: str, depth: int=2):
+    """Split basedir in work units, return (job id, no units).
+
+    Every directory at `depth` levels below basedir is a unit covering
+    its whole subtree; every directory above that is a unit covering
+    only the files directly in it.
+    """
+    db = get_db(app)
+    job = get_random_sha256()[:12]
+    walker = Walker(basedir, ignore=load_ignore())
+    now = datetime.utcnow()
+    units = []
+
+    def add(dirname, recursive):
+        _id = hashlib.sha256('{}:{}'.format(job, dirname).encode('UTF8'))
+        units.append({
+            '_id': _id.hexdigest(),
+            'job': job,
+            'basedir': basedir,
+            'hostname': app.conf['hostname'],
+            'dirname': dirname,
+            'recursive': recursive,
+            'state': 'pending',
+            'owner': None,
+            'lease_until': None,
+            'not_before': None,
+            'attempts': 0,
+            'created': now,
+            'counters': {}})
+
+    def split(dirname, level):
+        if level >= depth:
+            add(dirname, True)
+            return
+        add(dirname, False)
+        files, subdirs = walker.listdir(dirname)
+        for subdir in sorted(subdirs):
+            split(subdir, level + 1)
+
+    split(basedir, 0)
+    db.scanunit.insert_many(units)
+    return job, len(units)
+
+
+class Worker:
+    """Claim and process work units until there are none left."""
+
+    def __init__(self, app, job: str=None) -> None:
+        """Prepare the worker (optionally only for one job)."""
+        self.app = app
+        self.job = job
+        self.db = get_db(app)
+        conf = app.conf['scan']
+        self.lease = timedelta(seconds=float(conf['lease']))
+        self.max_attempts = int(conf['max_attempts'])
+        self.backoff = float(conf['retry_backoff'])
+        self.owner = '{}:{}'.format(app.conf['hostname'], os.getpid())
+
+    def claim(self):
+        """Claim a pending or failed unit, or one with an expired lease.
+
+        Failed units are retried, up to `max_attempts` attempts, but not
+        before their backoff has passed.
+        """
+        now = datetime.utcnow()
+        query = {'$or': [{'state': 'pending'},
+                         {'state': 'failed'},
+                         {'state': 'leased', 'lease_until': {'$lt': now}}],
+                 'attempts': {'$lt': self.max_attempts},
+                 'not_before': {'$not': {'$gt': now}}}
+        if self.job:
+            query['job'] = self.job
+        return self.db.scanunit.find_one_and_update(
+            query,
+            {'$set': {'state': 'leased', 'owner': self.owner,
+                      'lease_until': now + self.lease},
+             '$inc': {'attempts': 1}},
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def _finish(self, unit, **update):
+        update['lease_until'] = None
+        update['finished'] = datetime.utcnow()
+        result = self.db.scanunit.update_one(
+            {'_id': unit['_id'], 'owner': self.owner}, {'$set': update})
+        if result.matched_count == 0:
+            lg.warning("lease on %s was lost", unit['dirname'])
+
+    def _share_limits(self, unit):
+        """Divide the governor limits over the workers active on the job."""
+        owners = self.db.scanunit.distinct('owner', {
+            'job': unit['job'], 'state': 'leased',
+            'lease_until': {'$gt': datetime.utcnow()}})
+        get_governor(self.app).set_share(len(owners))
+
+    def _progress(self, before: Counter) -> dict:
+        """Return the counters of this unit: the increase since `before`."""
+        counters = Counter(self.app.counter)
+        counters.subtract(before)
+        return {k: v for k, v in counters.items() if v > 0}
+
+    def _heartbeat(self, unit, before, stop):
+        """Renew the lease on a unit, store its counters until `stop`."""
+        while not stop.wait(self.lease.total_seconds() / 3):
+            result = self.db.scanunit.update_one(
+                {'_id': unit['_id'], 'owner': self.owner},
+                {'$set': {'lease_until': datetime.utcnow() + self.lease,
+                          'counters': self._progress(before)}})
+            if result.matched_count == 0:
+                lg.warning("lease on %s was lost", unit['dirname'])
+                return
+            self._share_limits(unit)
+
+    def run(self, scanfunc):
+        """Process units with `scanfunc(dirname, recursive)`."""
+        while True:
+            unit = self.claim()
+            if unit is None:
+                lg.info("no work units left")
+                get_governor(self.app).set_share(1)
+                return
+
+            lg.info("scanning unit %s", unit['dirname'])
+            # all workers scan as the host of the coordinator, so the
+            # transient ids do not depend on the node
+            hostname = self.app.conf['hostname']
+            self.app.conf['hostname'] = unit['hostname']
+            before = Counter(self.app.counter)
+            self._share_limits(unit)
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=self._heartbeat, args=(unit, before, stop),
+                daemon=True)
+            heartbeat.start()
+            try:
+                scanfunc(unit['dirname'], unit['recursive'])
+            except KeyboardInterrupt:
+                self._finish(unit, state='pending', owner=None)
+                raise
+            except Exception as e:
+                lg.exception("scan of unit %s failed", unit['dirname'])
+                # back off exponentially before the unit is retried
+                wait = self.backoff * 2 ** (unit['attempts'] - 1)
+                self._finish(unit, state='failed', error=str(e),
+                             not_before=datetime.utcnow() +
+                             timedelta(seconds=wait))
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+                self.app.conf['hostname'] = hostname
+
+            self._finish(unit, state='done',
+                         counters=self._progress(before))
+
+
+def job_status(app, job: str=None) -> list:
+    """Aggregate unit states and counters per job."""
+    db = get_db(app)
+    query = {} if job is None else {'job': job}
+    now = datetime.utcnow()
+    jobs = {}
+    for unit in db.scanunit.find(query).sort('created', pymongo.ASCENDING):
+        rec = jobs.setdefault(unit['job'], {
+            '_id': unit['job'],
+            'basedir': unit['basedir'],
+            'hostname': unit['hostname'],
+            'states': Counter(),
+            'counters': Counter()})
+        state = unit['state']
+        if state == 'leased' and unit['lease_until'] < now:
+            state = 'expired'
+        rec['states'][state] += 1
+        rec['counters'].update(unit.get('counters', {}))
+    return list(jobs.values())
@@ -0,0 +1,84 @@
+"""
+Minimal MongoDB updates between two versions of a record.
+
+Changed scalars are written with `$set`, values added to set-shaped
+(list) fields with `$addToSet`/`$each`, values removed with `$pull` and
+removed fields with `$unset`. The same updates are used for bulk and
+direct writes.
+"""
+
+UPDATE_OPS = ('$set', '$unset', '$addToSet', '$pull')
+
+
+def snapshot(rec: dict) -> dict:
+    """Return a copy of a record to compute a delta against later."""
+    if rec is None:
+        return {}
+    return {k: list(v) if isinstance(v, list) else v
+            for k, v in rec.items()}
+
+
+def _missing(values: list, other: list) -> list:
+    """Return the values that are not in other."""
+    try:
+        lookup = set(other)
+    except TypeError:
+        # unhashable values (e.g. dictionaries): compare one by one
+        lookup = other
+    return [x for x in values if x not in lookup]
+
+
+def delta(old: dict, new: dict) -> dict:
+    """Return the update that turns record `old` into `new`.
+
+    Returns an empty dictionary if nothing changed. `_id` is never part
+    of the update.
+    """
+    update = {}     # type: dict
+    for k, v in new.items():
+        if k == '_id':
+            continue
+        if k not in old:
+            update.setdefault('$set', {})[k] = v
+            continue
+        ov = old[k]
+        if ov == v:
+            continue
+        if isinstance(v, list) and isinstance(ov, list):
+            added = _missing(v, ov)
+            removed = _missing(ov, v)
+            if added and not removed:
+                update.setdefault('$addToSet', {})[k] = {'$each': added}
+                continue
+            if removed and not added:
+                update.setdefault('$pull', {})[k] = {'$in': removed}
+                continue
+        update.setdefault('$set', {})[k] = v
+    for k in old:
+        if k not in new and k != '_id':
+            update.setdefault('$unset', {})[k] = ''
+    return update
+
+
+def fields(update: dict) -> set:
+    """Return the fields touched by an update."""
+    return set(k for op in update.values() for k in op)
+
+
+def merge(first: dict, second: dict) -> dict:
+    """Merge two updates of the same record into one.
+
+    Returns None if the updates cannot be merged, i.e. when they touch
+    the same field other than with `$set` in both.
+    """
+    rv = {op: dict(v) for op, v in first.items()}
+    touched = fields(first)
+    for op, values in second.items():
+        for k, v in values.items():
+            if op == '$set' and k in rv.get('$set', {}):
+                rv['$set'][k] = v
+            elif k in touched:
+                return None
+            else:
+                rv.setdefault(op, {})[k] = v
+    return rv
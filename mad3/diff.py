@@ -0,0 +1,71 @@
+"""
+Streaming comparison of the filesystem with the database.
+
+Files are compared on a stat signature: nanosecond mtime, size, ctime,
+inode and device. Any difference means the transient record needs an
+update; only a change of mtime, size, inode or device means the
+content may have changed and the file has to be hashed again (ctime
+also changes with ownership or permissions).
+"""
+
+from datetime import datetime
+
+# transient record fields of the signature, in order
+SIGNATURE = ('mtime_ns', 'size', 'ctime_ns', 'ino', 'dev')
+
+
+def signature(st) -> tuple:
+    """Return the signature of a stat result."""
+    return (st.st_mtime_ns, st.st_size, st.st_ctime_ns, st.st_ino,
+            st.st_dev)
+
+
+def db_signature(rec: dict) -> tuple:
+    """Return the signature stored in a transient record."""
+    return tuple(rec.get(k) for k in SIGNATURE)
+
+
+def content_changed(rec: dict, st) -> bool:
+    """Might the content have changed since the record was made?
+
+    Records without a signature (from older versions) are compared on
+    size and mtime (in whole seconds).
+    """
+    if rec.get('mtime_ns') is None:
+        return (rec.get('size'), rec.get('mtime')) != \
+            (st.st_size, datetime.fromtimestamp(int(st.st_mtime)))
+    return (rec['mtime_ns'], rec['size'], rec.get('ino'), rec.get('dev')) \
+        != (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+
+
+def merge_join(fsrecords, dbrecords):
+    """Join two streams of file records, both sorted by filename.
+
+    `fsrecords` yields (filename, *signature) tuples and `dbrecords`
+    yields transient records (dictionaries with at least a `filename`).
+    Yields (fsrec, dbrec) pairs, where one of the two is None for files
+    only on the filesystem or only in the database. Only the current
+    record of each stream is held in memory.
+    """
+    fsrecords = iter(fsrecords)
+    dbrecords = iter(dbrecords)
+    fsrec = next(fsrecords, None)
+    dbrec = next(dbrecords, None)
+
+    while fsrec is not None or dbrec is not None:
+        if dbrec is None or \
+                (fsrec is not None and fsrec[0] < dbrec['filename']):
+            yield fsrec, None
+            fsrec = next(fsrecords, None)
+        elif fsrec is None or dbrec['filename'] < fsrec[0]:
+            yield None, dbrec
+            dbrec = next(dbrecords, None)
+        else:
+            yield fsrec, dbrec
+            fsrec = next(fsrecords, None)
+            dbrec = next(dbrecords, None)
+
+
+def unchanged(fsrec, dbrec) -> bool:
+    """Do the filesystem and database record have the same signature?"""
+    return db_signature(dbrec) == tuple(fsrec[1:])
@@ -0,0 +1,135 @@
+"""
+Per directory `mad.config` data.
+
+The data of a directory is that of all `mad.config` files from the top
+down to the directory itself, later files overriding earlier ones. It
+is kept in a trie of directories: every `mad.config` is parsed once,
+and a directory reuses the merged data of its parent. A `mad.config`
+is stat'ed again if it was last checked more than `ttl` seconds ago,
+and parsed again if its mtime or size changed. With a `path`, parsed
+files are also stored in a dbm file, so later runs skip parsing
+unchanged files.
+"""
+
+import dbm
+import logging
+import os
+import pickle
+import threading
+import time
+
+import yaml
+
+lg = logging.getLogger(__name__)
+
+CONFIG_NAME = 'mad.config'
+
+# the C loader, if pyyaml was built with libyaml
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class Node:
+    """A directory in the trie."""
+
+    __slots__ = ('children', 'stamp', 'own', 'base', 'merged', 'checked')
+
+    def __init__(self) -> None:
+        self.children = {}     # type: dict
+        self.stamp = None      # type: tuple
+        self.own = {}          # type: dict
+        self.base = None       # type: dict
+        self.merged = {}       # type: dict
+        self.checked = None    # type: float
+
+
+class DirConfig:
+    """Resolve and cache the `mad.config` data of directories."""
+
+    def __init__(self, ttl: float=60, path: str=None, counter=None) -> None:
+        """Create an empty cache, optionally persisted in a dbm file."""
+        self.ttl = ttl
+        self.counter = counter
+        self.root = Node()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = dbm.open(path, 'c')
+
+    def _count(self, name):
+        if self.counter is not None:
+            self.counter[name] += 1
+
+    def _parse(self, filename: str, stamp: tuple) -> dict:
+        key = filename.encode('UTF8')
+        if self._db is not None and key in self._db:
+            cached_stamp, data = pickle.loads(self._db[key])
+            if cached_stamp == stamp:
+                return data
+        self._count('madconfig_parse')
+        try:
+            with open(filename) as F:
+                data = yaml.load(F, Loader=Loader) or {}
+        except (OSError, yaml.YAMLError) as e:
+            lg.warning("cannot read %s: %s", filename, e)
+            data = {}
+        if self._db is not None:
+            self._db[key] = pickle.dumps((stamp, data))
+        return data
+
+    def _check(self, node: Node, dirname: str, now: float):
+        """Reload the mad.config of a directory node, if it changed."""
+        if node.checked is not None and now - node.checked < self.ttl:
+            return
+        node.checked = now
+        filename = os.path.join(dirname, CONFIG_NAME)
+        try:
+            st = os.stat(filename)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp == node.stamp:
+            return
+        node.stamp = stamp
+        node.own = {} if stamp is None else self._parse(filename, stamp)
+        # force a merge with the parent data
+        node.base = None
+
+    def get(self, dirname: str) -> dict:
+        """Return the merged data for a directory (do not modify it)."""
+        now = time.monotonic()
+        parts = [p for p in dirname.split(os.sep) if p]
+        with self._lock:
+            node, path, merged = self.root, os.sep, {}
+            for part in parts:
+                node = node.children.setdefault(part, Node())
+                path = os.path.join(path, part)
+                self._check(node, path, now)
+                if node.base is not merged:
+                    node.base = merged
+                    if node.own:
+                        node.merged = dict(merged)
+                        node.merged.update(node.own)
+                    else:
+                        node.merged = merged
+                merged = node.merged
+            return merged
+
+    def close(self):
+        """Close the dbm file."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def get_dirconfig(app) -> DirConfig:
+    """Return the mad.config cache of an app, create it if necessary."""
+    dirconfig = getattr(app, 'dirconfig', None)
+    if dirconfig is None:
+        conf = app.conf['madfile']
+        dirconfig = DirConfig(ttl=float(conf['config_ttl']),
+                              path=conf['config_cache'] or None,
+                              counter=app.counter)
+        app.dirconfig = dirconfig
+    return dirconfig
@@ -0,0 +1,73 @@
+"""
+Directory signatures of earlier scans.
+
+Stored in the `dirstate` collection, one record per directory and host,
+so an incremental scan can skip listing directories that did not change.
+"""
+
+import hashlib
+import logging
+import re
+
+from mad3.db import get_db
+
+lg = logging.getLogger(__name__)
+
+
+def dirstate_id(app, dirname: str) -> str:
+    """Return the record id of a directory (like a transient id)."""
+    sha256 = hashlib.sha256()
+    sha256.update(app.conf['hostname'].encode('UTF8'))
+    sha256.update(dirname.encode('UTF8'))
+    return sha256.hexdigest()
+
+
+def _query(app, basedir: str) -> dict:
+    """Query for all directory records at or below basedir."""
+    return {'hostname': app.conf['hostname'],
+            'dirname': {'$regex': '^{}(/|$)'.format(
+                re.escape(basedir.rstrip('/')))}}
+
+
+def load_dirstate(app, basedir: str) -> dict:
+    """Return dirname -> (signature, subdirs) for dirs below basedir."""
+    db = get_db(app)
+    rv = {}
+    for rec in db.dirstate.find(_query(app, basedir)):
+        rv[rec['dirname']] = ((rec['mtime_ns'], rec['ctime_ns']),
+                              rec['subdirs'])
+    lg.info("loaded {} directory signatures".format(len(rv)))
+    return rv
+
+
+def save_dirstate(app, basedir: str, dirstate: dict, recursive: bool=True):
+    """Store the directory signatures of a completed walk.
+
+    Records of directories below basedir that were not seen in a
+    recursive walk are removed.
+    """
+    db = get_db(app)
+    seen = set()
+    bulk = db.dirstate.initialize_unordered_bulk_op()
+    for dirname, ((mtime_ns, ctime_ns), subdirs) in dirstate.items():
+        _id = dirstate_id(app, dirname)
+        seen.add(_id)
+        bulk.find({'_id': _id}).upsert().update({'$set': {
+            'hostname': app.conf['hostname'],
+            'dirname': dirname,
+            'mtime_ns': mtime_ns,
+            'ctime_ns': ctime_ns,
+            'subdirs': subdirs}})
+    if seen:
+        bulk.execute()
+
+    if not recursive:
+        lg.info("stored {} directory signatures".format(len(seen)))
+        return
+
+    stale = [rec['_id'] for rec in db.dirstate.find(
+        _query(app, basedir), projection=['_id']) if rec['_id'] not in seen]
+    if stale:
+        db.dirstate.remove({'_id': {'$in': stale}})
+    lg.info("stored {} directory signatures, removed {}"
+            .format(len(seen), len(stale)))
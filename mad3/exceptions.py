@@ -29,3 +29,9 @@ class M3OutputFileChanged(M3FileChanged):
     """An file has changed."""
 
     pass
+
+
+class M3UnknownKey(KeyError):
+    """A key is not in the keyword schema."""
+
+    pass
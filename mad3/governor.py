@@ -0,0 +1,171 @@
+"""
+Rate limits for scans on shared storage.
+
+A governor holds one token bucket per resource: `read` (bytes/s read
+for hashing), `stat` (files stat'ed per second) and `bulk` (bulk write
+operations per second to MongoDB). All workers of a process share the
+governor of the app. The workers of a distributed scan (on any node)
+share the limits: each uses its share, the limit divided by the number
+of workers active on the job. Limits are read from the `governor`
+config, and can be changed at runtime by editing the control file, which is
+checked every few seconds, or on the next use after a SIGUSR1.
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+
+import yaml
+
+from mad3.util import parse_size
+
+lg = logging.getLogger(__name__)
+
+RESOURCES = ('read', 'stat', 'bulk')
+
+# seconds between checks of the control file
+CHECK_INTERVAL = 5
+
+
+class TokenBucket:
+    """Thread safe token bucket; a rate of 0 means unlimited.
+
+    Up to `burst` seconds worth of tokens are saved up. A request for
+    more tokens than available is granted, but the caller sleeps until
+    the debt is paid off, so large requests (a whole file) average out
+    to the right rate.
+    """
+
+    def __init__(self, rate: float=0, burst: float=1) -> None:
+        """Create a full bucket."""
+        self.burst = burst
+        self.rate = rate
+        self.tokens = rate * burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate: float):
+        """Change the rate."""
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate * self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, n: float=1) -> float:
+        """Take n tokens, sleep if needed; return the time slept."""
+        with self._lock:
+            if not self.rate:
+                return 0
+            self._refill()
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Governor:
+    """Token buckets for all throttled resources."""
+
+    def __init__(self, limits: dict=None, control: str=None) -> None:
+        """Create the buckets; `limits` maps resource -> rate."""
+        self.buckets = {r: TokenBucket() for r in RESOURCES}
+        self.control = os.path.expanduser(control) if control else None
+        self.limits = {}          # type: dict
+        self.share = 1
+        self.waited = dict.fromkeys(RESOURCES, 0.0)
+        self._mtime = None
+        self._checked = time.monotonic()
+        # set by the signal handler, which must not take any lock
+        self._signalled = False
+        self._lock = threading.Lock()
+        self.set_limits(limits or {})
+        self.reload()
+
+    def set_limits(self, limits: dict):
+        """Set the rate of some resources (sizes like `50M` are fine)."""
+        for resource, rate in limits.items():
+            if resource not in self.buckets:
+                lg.warning("unknown governor resource: %s", resource)
+                continue
+            rate = parse_size(rate) if rate else 0
+            if self.limits.get(resource) != rate:
+                lg.info("limit %s at %s/s", resource, rate or 'unlimited')
+            self.limits[resource] = rate
+            self.buckets[resource].set_rate(rate / self.share)
+
+    def set_share(self, workers: int):
+        """Use 1/workers of every limit (the others use the rest)."""
+        workers = max(1, workers)
+        if workers == self.share:
+            return
+        lg.info("governor limits shared by %d workers", workers)
+        self.share = workers
+        for resource, rate in self.limits.items():
+            self.buckets[resource].set_rate(rate / workers)
+
+    def reload(self, force: bool=False):
+        """Read the control file, if it changed (or with `force`)."""
+        self._checked = time.monotonic()
+        if not self.control:
+            return
+        try:
+            mtime = os.stat(self.control).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime and not force:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.control) as F:
+                limits = yaml.safe_load(F)
+        except (OSError, yaml.YAMLError) as e:
+            lg.warning("cannot read %s: %s", self.control, e)
+            return
+        if isinstance(limits, dict):
+            self.set_limits(limits)
+
+    def take(self, resource: str, n: float=1):
+        """Use n units of a resource, sleep if over the limit."""
+        if self._signalled:
+            self._signalled = False
+            self.reload(force=True)
+        elif time.monotonic() - self._checked > CHECK_INTERVAL:
+            self.reload()
+        waited = self.buckets[resource].take(n)
+        if waited:
+            with self._lock:
+                self.waited[resource] += waited
+
+    def install_signal(self, signum=signal.SIGUSR1):
+        """Reread the control file after a signal (main thread only).
+
+        The handler only flags the reload; the next `take` does it.
+        """
+        def handler(*_):
+            self._signalled = True
+        signal.signal(signum, handler)
+
+
+def get_governor(app) -> Governor:
+    """Return the governor of an app, create it if necessary."""
+    governor = getattr(app, 'governor', None)
+    if governor is None:
+        conf = app.conf['governor']
+        governor = Governor({r: conf[r] for r in RESOURCES},
+                            control=conf['control'] or None)
+        try:
+            governor.install_signal()
+        except ValueError:
+            # not in the main thread
+            pass
+        app.governor = governor
+    return governor
@@ -0,0 +1,93 @@
+"""
+Compiled keyword schema.
+
+The `keywords` config is compiled once into a flat, read only table
+of key descriptors, with aliases resolved. Looking up a key is a
+single dictionary lookup; unknown keys raise `M3UnknownKey`.
+"""
+
+from types import MappingProxyType
+
+from mad3.exceptions import M3UnknownKey
+from mad3.util import datasetter, datatypes, setone
+
+
+class KeyInfo:
+    """Read only description of a keyword."""
+
+    __slots__ = ('name', 'shape', 'cat', 'type', 'desc', 'transformer',
+                 'setter')
+
+    def __init__(self, name: str, info: dict) -> None:
+        """Compile the config of keyword `name`, filling in defaults."""
+        set_ = object.__setattr__
+        set_(self, 'name', name)
+        set_(self, 'shape', str(info.get('shape', 'one')))
+        set_(self, 'cat', frozenset(info.get('cat', ['transient', 'core'])))
+        set_(self, 'type', str(info.get('type', 'str')))
+        set_(self, 'desc', info.get('desc', ''))
+        set_(self, 'transformer', datatypes.get(self.type, str))
+        set_(self, 'setter', datasetter.get(self.shape, setone))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("KeyInfo is read only")
+
+    def __getitem__(self, name):
+        """Dictionary style access, e.g. `info['shape']`."""
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __repr__(self):
+        return 'KeyInfo({!r}, shape={!r}, cat={})'.format(
+            self.name, self.shape, sorted(self.cat))
+
+
+class Schema:
+    """All keywords, by name and alias."""
+
+    def __init__(self, keywords: dict) -> None:
+        """Compile the `keywords` config."""
+        infos = {}
+        for name, info in keywords.items():
+            if 'alias' not in (info or {}):
+                infos[name] = KeyInfo(name, info or {})
+
+        table = dict(infos)
+        for name in keywords:
+            if name in table:
+                continue
+            seen = [name]
+            target = keywords[name]['alias']
+            while target not in infos:
+                if target in seen or target not in keywords:
+                    raise M3UnknownKey("bad alias: {}".format(
+                        ' -> '.join(seen + [target])))
+                seen.append(target)
+                target = keywords[target]['alias']
+            table[name] = infos[target]
+        self.keys = MappingProxyType(table)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def get(self, key: str) -> KeyInfo:
+        """Return the descriptor of a key or alias, None if unknown."""
+        return self.keys.get(key)
+
+    def resolve(self, key: str) -> tuple:
+        """Return (key name, descriptor) of a key or alias."""
+        try:
+            info = self.keys[key]
+        except KeyError:
+            raise M3UnknownKey(key)
+        return info.name, info
+
+
+def get_schema(app) -> Schema:
+    """Return the keyword schema of an app, compile it if necessary."""
+    schema = getattr(app, 'schema', None)
+    if schema is None:
+        schema = app.schema = Schema(app.conf['keywords'])
+    return schema
@@ -1,5 +1,6 @@
 
 
+from contextlib import contextmanager
 from datetime import datetime
 import getpass
 import grp
@@ -10,10 +11,15 @@ import os
 import pwd
 import stat
 
-import pymongo.errors
-
+from mad3.bulk import BulkWriter
+from mad3.checksum import DIGESTS, fingerprint, get_engine
 from mad3.db import get_db
-from mad3.util import key_info
+from mad3.delta import delta, snapshot
+from mad3.diff import content_changed
+from mad3.governor import get_governor
+from mad3.progress import phase
+from mad3.exceptions import M3FileNotFound
+from mad3.keywords import get_schema
 
 lg = logging.getLogger(__name__)
 
@@ -21,32 +27,41 @@ lg = logging.getLogger(__name__)
 def bulk_init(app):
     lg.debug("start bulk mode")
     db = get_db(app)
+    conf = app.conf['bulk']
+    kwargs = dict(max_ops=int(conf['max_ops']),
+                  max_bytes=int(conf['max_bytes']),
+                  interval=float(conf['interval']),
+                  governor=get_governor(app))
     app.bulk_mode = True
-    app.bulk_transient = db.transient.initialize_unordered_bulk_op()
-    app.bulk_core = db.core.initialize_unordered_bulk_op()
+    app.bulk_transient = BulkWriter(app, db.transient, **kwargs)
+    app.bulk_core = BulkWriter(app, db.core, **kwargs)
+    app.bulk_queue = None
+
+
+def bulk_upsert(app, collection, _id, update):
+    """Upsert one record in bulk mode.
+
+    If a bulk writer is running (`app.bulk_queue` is set), the operation
+    is handed to it, otherwise it is added to the bulk op directly.
+    """
+    bulk_queue = getattr(app, 'bulk_queue', None)
+    if bulk_queue is not None:
+        bulk_queue.put((collection, _id, update))
+    else:
+        bulk_append(app, collection, _id, update)
+
+
+def bulk_append(app, collection, _id, update):
+    """Add an upsert to the bulk writer of a collection."""
+    bulk = getattr(app, 'bulk_{}'.format(collection))
+    bulk.upsert(_id, update)
 
 
 def bulk_execute(app):
     lg.debug("Executing bulk operations")
-    try:
-        app.bulk_transient.execute()
-    except pymongo.errors.InvalidOperation as e:
-        if e.args[0] == 'No operations to execute':
-            lg.info("no bulk data to store to transient")
-        else:
-            raise
-    except pymongo.errors.BulkWriteError as e:
-        #from pprint import pprint
-        #pprint(e.details)
-        raise
-
-    try:
-        app.bulk_core.execute()
-    except pymongo.errors.InvalidOperation as e:
-        if e.args[0] == 'No operations to execute':
-            lg.info("no bulk data to store to core")
-        else:
-            raise
+    for bulk in (app.bulk_transient, app.bulk_core):
+        bulk.close()
+        bulk.report()
 
 
 def setone(data, k, v):
@@ -73,21 +88,64 @@ def setset(data, k, v):
         return True, data[k]
 
 
+def transient_id(app, filename):
+    """Return the transient id of a (full path) filename on this host.
+
+    See `MadFile.get_transient_id`.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(app.conf['hostname'].encode('UTF8'))
+    sha256.update(filename.encode('UTF8'))
+    return sha256.hexdigest()
+
+
+def chunked(items, size):
+    """Yield lists of at most `size` items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def without_id(rec):
+    """Return a record without its `_id`."""
+    return {k: v for k, v in rec.items() if k != '_id'}
+
+
+# checksums of a quick (not hashed) record
+QUICK_DIGESTS = {'sha1': '0', 'sha256': '0'}
+
+# marks a record that was not prefetched
+NOT_FETCHED = object()
+
+
 class MadFile:
     """Representing a file + metadata."""
 
-    def __init__(self, app, filename, quick=False):
-        """Prepare the MadFile."""
+    def __init__(self, app, filename, quick=False,
+                 transient_rec=NOT_FETCHED, core_recs=None):
+        """Prepare the MadFile.
+
+        `transient_rec` (None if there is none) and `core_recs` (sha256
+        -> core record, or None) can be passed in if already fetched from
+        the database, see `MadFile.load_many`.
+        """
         self.app = app
         self.quick = quick
         self.dirty = False
+        self.core_dirty = False
+        self._deferred = 0
 
-        self.app.counter['init_madfile'] += 1
+        self.app.counter.incr('init_madfile')
 
         filename = os.path.abspath(os.path.expanduser(filename))
         if not os.path.exists(filename):
             lg.warning("{} does not exist:".format(filename))
-            raise FileNotFound()
+            raise M3FileNotFound(filename)
 
         if not os.access(filename, os.R_OK):
             raise PermissionError("m3 cannot read file {}".format(filename))
@@ -105,76 +163,105 @@ class MadFile:
         self.db = get_db(app)
         lg.debug('check transient rec for {}'.format(self.filename))
 
-        self.transient_rec = self.db.transient.find_one({'_id': self.transient_id})
+        if transient_rec is NOT_FETCHED:
+            self.transient_rec = self.db.transient.find_one(
+                {'_id': self.transient_id})
+        else:
+            self.transient_rec = transient_rec
+
+        # the record as it is in the database, changes are saved as a delta
+        self._saved = snapshot(self.transient_rec)
 
         # if there is no transient rec, calculate core id
 
         if self.transient_rec is None:
-            self.app.counter['-trans'] += 1
+            self.app.counter.incr('-trans')
             lg.debug('transient record does not exist')
             # needs to be saved now
             self.dirty = True
 
             if self.quick:
-                self.app.counter['nochksum'] += 1
-                self.sha1, self.sha256 = '0', '0'
+                self.app.counter.incr('nochksum')
+                digests = QUICK_DIGESTS
             else:  # not quick, calculate all shasums
                 # calculate fresh sha256
-                self.app.counter['chksum'] += 1
-                self.sha1, self.sha256 = self.calculate_checksum()
+                self.app.counter.incr('chksum')
+                digests = self.calculate_checksum()
 
             # create an stub transient rec
             self.transient_rec = {
                 '_id': self.transient_id,
-                'sha256': self.sha256,
-                'sha1': self.sha1,
                 'filename': self.filename,
                 'hostname':  self.app.conf['hostname']}
+            self.set_digests(digests)
 
             # and fill up the transient record see if there are changes
             self.refresh()
+            self.refresh_fingerprint(changed=True)
 
         else:
             lg.debug('transient record found!')
-            self.app.counter['transload'] += 1
+            self.app.counter.incr('transload')
             self.sha256 = self.transient_rec['sha256']
-            self.sha1 = self.transient_rec['sha1']
+            # sha1 might not (yet) be calculated
+            self.sha1 = self.transient_rec.get('sha1')
+
+            # only a changed mtime, size, inode or device means the
+            # content might have changed; ownership or permission changes
+            # are recorded without reading the file
+            changed = content_changed(self.transient_rec, self.filestat)
 
             #check if this was a Q&D record (and this is not a Q&D call)
             if not self.quick and (self.sha256 == '0' or self.sha1 == '0'):
-                self.app.counter['unquicken'] += 1
-                self.sha1, self.sha256 = self.calculate_checksum()
-                self.transient_rec['sha256'] = self.sha256
-                self.transient_rec['sha1'] = self.sha1
+                self.app.counter.incr('unquicken')
+                self.set_digests(self.calculate_checksum())
                 self.dirty = True
+                # freshly calculated
+                changed = False
 
             # refrehs the transient record - see if there are changes
             self.refresh()
 
-            # if something changed - recalc thte sha256
-            if self.dirty:
+            if self.dirty and not changed:
+                self.app.counter.incr('restat')
+
+            # if the content changed - recalc thte sha256
+            if changed:
                 if self.quick:
-                    self.app.counter['~dirty'] += 1
-                    #print('dirty?', self.filename)
+                    self.app.counter.incr('~dirty')
+                    # the checksums are no longer valid, leave them for
+                    # a backfill
+                    self.set_digests(QUICK_DIGESTS)
                 else:
-                    self.app.counter['re-chksum'] += 1
-                    newsha1, newsha256 = self.calculate_checksum()
-                    if newsha256 == self.transient_rec['sha256']:
-                        self.app.counter['sha256_ok'] += 1
+                    self.app.counter.incr('re-chksum')
+                    digests = self.calculate_checksum()
+                    if digests['sha256'] == self.transient_rec['sha256']:
+                        self.app.counter.incr('sha256_ok')
+                        # same content, keep digests not calculated now
+                        self.transient_rec.update(digests)
+                        self.sha1 = self.transient_rec.get('sha1')
                     else:
-                        self.app.counter['sha256_change!'] += 1
-                        self.transient_rec['sha1'] = newsha1
-                        self.transient_rec['sha256'] = newsha256
+                        self.app.counter.incr('sha256_change!')
+                        self.set_digests(digests)
                         # TODO: Create a transaction!!!
                         # TODO: copy core record data??
 
+            self.refresh_fingerprint(changed=changed)
+
         if not self.quick:
             assert self.sha256 != "0"
-            self.core_rec = self.db.core.find_one({'_id': self.sha256})
+            if core_recs is not None and self.sha256 in core_recs:
+                self.core_rec = core_recs[self.sha256]
+            else:
+                self.core_rec = self.db.core.find_one({'_id': self.sha256})
 
+            self._core_saved = snapshot(self.core_rec)
             if self.core_rec is None:
                 lg.debug('Core rec not found')
-                self.core_rec = {'_id': self.sha256, 'sha1': self.sha1}
+                self.core_rec = {'_id': self.sha256}
+                self.core_rec.update(
+                    (k, v) for k, v in self.transient_rec.items()
+                    if k in DIGESTS and k != 'sha256')
             else:
                 for k, v in self.core_rec.items():
                     if k == '_id': continue
@@ -183,21 +270,68 @@ class MadFile:
                         self.transient_rec[k] = v
                         self.dirty = True
 
-        if self.dirty:
-            lg.debug('dirty transient rec, saving')
-            if getattr(self.app, 'bulk_mode', False):
-                lg.debug('pepare bulk insert for {}'.format(self.filename))
-                self.app.bulk_transient\
-                    .find({'_id': self.transient_id})\
-                    .upsert()\
-                    .update({"$set": self.transient_rec})
-            else:
-                self.db.transient.update({'_id': self.transient_id},
-                                         self.transient_rec, upsert=True)
-            self.dirty=False
+        # the stat refresh and the changes made by the onload hooks
+        # (e.g. mad.config data) are written at once
+        with self.defer_save():
+            self.app.run_hook('onload', self)
 
-        self.app.run_hook('onload', self)
+    @staticmethod
+    def prefetch(app, filenames, quick=False):
+        """Fetch the db records for a list of (full path) filenames.
 
+        Uses one `$in` query on transient, and one on core for the
+        sha256 sums found. Returns a dictionary filename -> transient
+        record (None if not in the db), and a dictionary sha256 -> core
+        record (None if not in the db).
+        """
+        db = get_db(app)
+        ids = {transient_id(app, fn): fn for fn in filenames}
+        transient_recs = dict.fromkeys(filenames)
+        core_recs = {}
+        with phase(app, 'lookup'):
+            for rec in db.transient.find({'_id': {'$in': list(ids)}}):
+                transient_recs[ids[rec['_id']]] = rec
+
+            if not quick:
+                shas = set(rec.get('sha256')
+                           for rec in transient_recs.values()
+                           if rec is not None) - {None, '0'}
+                core_recs = dict.fromkeys(shas)
+                for rec in db.core.find({'_id': {'$in': list(shas)}}):
+                    core_recs[rec['_id']] = rec
+
+        app.counter.incr('prefetch')
+        return transient_recs, core_recs
+
+    @classmethod
+    def load_many(cls, app, filenames, quick=False, parallel=False):
+        """Load many files, with prefetched db records.
+
+        Records are fetched per chunk of `madfile.prefetch_size` files.
+        Yields (filename, MadFile) tuples; the MadFile is None if the
+        file does not exist or cannot be read. With `parallel`, the
+        files of a chunk are loaded (and hashed) by the checksum engine.
+        """
+        size = int(app.conf['madfile']['prefetch_size'])
+        for chunk in chunked(filenames, size):
+            chunk = [os.path.abspath(os.path.expanduser(fn))
+                     for fn in chunk]
+            transient_recs, core_recs = cls.prefetch(app, chunk, quick)
+
+            def load(filename):
+                try:
+                    return filename, cls(
+                        app, filename, quick=quick,
+                        transient_rec=transient_recs[filename],
+                        core_recs=core_recs)
+                except (M3FileNotFound, PermissionError) as e:
+                    lg.debug("cannot load %s: %s", filename, e)
+                    return filename, None
+
+            if parallel:
+                yield from get_engine(app).map(load, chunk)
+            else:
+                yield from map(load, chunk)
 
     def keys(self):
         """Return keys - madfile as a dictionary."""
@@ -208,10 +342,10 @@ class MadFile:
     def __setitem__(self, rawkey, val):
         """Set value for this MF."""
 
-        key, kinfo = key_info(self.app.conf, rawkey)
-        val = kinfo['transformer'](val)
-        setter = kinfo['setter']
-        keycat = kinfo['cat']
+        key, kinfo = get_schema(self.app).resolve(rawkey)
+        val = kinfo.transformer(val)
+        setter = kinfo.setter
+        keycat = kinfo.cat
 
         if not 'transient' in keycat:
             return
@@ -227,6 +361,7 @@ class MadFile:
                 pass
             else:
                 self.core_rec[key] = setvalue
+                self.core_dirty = True
                 changed = True
 
         # store in transient db
@@ -238,44 +373,113 @@ class MadFile:
             changed = True
 
         if changed:
-            self.dirty=True
+            self.modified()
+
+    def __delitem__(self, rawkey):
+        """Remove a key from this MF."""
+        key, kinfo = get_schema(self.app).resolve(rawkey)
+        if not 'transient' in kinfo.cat or key not in self.transient_rec:
+            return
+        del self.transient_rec[key]
+        if not self.quick and 'core' in kinfo.cat \
+                and key in self.core_rec:
+            del self.core_rec[key]
+            self.core_dirty = True
+        self.modified()
+
+    def discard(self, rawkey, val):
+        """Remove a value from a set-shaped key."""
+        key, kinfo = get_schema(self.app).resolve(rawkey)
+        val = kinfo.transformer(val)
+        if not 'transient' in kinfo.cat \
+                or val not in self.transient_rec.get(key, []):
+            return
+        self.transient_rec[key] = [
+            v for v in self.transient_rec[key] if v != val]
+        if not self.quick and 'core' in kinfo.cat \
+                and val in self.core_rec.get(key, []):
+            self.core_rec[key] = [v for v in self.core_rec[key] if v != val]
+            self.core_dirty = True
+        self.modified()
+
+    def modified(self):
+        """Mark the record as changed; save it unless saving is deferred."""
+        self.dirty = True
+        if not self._deferred:
             lg.debug('saving transient+rec for {}'.format(self.filename))
             self.save()
 
+    @contextmanager
+    def defer_save(self):
+        """Collect all changes made in the block, and save them once.
+
+        Blocks can be nested; the record is saved when leaving the
+        outermost block, if anything changed.
+        """
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+        if not self._deferred and self.dirty:
+            self.save()
 
     def update(self, other):
         """Conform dict."""
-        for k, v in other.items():
-            if isinstance(v, list):
-                for vv in v:
-                    self[k] = vv
-            else:
-                self[k] = v
+        with self.defer_save():
+            for k, v in other.items():
+                if isinstance(v, list):
+                    for vv in v:
+                        self[k] = vv
+                else:
+                    self[k] = v
 
-    def save(self):
-        """Save record to mongodb."""
+    def save(self, full: bool=False):
+        """Save record to mongodb.
+
+        Only the fields changed since the record was loaded (or last
+        saved) are written, see `mad3.delta`. The core record is only
+        written if it changed. With `full`, both records are written
+        completely.
+        """
+        if full:
+            trans_update = {'$set': without_id(self.transient_rec)}
+        else:
+            trans_update = delta(self._saved, self.transient_rec)
+
+        core_update = {}    # type: dict
+        if (full or self.core_dirty) and not self.quick \
+                and len(self.core_rec) > 1:
+            if full:
+                core_update = {'$set': without_id(self.core_rec)}
+            else:
+                core_update = delta(self._core_saved, self.core_rec)
 
         lg.debug("Saving {} (bulk:{})".format(
             self.filename, getattr(self.app, 'bulk_mode', 'cantfind')))
 
         if getattr(self.app, 'bulk_mode', False):
             lg.debug('pepare bulk update/save for {}'.format(self.filename))
-            self.app.bulk_transient\
-                .find({'_id': self.transient_id})\
-                .upsert().update({'$set': self.transient_rec})
-            if not self.quick and len(self.core_rec) > 1:
+            if trans_update:
+                self.app.bulk_upsert('transient', self.transient_id,
+                                     trans_update)
+            if core_update:
                 lg.debug('also bulk storing core {}'.format(self.filename))
-                self.app.bulk_core\
-                    .find({'_id': self.sha256})\
-                    .upsert().update({'$set': self.core_rec})
+                self.app.bulk_upsert('core', self.sha256, core_update)
         else:
             lg.debug('pepare normal update/save for {}'.format(self.filename))
-            self.db.transient.update_one({'_id': self.transient_id},
-                                         {'$set': self.transient_rec})
-            if not self.quick and len(self.core_rec) > 1:
+            if trans_update:
+                self.db.transient.update_one({'_id': self.transient_id},
+                                             trans_update, upsert=True)
+            if core_update:
                 self.db.core.update_one({'_id': self.sha256},
-                                        {'$set': self.core_rec})
+                                        core_update, upsert=True)
+
+        self._saved = snapshot(self.transient_rec)
+        if core_update:
+            self._core_saved = snapshot(self.core_rec)
         self.dirty = False
+        self.core_dirty = False
 
 
     def __getitem__(self, key):
@@ -304,6 +508,10 @@ class MadFile:
 
         statmap = dict(
             size=self.filestat[stat.ST_SIZE],
+            mtime_ns=self.filestat.st_mtime_ns,
+            ctime_ns=self.filestat.st_ctime_ns,
+            ino=self.filestat.st_ino,
+            dev=self.filestat.st_dev,
             nlink=self.filestat[stat.ST_NLINK],
             mtime=datetime.fromtimestamp(self.filestat[stat.ST_MTIME]),
             gid=self.filestat[stat.ST_GID],
@@ -326,6 +534,27 @@ class MadFile:
                 self.transient_rec[k] = v
                 self.dirty = True
 
+    def refresh_fingerprint(self, changed: bool=False):
+        """Store a partial content fingerprint, if configured.
+
+        Only (re)calculated if missing, or if the content `changed`.
+        """
+        conf = self.app.conf['madfile']
+        if not conf['fingerprint']:
+            return
+        if not changed and 'fingerprint' in self.transient_rec:
+            return
+        try:
+            fp = fingerprint(self.filename, self.filestat.st_size,
+                             blocksize=int(conf['fingerprint_block']),
+                             samples=int(conf['fingerprint_samples']))
+        except IOError:
+            lg.warning("Cannot fingerprint %s", self.filename)
+            return
+        self.app.counter.incr('fingerprint')
+        changed, _ = setone(self.transient_rec, 'fingerprint', fp)
+        self.dirty = self.dirty or changed
+
     def get_transient_id(self):
         """Transient id is a unqiue id for a file on a certain host. It is
         quick to calculate, but might change (without the underlying
@@ -344,26 +573,31 @@ class MadFile:
 
         if the transient id changes, the core id needs to be recalculated
         """
-        sha256 = hashlib.sha256()
-        sha256.update(self.app.conf['hostname'].encode('UTF8'))
-        sha256.update(self.filename.encode('UTF8'))
-        return sha256.hexdigest()
+        return transient_id(self.app, self.filename)
 
 
-    def calculate_checksum(self):
-        "Return the sha1sum for a certain filename - expected is a full path"
-        h2 = hashlib.sha256()
-        h1 = hashlib.sha1()
-        blocksize = 2 ** 20
+    def set_digests(self, digests: dict):
+        """Store freshly calculated digests of the file.
 
-        try:
-            with open(self.filename, 'rb') as F:
-                for chunk in iter(lambda: F.read(blocksize), b''):
-                    h1.update(chunk)
-                    h2.update(chunk)
-                    self.app.counter['chksum_sz'] += len(chunk)
+        Digests not in `digests` are removed; they belong to the old
+        content, and can be filled in later (`m3 digest`).
+        """
+        for name in DIGESTS:
+            if name in digests:
+                self.transient_rec[name] = digests[name]
+            else:
+                self.transient_rec.pop(name, None)
+        self.sha256 = digests['sha256']
+        self.sha1 = digests.get('sha1')
 
-            return h1.hexdigest(), h2.hexdigest()
+    def calculate_checksum(self):
+        "Return the digests of the file, as configured in `scan.digests`"
+        try:
+            with phase(self.app, 'hash'):
+                digests, size = get_engine(self.app).digest(
+                    self.filename, self.filestat)
+            self.app.counter.incr('chksum_sz', size)
+            return digests
 
         except IOError:
             # something went wrong reading the file (no permissions??
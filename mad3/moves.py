@@ -0,0 +1,79 @@
+"""
+Rename and move detection.
+
+A new file (no transient record) whose (device, inode, size, mtime)
+equals that of a record of a file that no longer exists was moved or
+renamed. Its record is carried over to the new filename, checksums and
+user metadata included, without reading the file.
+"""
+
+import logging
+import os
+
+from mad3.db import get_db
+from mad3.diff import SIGNATURE
+from mad3.madfile import transient_id
+
+lg = logging.getLogger(__name__)
+
+
+def move_key(sig) -> tuple:
+    """Return the (device, inode, size, mtime) key of a signature."""
+    mtime_ns, size, ctime_ns, ino, dev = sig
+    return (dev, ino, size, mtime_ns)
+
+
+def find_moves(app, fsrecs) -> dict:
+    """Return new path -> old transient record, for moved files.
+
+    `fsrecs` are (path, *signature) tuples of files without a transient
+    record. One query per call, so pass them in chunks.
+    """
+    if not fsrecs:
+        return {}
+    db = get_db(app)
+    wanted = {}
+    for fsrec in fsrecs:
+        wanted.setdefault(move_key(fsrec[1:]), []).append(fsrec[0])
+
+    query = {'hostname': app.conf['hostname'],
+             'ino': {'$in': list(set(k[1] for k in wanted))}}
+    rv = {}
+    for rec in db.transient.find(query):
+        key = (rec.get('dev'), rec['ino'], rec.get('size'),
+               rec.get('mtime_ns'))
+        paths = wanted.get(key)
+        if not paths or os.path.lexists(rec['filename']):
+            # no match, or a hardlink that still exists
+            continue
+        rv[paths.pop()] = rec
+    return rv
+
+
+def detect_moves(app, fsrecs, deleter=None) -> dict:
+    """Carry over the records of moved files.
+
+    Returns new path -> old transient id for the moved files in
+    `fsrecs`. The record of a moved file is stored under its new
+    filename, with the new signature, and the old record is removed by
+    `deleter`. The records are left alone if there is no deleter (e.g.
+    when only planning a scan).
+    """
+    moves = find_moves(app, fsrecs)
+    rv = {}
+    for fsrec in fsrecs:
+        rec = moves.get(fsrec[0])
+        if rec is None:
+            continue
+        app.counter['moved'] += 1
+        rv[fsrec[0]] = rec['_id']
+        if deleter is None:
+            continue
+        lg.debug("moved %s -> %s", rec['filename'], fsrec[0])
+        old_id = rec.pop('_id')
+        rec['filename'] = fsrec[0]
+        rec.update(zip(SIGNATURE, fsrec[1:]))
+        app.bulk_upsert('transient', transient_id(app, fsrec[0]),
+                        {'$set': rec})
+        deleter.add(old_id, moved_to=fsrec[0])
+    return rv
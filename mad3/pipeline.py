@@ -0,0 +1,185 @@
+"""
+Staged processing pipeline.
+
+Stages are groups of worker threads connected by bounded queues, so a
+slow stage blocks the ones feeding it (backpressure) and memory use is
+capped by the queue sizes, not by the amount of work.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+lg = logging.getLogger(__name__)
+
+# passed down the queues to signal the end of the stream
+END = object()
+
+
+def batches(inq, size: int, timeout: float=0.5):
+    """Read items from a queue up to END, and yield them in lists.
+
+    Lists hold at most `size` items; a shorter list is yielded when no
+    new item arrives within `timeout` seconds.
+    """
+    batch = []
+    while True:
+        try:
+            item = inq.get(timeout=timeout if batch else None)
+        except queue.Empty:
+            yield batch
+            batch = []
+            continue
+        if item is END:
+            break
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Stage:
+    """A named group of worker threads applying `func` to a queue.
+
+    `func` returns the item to pass downstream, or None to drop it. A
+    stage without an input queue is a source, and iterates over
+    `source` instead.
+    """
+
+    def __init__(self, name: str, func=None, inq=None, outq=None,
+                 workers: int=1, source=None) -> None:
+        """Prepare the stage (threads start with `start`)."""
+        self.name = name
+        self.func = func
+        self.inq = inq
+        self.outq = outq
+        self.workers = max(1, workers) if source is None else 1
+        self.source = source
+
+        self.count = 0
+        self.busy = 0.0
+        self.starttime = None     # type: float
+        self.endtime = None       # type: float
+        self.error = None         # type: Exception
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self._threads = []        # type: list
+
+    def start(self):
+        """Start the worker threads."""
+        self.starttime = time.time()
+        self._running = self.workers
+        target = self._run_source if self.source is not None else self._run
+        for i in range(self.workers):
+            t = threading.Thread(target=target, daemon=True,
+                                 name='{}-{}'.format(self.name, i))
+            self._threads.append(t)
+            t.start()
+
+    def join(self):
+        """Wait for all worker threads to finish."""
+        for t in self._threads:
+            t.join()
+
+    def _emit(self, item):
+        if item is not None and self.outq is not None:
+            self.outq.put(item)
+
+    def _apply(self, item):
+        t0 = time.time()
+        try:
+            rv = self.func(item)
+        except Exception as e:
+            lg.exception("error in stage %s", self.name)
+            if self.error is None:
+                self.error = e
+            rv = None
+        with self._lock:
+            self.count += 1
+            self.busy += time.time() - t0
+        return rv
+
+    def _finish(self):
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            self.endtime = time.time()
+            if self.outq is not None:
+                self.outq.put(END)
+
+    def _run_source(self):
+        try:
+            for item in self.source:
+                if self.func is not None:
+                    item = self._apply(item)
+                else:
+                    self.count += 1
+                self._emit(item)
+        except Exception as e:
+            lg.exception("error in stage %s", self.name)
+            self.error = e
+        finally:
+            self._finish()
+
+    def _run(self):
+        while True:
+            item = self.inq.get()
+            if item is END:
+                # let sibling workers see the end as well
+                self.inq.put(END)
+                break
+            self._emit(self._apply(item))
+        self._finish()
+
+    @property
+    def rate(self) -> float:
+        """Items processed per second (wallclock, over the stage life)."""
+        end = self.endtime or time.time()
+        if self.starttime is None or end <= self.starttime:
+            return 0.0
+        return self.count / (end - self.starttime)
+
+
+class Pipeline:
+    """A chain of stages, connected by bounded queues."""
+
+    def __init__(self, maxsize: int=1000) -> None:
+        """Create an empty pipeline."""
+        self.maxsize = maxsize
+        self.stages = []          # type: list
+
+    def queue(self):
+        """Return a new bounded queue."""
+        return queue.Queue(maxsize=self.maxsize)
+
+    def add(self, stage: Stage) -> Stage:
+        """Add a stage."""
+        self.stages.append(stage)
+        return stage
+
+    def run(self, monitor=None, interval: float=2):
+        """Run all stages to completion.
+
+        `monitor` is called every `interval` seconds while waiting. The
+        first error raised inside a stage is re-raised here.
+        """
+        for stage in self.stages:
+            stage.start()
+        for stage in self.stages:
+            for t in stage._threads:
+                while t.is_alive():
+                    t.join(timeout=interval)
+                    if monitor is not None:
+                        monitor()
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+
+    def rates(self) -> dict:
+        """Return throughput (items/s) per stage."""
+        return {s.name: s.rate for s in self.stages}
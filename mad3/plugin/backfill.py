@@ -0,0 +1,269 @@
+"""
+Upgrade quick (`scan -q`) records to full checksums, and fill in
+digests that were not calculated during a scan.
+"""
+
+import logging
+import os
+import re
+import time
+
+import leip
+import pymongo
+
+from mad3.checksum import DIGESTS, get_engine
+from mad3.db import get_db
+from mad3.diff import content_changed
+from mad3.keywords import get_schema
+from mad3.madfile import chunked
+from mad3.plugin.scan import print_counter
+from mad3.util import nicesize, parse_duration, parse_size
+
+lg = logging.getLogger(__name__)
+
+# order policy -> mongo sort
+ORDER = {
+    'small': [('size', pymongo.ASCENDING)],
+    'large': [('size', pymongo.DESCENDING)],
+    'oldest': [('mtime', pymongo.ASCENDING)],
+    'newest': [('mtime', pymongo.DESCENDING)],
+    'path': [('filename', pymongo.ASCENDING)]}
+
+
+def core_fields(app, rec: dict) -> dict:
+    """Return the fields of a transient record that belong in core."""
+    schema = get_schema(app)
+    rv = {}
+    for k, v in rec.items():
+        info = schema.get(k)
+        if info is None or info.name != k or k in DIGESTS:
+            continue
+        if 'core' in info.cat:
+            rv[k] = v
+    return rv
+
+
+def quick_records(app, basedir: str, order: str='small',
+                  max_time: float=None, max_bytes: int=None):
+    """Yield the quick records below basedir, within a time/byte budget.
+
+    Records are yielded in the order of the `order` policy, until
+    `max_time` seconds have passed or `max_bytes` would be exceeded.
+    """
+    return budget_records(app, basedir, {'sha256': '0'}, order=order,
+                          max_time=max_time, max_bytes=max_bytes)
+
+
+def budget_records(app, basedir: str, query: dict, order: str='small',
+                   max_time: float=None, max_bytes: int=None):
+    """Yield the records below basedir matching query, within a budget.
+
+    See `quick_records`.
+    """
+    db = get_db(app)
+    query = dict(query, hostname=app.conf['hostname'],
+                 filename={'$regex': '^{}/'.format(re.escape(basedir))})
+    cursor = db.transient.find(query, no_cursor_timeout=True)\
+        .sort(ORDER[order])
+    starttime = time.time()
+    nbytes = 0
+    try:
+        for rec in cursor:
+            if max_time is not None and time.time() - starttime > max_time:
+                app.counter['budget_time'] += 1
+                return
+            if max_bytes is not None and nbytes + rec['size'] > max_bytes:
+                app.counter['budget_sz'] += 1
+                return
+            nbytes += rec['size']
+            yield rec
+    finally:
+        cursor.close()
+
+
+def backfill_one(app, rec: dict, digests=None):
+    """Hash the file of a record.
+
+    Calculates the configured digests, or only `digests`. Returns (rec,
+    {name: hexdigest}), or None if the file is gone or changed since the
+    record was made (left for the next scan).
+    """
+    filename = rec['filename']
+    try:
+        st = os.stat(filename)
+        if content_changed(rec, st):
+            app.counter.incr('changed')
+            return None
+        rv, size = get_engine(app).digest(filename, st, digests=digests)
+        if os.stat(filename).st_mtime_ns != st.st_mtime_ns:
+            app.counter.incr('changed')
+            return None
+    except OSError as e:
+        lg.debug("cannot hash %s: %s", filename, e)
+        app.counter.incr('noaccess')
+        return None
+
+    app.counter.incr('backfill')
+    app.counter.incr('backfill_sz', size)
+    return rec, rv
+
+
+def run_backfill(app, basedir: str, order: str='small',
+                 max_time: float=None, max_bytes: int=None, monitor=None):
+    """Fill in the checksums of all quick records below basedir.
+
+    Transient records get their digests, plus whatever the (possibly
+    existing) core record holds; core records get the core fields of
+    the transient record.
+    """
+    db = get_db(app)
+    app.bulk_init()
+    records = quick_records(app, basedir, order=order,
+                            max_time=max_time, max_bytes=max_bytes)
+    results = get_engine(app).map(lambda rec: backfill_one(app, rec),
+                                  records)
+    size = int(app.conf['madfile']['prefetch_size'])
+    for chunk in chunked(results, size):
+        chunk = [x for x in chunk if x is not None]
+        shas = list(set(x[1]['sha256'] for x in chunk))
+        core_recs = {rec['_id']: rec
+                     for rec in db.core.find({'_id': {'$in': shas}})}
+
+        for rec, digests in chunk:
+            sha256 = digests['sha256']
+            transient = dict(digests)
+            for k, v in core_recs.get(sha256, {}).items():
+                if k != '_id':
+                    transient[k] = v
+            update = {'$set': transient}
+            # the quick placeholder sha1 is not valid
+            if 'sha1' not in transient:
+                update['$unset'] = {'sha1': ''}
+            app.bulk_upsert('transient', rec['_id'], update)
+
+            core = core_fields(app, rec)
+            core.update((k, v) for k, v in digests.items() if k != 'sha256')
+            if core:
+                app.bulk_upsert('core', sha256, {'$set': core})
+
+        if monitor is not None:
+            monitor()
+    app.bulk_execute()
+
+
+def digest_one(app, rec: dict, names):
+    """Calculate the digests in `names` a record does not have yet.
+
+    Returns (rec, {name: hexdigest}), or None if the file is gone or its
+    content changed since the record was made.
+    """
+    filename = rec['filename']
+    missing = [n for n in names if n not in rec]
+    try:
+        st = os.stat(filename)
+        if content_changed(rec, st):
+            app.counter.incr('changed')
+            return None
+        rv, size = get_engine(app).digest(filename, st, digests=missing)
+        if os.stat(filename).st_mtime_ns != st.st_mtime_ns:
+            app.counter.incr('changed')
+            return None
+    except OSError as e:
+        lg.debug("cannot hash %s: %s", filename, e)
+        app.counter.incr('noaccess')
+        return None
+
+    app.counter.incr('digest')
+    app.counter.incr('digest_sz', size)
+    return rec, rv
+
+
+def run_digests(app, basedir: str, names, order: str='small',
+                max_time: float=None, max_bytes: int=None, monitor=None):
+    """Fill in the digests `names` of all hashed records below basedir.
+
+    Only records missing one of the digests are read, once, for all
+    their missing digests. Digests are stored in the transient and core
+    records.
+    """
+    app.bulk_init()
+    query = {'sha256': {'$ne': '0'},
+             '$or': [{name: {'$exists': False}} for name in names]}
+    records = budget_records(app, basedir, query, order=order,
+                             max_time=max_time, max_bytes=max_bytes)
+    results = get_engine(app).map(lambda rec: digest_one(app, rec, names),
+                                  records)
+    size = int(app.conf['madfile']['prefetch_size'])
+    for chunk in chunked(results, size):
+        for rec, digests in filter(None, chunk):
+            app.bulk_upsert('transient', rec['_id'], {'$set': digests})
+            app.bulk_upsert('core', rec['sha256'], {'$set': digests})
+        if monitor is not None:
+            monitor()
+    app.bulk_execute()
+
+
+@leip.arg('--order', choices=sorted(ORDER), help='which files first '
+          '(default: backfill.order)')
+@leip.arg('--max-time', help='stop after this time (e.g. 8h, 30m)')
+@leip.arg('--max-bytes', help='stop after hashing this much (e.g. 500G)')
+@leip.arg('--host', help='backfill the records of another host, with the '
+          'same files mounted at the same paths')
+@leip.arg('-j', '--threads', type=int, help='no of hashing threads')
+@leip.arg('dir', nargs='?', default='.', help='directory to backfill')
+@leip.command
+def backfill(app, args):
+    """Calculate the checksums of files scanned in quick mode."""
+    starttime = time.time()
+    basedir = os.path.abspath(os.path.normpath(args.dir))
+    conf = app.conf['backfill']
+
+    if args.host:
+        app.conf['hostname'] = args.host
+    if args.threads:
+        app.conf['scan']['hash_workers'] = args.threads
+
+    max_time = args.max_time or conf['max_time']
+    max_bytes = args.max_bytes or conf['max_bytes']
+
+    run_backfill(app, basedir, order=args.order or conf['order'],
+                 max_time=parse_duration(max_time) if max_time else None,
+                 max_bytes=parse_size(max_bytes) if max_bytes else None,
+                 monitor=lambda: print_counter(app.counter))
+
+    print_counter(app.counter)
+    print("\nruntime: {:.4f}".format(time.time() - starttime))
+    lg.info("backfilled %d files, %s",
+            app.counter['backfill'], nicesize(app.counter['backfill_sz']))
+
+
+@leip.arg('-d', '--digest', action='append', choices=sorted(DIGESTS),
+          help='digest to fill in (default: sha1), can be repeated')
+@leip.arg('--order', choices=sorted(ORDER), help='which files first '
+          '(default: backfill.order)')
+@leip.arg('--max-time', help='stop after this time (e.g. 8h, 30m)')
+@leip.arg('--max-bytes', help='stop after hashing this much (e.g. 500G)')
+@leip.arg('-j', '--threads', type=int, help='no of hashing threads')
+@leip.arg('dir', nargs='?', default='.', help='directory to process')
+@leip.command
+def digest(app, args):
+    """Calculate digests that were not calculated during a scan."""
+    starttime = time.time()
+    basedir = os.path.abspath(os.path.normpath(args.dir))
+    conf = app.conf['backfill']
+    if args.threads:
+        app.conf['scan']['hash_workers'] = args.threads
+
+    max_time = args.max_time or conf['max_time']
+    max_bytes = args.max_bytes or conf['max_bytes']
+
+    run_digests(app, basedir, args.digest or ['sha1'],
+                order=args.order or conf['order'],
+                max_time=parse_duration(max_time) if max_time else None,
+                max_bytes=parse_size(max_bytes) if max_bytes else None,
+                monitor=lambda: print_counter(app.counter))
+
+    print_counter(app.counter)
+    print("\nruntime: {:.4f}".format(time.time() - starttime))
+    lg.info("calculated digests of %d files, %s",
+            app.counter['digest'], nicesize(app.counter['digest_sz']))
@@ -2,7 +2,11 @@
 Core functions for Mad3
 """
 
+from datetime import datetime, timedelta
 import logging
+import os
+import re
+
 import colors
 
 import leip
@@ -10,7 +14,8 @@ import pymongo
 
 from mad3.db import get_db
 from mad3.madfile import MadFile
-from mad3.util import key_info
+from mad3.keywords import get_schema
+from mad3.util import parse_duration
 
 lg = logging.getLogger(__name__)
 
@@ -42,6 +47,22 @@ def create_index(app, args):
         db.transient.create_index([(idx, pymongo.ASCENDING)])
     for idx in app.conf['index']['transaction']:
         db.transaction.create_index([(idx, pymongo.ASCENDING)])
+    for idx in app.conf['index']['dirstate']:
+        db.dirstate.create_index([(idx, pymongo.ASCENDING)])
+    for idx in app.conf['index']['scanunit']:
+        db.scanunit.create_index([(idx, pymongo.ASCENDING)])
+    ttl = app.conf['tombstone']['ttl']
+    for idx in app.conf['index']['tombstone']:
+        if idx == 'deleted' and ttl:
+            # expire old tombstones
+            db.tombstone.create_index(
+                [(idx, pymongo.ASCENDING)],
+                expireAfterSeconds=int(parse_duration(ttl)))
+        else:
+            db.tombstone.create_index([(idx, pymongo.ASCENDING)])
+    # tombstones are upserted on these
+    db.tombstone.create_index([('transient_id', pymongo.ASCENDING),
+                               ('deleted', pymongo.ASCENDING)])
 
 
 @leip.arg('term', nargs='*')
@@ -54,15 +75,15 @@ def find(app, args):
 
     for term in args.term:
         rawkey, rawval = term.split('=', 1)
-        keyname, keyinfo = key_info(app, rawkey)
-        val = keyinfo['transformer'](rawval)
+        keyname, keyinfo = get_schema(app).resolve(rawkey)
+        val = keyinfo.transformer(rawval)
         lg.info('search: {} {}'.format(keyname, val))
-        if keyinfo['shape'] == 'one':
+        if keyinfo.shape == 'one':
             if keyname not in query:
                 query[keyname] = {"$in": [val]}
             else:
                 raise NotImplemented()
-        elif keyinfo['shape'] == 'set':
+        elif keyinfo.shape == 'set':
             if keyname not in query:
                 query[keyname] = {'$all': [val]}
 
@@ -70,30 +91,75 @@ def find(app, args):
         print(rec['filename'])
 
 
+@leip.arg('--since', help='only deletions after this time (UTC, ISO format)')
+@leip.arg('dir', nargs='?', default='.', help='directory')
+@leip.command
+def deleted(app, args):
+    """List files removed from the database by scans, oldest first."""
+    db = get_db(app)
+    basedir = os.path.abspath(os.path.normpath(args.dir))
+    query = {'hostname': app.conf['hostname'],
+             'filename': {'$regex': '^{}/'.format(re.escape(basedir))}}
+    if args.since:
+        query['deleted'] = {'$gt': datetime.strptime(
+            args.since[:19], '%Y-%m-%dT%H:%M:%S'
+            if 'T' in args.since else '%Y-%m-%d')}
+    for rec in db.tombstone.find(query).sort('deleted', pymongo.ASCENDING):
+        print(rec['deleted'].isoformat(), rec['sha256'], rec['size'],
+              rec['filename'], sep='\t')
+
+
+@leip.arg('age', nargs='?', help='remove tombstones older than this '
+          '(e.g. 30d), defaults to tombstone.ttl')
+@leip.command
+def prune(app, args):
+    """Remove old tombstones of deleted files."""
+    age = args.age or app.conf['tombstone']['ttl']
+    if not age:
+        app.warning("No age given, and no tombstone.ttl configured")
+        return
+    db = get_db(app)
+    before = datetime.utcnow() - timedelta(seconds=parse_duration(age))
+    rv = db.tombstone.delete_many({'deleted': {'$lt': before}})
+    lg.info("removed %d tombstones", rv.deleted_count)
+
+
 @leip.flag('-H', '--human', help='human readable')
-@leip.arg('file')
+@leip.arg('file', nargs='+')
 @leip.command
 def show(app, args):
     """Show file metadata."""
-    mf = MadFile(app, args.file)
-    if not args.human:
+    for i, (filename, mf) in enumerate(MadFile.load_many(app, args.file)):
+        if len(args.file) > 1:
+            print('{}==> {} <=='.format('\n' if i else '', filename))
+        if mf is None:
+            app.warning("Cannot read {}".format(filename))
+            continue
+        _show_madfile(app, mf, args.human)
+
+
+def _show_madfile(app, mf, human=False):
+    """Print the metadata of one MadFile."""
+    if not human:
         for k in mf.keys():
             print('{}\t{}'.format(k, mf[k]))
     else:
         keylen = max([len(k) for k in mf.keys()])
         mfs = '{:' + str(keylen) + '}'
+        schema = get_schema(app)
         for k in sorted(mf.keys()):
             if k != '_id':
-                kname, kinfo = key_info(app.conf, k)
+                kinfo = schema.get(k)
                 tag = ''
                 for cc in 'transient core'.split():
-                    if cc in kinfo['cat']:
+                    if kinfo is not None and cc in kinfo.cat:
                         tag += colors.color(cc[0],
                                             fg=app.conf['color'][cc]['fg'],
                                             bg=app.conf['color'][cc]['bg'])
                     else:
                         tag += ' '
-                val = mf[k] if kinfo['shape'] == 'one' else '|'.join(mf[k])
+                val = mf[k] if not isinstance(mf[k], list) \
+                    else '|'.join(map(str, mf[k]))
                 print(tag,
                       colors.color(mfs.format(k)),
                       colors.color(': {}'.format(val)), sep=' ')
@@ -104,7 +170,7 @@ def show(app, args):
 def save(app, args):
     """Ensure all metadata is saved."""
     mf = MadFile(app, args.file)
-    mf.save()
+    mf.save(full=True)
 
 
 @leip.arg('file')
@@ -122,12 +188,12 @@ def set(app, args):
 @leip.command
 def forget(app, args):
     """Forget a key, or key value combination."""
-    key, kinfo = key_info(app.conf, args.key)
+    key, kinfo = get_schema(app).resolve(args.key)
 
     db = get_db(app)
     if args.value:
         lg.warning("forget key=value {}={}".format(key, args.value))
-        if kinfo.get('shape', 'one') == 'set':
+        if kinfo.shape == 'set':
             db.transient.update({}, {"$pull": {key: args.value}},
                                 upsert=False, multi=True)
             db.core.update({}, {"$pull": {key: args.value}},
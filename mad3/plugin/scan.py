@@ -2,16 +2,30 @@
 
 import logging
 import os
-import math
+import random
 from datetime import datetime
+import re
 import time
-import subprocess as sp
 import sys
 import leip
+import pymongo
 
+from mad3 import checksum, madfile
 from mad3.madfile import MadFile
 from mad3.db import get_db
-from mad3.util import nicesize
+from mad3.diff import (SIGNATURE, db_signature, merge_join, signature,
+                       unchanged)
+from mad3.dirstate import load_dirstate, save_dirstate
+from mad3.checkpoint import Checkpointer, clear_checkpoint, load_checkpoint
+from mad3.coordinator import Worker, create_units, job_status
+from mad3.exceptions import M3FileNotFound
+from mad3.governor import get_governor
+from mad3.moves import detect_moves
+from mad3.pipeline import Pipeline, Stage, batches
+from mad3.progress import Progress, fmt_eta, timed
+from mad3.tombstone import get_deleter
+from mad3.util import nicesize, parse_duration, parse_size
+from mad3.walk import Walker, load_ignore
 
 lg = logging.getLogger(__name__)
 
@@ -32,223 +46,625 @@ def print_counter(c):
     sys.stdout.flush()
 
 
-@leip.flag('-q', '--quick', help='do not calculate shasums, do not store data '
-           'in the core database')
-@leip.flag('-r', '--refresh', help='refresh all files')
-@leip.command
-def scan(app, args):
+def fsrecord(path, st):
+    """Convert a walker entry to a (path, *signature) tuple.
 
-    basedir = os.getcwd().rstrip('/') + '/'
-    db = get_db(app)
-    starttime = time.time()
+    See `mad3.diff.signature`; the mtime (ns) and size are the second
+    and third element.
+    """
+    return (path,) + signature(st)
 
-    app.bulk_init()
 
-    ff_regex = "^{}".format(basedir)
+def get_walker(app, basedir, args, recursive=True):
+    """Prepare a filesystem walker for a scan.
 
-    lg.info("Query database for files below\n    {}".format(basedir))
-    allfilesdb = db.transient.find({'filename': {"$regex": ff_regex}},
-                                 projection=['filename', 'mtime', 'size'])
+    On an incremental scan, directories that did not change since the
+    previous scan are not listed.
+    """
+    threads = args.threads or app.conf['scan']['walk_threads']
+    dircache = None
+    if args.incremental and not args.full:
+        dircache = load_dirstate(app, basedir)
+    return Walker(basedir, threads=int(threads), ignore=load_ignore(),
+                  dircache=dircache, recursive=recursive,
+                  governor=get_governor(app))
 
-    file2id = {}
-    allfiles = []
-    for x in allfilesdb:
-        allfiles.append((x['filename'], x['mtime'], x['size']))
-        file2id[x['filename']] = x['_id']
 
-    allfiles = set(allfiles)
-    lg.info("Found {} files in db".format(len(allfiles)))
+def count_throttle(app):
+    """Add the time spent waiting for the governor to the counters."""
+    for resource, waited in get_governor(app).waited.items():
+        if waited:
+            app.counter['throttle_{}_s'.format(resource)] = int(waited)
 
 
-    madignore = os.path.expanduser('~/.madignore')
-    cwd = os.path.abspath(os.path.normpath(os.getcwd()))
-    cl = r"find {} -type f -printf '%p\t%T@\t%s\n'".format(cwd)
+def below_query(app, basedir, recursive=True, after=None):
+    """Query for the transient records (of this host) below basedir.
 
-    if os.path.exists(madignore):
-        cl += ' | grep -v -f ~/.madignore'
+    With `after`, only files sorting after that filename are included.
+    """
+    pattern = '^{}/' if recursive else '^{}/[^/]+$'
+    query = {'hostname': app.conf['hostname'],
+             'filename': {'$regex': pattern.format(re.escape(basedir))}}
+    if after is not None:
+        query['filename']['$gt'] = after
+    return query
 
-    lg.info('running unix find')
-    P = sp.Popen(cl, shell=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
-    o, e = P.communicate()
 
-    o = list(map(str.strip, o.decode().split('\n')))
-    o = filter(None, o)
+def in_skipped_dir(walker, filename):
+    """Was the directory of this file skipped by an incremental walk?"""
+    return os.path.dirname(filename) in walker.skipped
 
-    def cnv2(l):
-        p, m, s = l.rsplit("\t", 2)
-        m = datetime.fromtimestamp(int(math.floor(float(m))))
-        s = int(s)
-        return (p, m, s)
 
-    o = list(map(cnv2, o))
-    lg.info("unix find found {} files".format(len(o)))
-    now = set(o)
+# order policy -> sort key for (path, mtime, size, ...) records
+ORDERS = {
+    'path': None,
+    'small': lambda f: (f[2], f[0]),
+    'large': lambda f: (-f[2], f[0])}
 
-    if args.refresh:
-        changed = list(now)
-    else:
-        changed = list(now - allfiles)
+# upper limits of the size buckets reported by a plan
+SIZE_BUCKETS = [10 ** 4, 10 ** 6, 10 ** 8, 10 ** 9, 10 ** 10, float('inf')]
 
-    deleted = list(allfiles - now)
 
-    app.counter['indb'] = len(allfiles)
-    app.counter['onfs'] = len(now)
-    app.counter['check'] = len(changed)
-    app.counter['rm'] = len(deleted)
+def ordered(files, order='path'):
+    """Return the paths of (path, mtime, size, ...) records in order.
 
-    lg.info('in database       : {:>8d}'.format(len(allfiles)))
-    lg.info('on filesystem     : {:>8d}'.format(len(now)))
-    lg.info('total new/changed : {:>8d}'.format(len(changed)))
-    lg.info('total deleted     : {:>8d}'.format(len(deleted)))
+    Files arrive sorted by path; other orders need all of them in
+    memory.
+    """
+    if order == 'path':
+        return (f[0] for f in files)
+    return [f[0] for f in sorted(files, key=ORDERS[order])]
 
-    for i, c in enumerate(sorted(changed)):
-        lg.info('changed: {} path  {}'.format(i, c[0]))
-        lg.info('           mtime {}'.format(c[1]))
-        lg.info('           size  {}'.format(c[2]))
-        if i > 3:
-            break
 
-    delids = [file2id[x[0]] for x in deleted]
+def plan_scan(app, files, quick=False):
+    """Report what a scan would hash, with an estimated runtime.
 
-    db.transient.remove({'_id': {"$in": delids}})
-
-    changed = set([f[0] for f in changed])
-    deleted = set([f[0] for f in deleted])
+    Files are grouped by size. For every group the runtime is estimated
+    by hashing a few sample files (up to `plan.sample_size` each) and
+    extrapolating by the number of bytes.
+    """
+    conf = app.conf['plan']
+    nsamples = int(conf['samples'])
+    max_sample = parse_size(conf['sample_size'])
+    buckets = [[0, 0, []] for _ in SIZE_BUCKETS]
 
+    for path, mtime, size, *_ in files:
+        b = next(b for b, limit in enumerate(SIZE_BUCKETS) if size < limit)
+        bucket = buckets[b]
+        bucket[0] += 1
+        bucket[1] += size
+        # reservoir sample of the files small enough to hash
+        if size <= max_sample:
+            if len(bucket[2]) < nsamples:
+                bucket[2].append(path)
+            else:
+                j = random.randrange(bucket[0])
+                if j < nsamples:
+                    bucket[2][j] = path
+
+    engine = checksum.get_engine(app)
+    rate = None            # bytes/s of the last sampled bucket
+    estimates = []
+    for nfiles, nbytes, samples in buckets:
+        if quick or not nfiles:
+            estimates.append(0)
+            continue
+        t0 = time.time()
+        sampled = 0
+        for fn in samples:
+            try:
+                sampled += os.path.getsize(fn)
+            except OSError:
+                pass
+        list(engine.map(lambda fn: _try_checksum(engine, fn), samples))
+        runtime = time.time() - t0
+        if samples and sampled:
+            rate = sampled / runtime
+            estimates.append(nbytes / rate)
+        elif samples:
+            estimates.append(runtime * nfiles / len(samples))
+        elif rate:
+            estimates.append(nbytes / rate)
+        else:
+            estimates.append(None)
+
+    fms = '{:>8}  {:>10}  {:>10}  {:>10}'
+    print(fms.format('size <', 'files', 'bytes', 'est. time'))
+    for limit, (nfiles, nbytes, _), est in zip(
+            SIZE_BUCKETS, buckets, estimates):
+        if nfiles:
+            print(fms.format(
+                'inf' if limit == float('inf') else nicesize(limit),
+                nfiles, nicesize(nbytes), fmt_eta(est)))
+    known = [e for e in estimates if e is not None]
+    print(fms.format(
+        'total', sum(b[0] for b in buckets),
+        nicesize(sum(b[1] for b in buckets)),
+        fmt_eta(sum(known)) + ('' if len(known) == len(estimates)
+                                else '+')))
+    if rate:
+        lg.info("measured hash throughput %s/s", nicesize(int(rate)))
+
+
+def _try_checksum(engine, filename):
+    try:
+        return engine.digest(filename)
+    except OSError:
+        return None
+
+
+def merge_diff(app, basedir, walker, args, recursive=True, after=None,
+               remove=True, deleter=None):
+    """Yield `fsrecord` tuples of the new and changed files below basedir.
+
+    Streams a sorted walk against the database records sorted by
+    filename, so memory use does not depend on the size of the tree.
+    New files are checked for moves in chunks, see `detect_moves`.
+    The records of files only in the database are held by `deleter` (or
+    a new one) until the end of the walk, so a move to a name later in
+    the walk is found as well (see `Deleter.hold`). With `after`, both
+    streams start after that filename. Without `remove`, nothing is
+    changed in the database.
+    """
+    db = get_db(app)
+    cursor = db.transient.find(below_query(app, basedir, recursive, after),
+                               projection=['filename'] + list(SIGNATURE),
+                               no_cursor_timeout=True)\
+        .sort('filename', pymongo.ASCENDING)
+
+    fsrecords = (fsrecord(p, st) for p, st
+                 in timed(app, 'walk', walker.sorted(after=after)))
+    if not remove:
+        deleter = None
+    elif deleter is None:
+        deleter = get_deleter(app)
+    chunk = int(app.conf['madfile']['prefetch_size'])
+    # (fsrec, is new) in filename order, waiting for move detection
+    pending = []
+
+    def flush():
+        moved = detect_moves(app, [f for f, new in pending if new], deleter)
+        for fsrec, new in pending:
+            if fsrec[0] in moved:
+                app.counter['check'] -= 1
+                app.counter['check_sz'] -= fsrec[2]
+            else:
+                yield fsrec
+        del pending[:]
+
+    try:
+        for fsrec, dbrec in merge_join(fsrecords, cursor):
+            if dbrec is not None:
+                app.counter['indb'] += 1
+            if fsrec is None:
+                if in_skipped_dir(walker, dbrec['filename']):
+                    pass
+                elif not remove:
+                    app.counter['gone'] += 1
+                else:
+                    deleter.hold(dbrec['_id'], dbrec['filename'])
+                continue
 
-    lg.info("{} files seem changed".format(len(changed)))
+            app.counter['onfs'] += 1
+            if dbrec is None or args.refresh or not unchanged(fsrec, dbrec):
+                app.counter['check'] += 1
+                app.counter['check_sz'] += fsrec[2]
+                pending.append((fsrec, dbrec is None))
+                if len(pending) >= chunk:
+                    yield from flush()
+        yield from flush()
+    finally:
+        cursor.close()
+
+    if deleter is not None:
+        deleter.close()
+
+
+def run_scan(app, basedir, args, recursive=True, checkpoint=False):
+    """Scan a directory (tree) and bring the database up to date.
+
+    With `recursive` False only the files directly in basedir are
+    scanned (used for the shallow units of a distributed scan). With
+    `checkpoint`, progress is stored periodically, and a scan started
+    with `args.resume` continues from the last checkpoint.
+    """
+    if args.plan:
+        return _run_scan(app, basedir, args, recursive, checkpoint)
+
+    app.progress = Progress(app.counter,
+                            json_path=args.progress_json)
+    app.progress.start()
+    try:
+        _run_scan(app, basedir, args, recursive, checkpoint)
+    finally:
+        app.progress.stop()
+        app.progress = None
+
+
+def _run_scan(app, basedir, args, recursive, checkpoint):
+    db = get_db(app)
+    app.bulk_init()
 
-    lastscreenupdate = time.time()
-    # print_counter(app.counter)
+    walker = get_walker(app, basedir, args, recursive=recursive)
 
-    # store in database
+    after = None
+    if checkpoint and args.resume:
+        ckpt = load_checkpoint(app, basedir)
+        if ckpt is None:
+            app.warning("No checkpoint found, starting from scratch")
+        else:
+            after = ckpt['position']
+            app.counter.update(ckpt['counters'])
+            app.message("Resuming after {}".format(after))
+
+    deleter = None
+    if args.merge or after is not None:
+        lg.info('merging a sorted walk of {} with the db'.format(basedir))
+        # shared with the checkpointer: removals are part of the progress
+        deleter = None if args.plan else get_deleter(app)
+        changed = merge_diff(app, basedir, walker, args,
+                             recursive=recursive, after=after,
+                             remove=not args.plan, deleter=deleter)
+    else:
+        lg.info("Query database for files below\n    {}".format(basedir))
+        allfilesdb = db.transient.find(
+            below_query(app, basedir, recursive=recursive),
+            projection=['filename'] + list(SIGNATURE))
+
+        file2id = {}
+        allfiles = []
+        for x in allfilesdb:
+            allfiles.append((x['filename'],) + db_signature(x))
+            file2id[x['filename']] = x['_id']
+
+        allfiles = set(allfiles)
+        lg.info("Found {} files in db".format(len(allfiles)))
+
+
+        lg.info('walking {}'.format(basedir))
+        now = set(fsrecord(p, st) for p, st in timed(app, 'walk', walker))
+        lg.info("walker found {} files in {} dirs"
+                .format(len(now), walker.dirs))
+
+        if walker.skipped:
+            # files in unchanged directories are assumed unchanged
+            now |= set(f for f in allfiles if in_skipped_dir(walker, f[0]))
+            lg.info("skipped {} unchanged dirs".format(len(walker.skipped)))
+            app.counter['dirskip'] += len(walker.skipped)
+
+        if args.refresh:
+            changed = list(now)
+        else:
+            changed = list(now - allfiles)
+
+        deleted = list(allfiles - now)
+
+        # moved files keep their record, see `detect_moves`
+        deleter = None if args.plan else get_deleter(app)
+        new = [f for f in changed if f[0] not in file2id]
+        moved = {}
+        for files in madfile.chunked(new, int(
+                app.conf['madfile']['prefetch_size'])):
+            moved.update(detect_moves(app, files, deleter))
+        if moved:
+            changed = [f for f in changed if f[0] not in moved]
+
+        app.counter['indb'] += len(allfiles)
+        app.counter['onfs'] += len(now)
+        app.counter['check'] += len(changed)
+        app.counter['check_sz'] += sum(f[2] for f in changed)
+
+        lg.info('in database       : {:>8d}'.format(len(allfiles)))
+        lg.info('on filesystem     : {:>8d}'.format(len(now)))
+        lg.info('total new/changed : {:>8d}'.format(len(changed)))
+        lg.info('total deleted     : {:>8d}'.format(len(deleted)))
+
+        for i, c in enumerate(sorted(changed)):
+            lg.info('changed: {} path  {}'.format(i, c[0]))
+            lg.info('           mtime {}'.format(
+                datetime.fromtimestamp(c[1] / 1e9)))
+            lg.info('           size  {}'.format(c[2]))
+            if i > 3:
+                break
+
+        if deleter is None:
+            app.counter['gone'] += len(deleted)
+        else:
+            moved_ids = set(moved.values())
+            for x in deleted:
+                if file2id[x[0]] not in moved_ids:
+                    deleter.add(file2id[x[0]])
+            deleter.close()
+
+        # sorted, so the progress can be checkpointed as a position
+        changed = sorted(changed)
+
+        lg.info("{} files seem changed".format(len(changed)))
+
+    if args.plan:
+        plan_scan(app, changed, quick=args.quick)
+        return
+
+    order = args.order or app.conf['scan']['order']
+    if after is not None and order != 'path':
+        app.warning("Resuming in path order")
+        order = 'path'
+    changed = ordered(changed, order)
+
+    checkpointer = None
+    if checkpoint and order == 'path':
+        # checkpoints are positions in the sorted list of files
+        checkpointer = Checkpointer(
+            app, basedir, interval=float(app.conf['scan']['checkpoint']),
+            deleter=deleter)
+
+    deadline = None
+    if args.budget:
+        deadline = time.time() + parse_duration(args.budget)
+
+    def until_deadline(files):
+        for filename in files:
+            yield filename
+            if deadline is not None and time.time() > deadline:
+                return
+
+    # store in database - files are loaded (and hashed) in parallel,
+    # with the db records fetched in batches. Once the budget is spent,
+    # the remaining files are stored as quick records.
+    changed = iter(changed)
+    for quick, files in ((args.quick, until_deadline(changed)),
+                         (True, changed)):
+        for filename, mfile in MadFile.load_many(app, files, quick=quick,
+                                                 parallel=True):
+            app.counter['changed'] += 1
+            if quick and not args.quick:
+                app.counter['budget_quick'] += 1
+            if mfile is None:
+                app.counter['noaccess'] += 1
+            else:
+                app.counter['done_sz'] += mfile.filestat.st_size
+                if mfile.dirty:
+                    mfile.save()
 
-    for filename in changed:
+            if checkpointer is not None:
+                checkpointer.update(filename)
 
-        app.counter['changed'] += 1
-        try:
-            mfile = MadFile(app, filename, quick=args.quick)
-        except PermissionError as e:
-            app.counter['noaccess'] += 1
-            continue
+    app.bulk_execute()
+    count_throttle(app)
+    if after is None:
+        # a resumed walk did not see the whole tree
+        save_dirstate(app, basedir, walker.dirstate, recursive=recursive)
+    if checkpointer is not None:
+        clear_checkpoint(app, basedir)
 
-        if mfile.dirty:
-            mfile.save()
 
-        if time.time() - lastscreenupdate > 2:
-            print_counter(app.counter)
-            lastscreenupdate = time.time()
+@leip.flag('-q', '--quick', help='do not calculate shasums, do not store data '
+           'in the core database')
+@leip.flag('-r', '--refresh', help='refresh all files')
+@leip.arg('-j', '--threads', type=int, help='no of directory listing threads')
+@leip.flag('-i', '--incremental', help='do not list directories that '
+           'did not change since the last scan')
+@leip.flag('--full', help='list all directories (overrides --incremental)')
+@leip.flag('-m', '--merge', help='compare a sorted walk with the database '
+           'in a streaming merge (constant memory)')
+@leip.flag('--coordinate', help='do not scan, split cwd into work units '
+           'for `m3 scan --worker` processes')
+@leip.arg('--depth', type=int, default=2, help='depth of the work units '
+          'created by --coordinate')
+@leip.flag('--worker', help='claim and scan work units created by '
+           '--coordinate, until there are none left')
+@leip.arg('--job', help='job to work on (with --worker; default: any)')
+@leip.flag('--resume', help='continue an interrupted scan from its last '
+           'checkpoint')
+@leip.arg('--progress-json', help='write progress snapshots (JSON) to this '
+          'file')
+@leip.flag('--plan', help='walk and compare only; report what needs hashing '
+           'and an estimated runtime')
+@leip.arg('--order', choices=sorted(ORDERS), help='order in which files are '
+          'processed (default: scan.order); checkpoints need `path`')
+@leip.arg('--budget', help='hash for at most this long (e.g. 8h), store the '
+          'remaining files as quick records')
+@leip.command
+def scan(app, args):
+    """Scan cwd and bring the database up to date."""
+    starttime = time.time()
+    cwd = os.path.abspath(os.path.normpath(os.getcwd()))
 
-    app.bulk_execute()
+    if args.coordinate:
+        job, nounits = create_units(app, cwd, depth=args.depth)
+        app.message("Created {} work units for job {}".format(nounits, job))
+        return
+    elif args.worker:
+        Worker(app, job=args.job).run(
+            lambda basedir, recursive: run_scan(
+                app, basedir, args, recursive=recursive))
+    else:
+        run_scan(app, cwd, args, checkpoint=True)
 
     print_counter(app.counter)
     # ensure we end on a newline
     print("\nruntime: {:.4f}".format(time.time() - starttime))
 
 
+@leip.arg('--job', help='job to show (default: all)')
+@leip.command
+def scanstatus(app, args):
+    """Show the progress of distributed scans."""
+    for job in job_status(app, job=args.job):
+        print('{} ({}, host {}, {})'.format(
+            job['_id'], job['basedir'], job['hostname'],
+            ' '.join('{}:{}'.format(k, v)
+                     for k, v in sorted(job['states'].items()))))
+        print('    ' + ' '.join(
+            '{}:{}'.format(k, nicesize(v) if k.endswith('_sz') else v)
+            for k, v in sorted(job['counters'].items())))
+
 
 @leip.flag('-q', '--quick', help='do not calculate shasums, do not store data '
            'in the core database')
 @leip.flag('-r', '--refresh', help='refresh all files')
+@leip.arg('-j', '--threads', type=int, help='no of directory listing threads')
+@leip.flag('-i', '--incremental', help='do not list directories that '
+           'did not change since the last scan')
+@leip.flag('--full', help='list all directories (overrides --incremental)')
+@leip.flag('-m', '--merge', help='compare a sorted walk with the database '
+           'in a streaming merge (constant memory, the default)')
+@leip.flag('--snapshot', help='load all database records first, and '
+           'compare an unsorted walk (memory grows with the tree)')
 @leip.command
 def scan2(app, args):
+    """Scan cwd with a staged pipeline: walk, diff, lookup, hash and write.
 
-    basedir = os.getcwd().rstrip('/') + '/'
+    Stages are connected with bounded queues, and the walk is merged
+    with the database records, so memory use stays flat while disk, cpu
+    and database work overlap.
+    """
     db = get_db(app)
-    lastscreenupdate = starttime = time.time()
+    starttime = time.time()
     app.bulk_init()
 
-    ff_regex = "^{}".format(basedir)
-
-    lg.info("Query database for files below\n    {}".format(basedir))
-    allfilesdb = db.transient.find({'filename': {"$regex": ff_regex}},
-                                 projection=['filename', 'mtime', 'size'])
-
-    file2id = {}
-    allfiles = []
-    for x in allfilesdb:
-        allfiles.append((x['filename'], x['mtime'], x['size']))
-        file2id[x['filename']] = x['_id']
-
-    allfiles = set(allfiles)
-    # print(len(allfiles))
-    lg.info("Found {} files in db".format(len(allfiles)))
-    app.counter['indb'] = len(allfiles)
-    app.message('Files in db: {}'.format(len(allfiles)))
-
-
-    # run Unix FIND (seems the fastest way, plus we get the benefit
-    # of adding in grep)
-
-
-    madignore = os.path.expanduser('~/.madignore')
     cwd = os.path.abspath(os.path.normpath(os.getcwd()))
-    cl = r"find {} -type f -printf '%p\t%T@\t%s\n'".format(cwd)
-
-    if os.path.exists(madignore):
-        cl += ' | grep -v -f ~/.madignore'
-
-    lg.info('running unix find')
-
-    def cnv2(l):
-        p, m, s = l.rsplit("\t", 2)
-        m = datetime.fromtimestamp(int(math.floor(float(m))))
-        s = int(s)
-        return (p, m, s)
-
-    deleted = set()
-    changed = set()
-    onfs = set()
-
-
-    P = sp.Popen(cl, shell=True, bufsize=1 stdout=sp.PIPE, stderr=sp.DEVNULL)
-    with P.stdout as uxfind:
-        for ii, line in enumerate(uxfind.readlines()):
-
-            ffile = cnv2(line.strip().decode())
-            if not ffile:
-                continue
-
-            onfs.add(ffile)
-            app.counter['seenonfs'] += 1
-            in_allfiles = ffile in allfiles
-            if (in_allfiles and args.refresh) or \
-                    (not in_allfiles):
-                #needs refreshing
-
-                filename = ffile[0]
-                if in_allfiles:
-                    app.counter['refresh'] += 1
-                else:
-                    app.counter['new'] += 1
-
-                try:
-                    mfile = MadFile(app, filename, quick=args.quick)
-                except PermissionError as e:
-                    app.counter['noxs'] += 1
-                    continue
-
-                if mfile.dirty:
-                    mfile.save()
-
-                if time.time() - lastscreenupdate > 2:
-                    print_counter(app.counter)
-                    lastscreenupdate = time.time()
-            else:
-                # ignoring this file, it exists, and has not changed
-                app.counter['notnew'] += 1
+    walker = get_walker(app, cwd, args)
+    merge = not args.snapshot
+
+    # filename -> (id, *signature); entries are removed when seen on
+    # the filesystem, what remains has been deleted
+    dbfiles = {}
+    if not merge:
+        lg.info("Query database for files below\n    {}".format(cwd))
+        allfilesdb = db.transient.find(
+            below_query(app, cwd),
+            projection=['filename'] + list(SIGNATURE))
+
+        for x in allfilesdb:
+            dbfiles[x['filename']] = (x['_id'],) + db_signature(x)
+
+        lg.info("Found {} files in db".format(len(dbfiles)))
+        app.counter['indb'] = len(dbfiles)
+        app.message('Files in db: {}'.format(len(dbfiles)))
+
+    def diff(entry):
+        fsrec = fsrecord(*entry)
+        path = fsrec[0]
+        app.counter.incr('seenonfs')
+        dbrec = dbfiles.pop(path, None)
+        if dbrec is None:
+            app.counter.incr('new')
+        elif dbrec[1:] != fsrec[1:]:
+            app.counter.incr('changed')
+        elif args.refresh:
+            app.counter.incr('refresh')
+        else:
+            # ignoring this file, it exists, and has not changed
+            app.counter.incr('notnew')
+            return None
+        return path
+
+    def lookup():
+        size = int(app.conf['madfile']['prefetch_size'])
+        for chunk in batches(workq, size):
+            transient_recs, core_recs = MadFile.prefetch(
+                app, chunk, quick=args.quick)
+            for filename in chunk:
+                yield filename, transient_recs[filename], core_recs
+
+    def process(item):
+        filename, transient_rec, core_recs = item
+        try:
+            mfile = MadFile(app, filename, quick=args.quick,
+                            transient_rec=transient_rec, core_recs=core_recs)
+        except (M3FileNotFound, PermissionError) as e:
+            app.counter.incr('noxs')
+            return None
+        if mfile.dirty:
+            mfile.save()
+        return None
+
+    def write(op):
+        madfile.bulk_append(app, *op)
+        return None
+
+    conf = app.conf['scan']
+    pipeline = Pipeline(maxsize=int(conf['queue_size']))
+    walkq = pipeline.queue()
+    workq = pipeline.queue()
+    hashq = pipeline.queue()
+    app.bulk_queue = pipeline.queue()
+
+    if merge:
+        # the merge join walks and diffs in one go
+        lg.info('merging a sorted walk of {} with the db'.format(cwd))
+        pipeline.add(Stage('diff', source=(
+            fsrec[0] for fsrec in merge_diff(app, cwd, walker, args)),
+                           outq=workq))
+    else:
+        lg.info('walking {}'.format(cwd))
+        pipeline.add(Stage('walk', source=walker, outq=walkq))
+        pipeline.add(Stage('diff', diff, inq=walkq, outq=workq))
+    pipeline.add(Stage('lookup', source=lookup(), outq=hashq))
+    pipeline.add(Stage('hash', process, inq=hashq, outq=app.bulk_queue,
+                       workers=int(conf['hash_workers'])))
+    pipeline.add(Stage('write', write, inq=app.bulk_queue))
+
+    def monitor():
+        print_counter(app.counter)
+
+    try:
+        pipeline.run(monitor=monitor)
+    finally:
+        app.bulk_queue = None
 
     app.bulk_execute()
 
-    deleted = list(allfiles - onfs)
+    save_dirstate(app, cwd, walker.dirstate)
 
-    app.counter['onfs'] = len(onfs)
-    app.counter['rm'] = len(deleted)
-    delids = [file2id[x[0]] for x in deleted]
+    app.counter['dirskip'] = len(walker.skipped)
+    if not merge:
+        # what remains of the db snapshot is deleted, unless it lives in
+        # a directory skipped by an incremental walk
+        app.counter['onfs'] = app.counter['seenonfs']
+        deleter = get_deleter(app)
+        for fn, x in dbfiles.items():
+            if not in_skipped_dir(walker, fn):
+                deleter.add(x[0])
+        deleter.close()
 
-    db.transient.remove({'_id': {"$in": delids}})
-    lg.info("{} files seem changed".format(len(changed)))
+    for name, rate in pipeline.rates().items():
+        app.counter['{}/s'.format(name)] = int(rate)
+    count_throttle(app)
 
     print_counter(app.counter)
     # ensure we end on a newline
     print("\nruntime: {:.4f}".format(time.time() - starttime))
+
+
+@leip.arg('-b', '--blocksize', type=int, default=checksum.BLOCKSIZE,
+          help='read block size')
+@leip.arg('-n', '--repeat', type=int, default=3, help='runs per backend')
+@leip.arg('-d', '--digests', help='digests to calculate, comma separated '
+          '(default: scan.digests)')
+@leip.flag('--no-fadvise', help='do not use posix_fadvise')
+@leip.arg('file', nargs='+', help='files to hash')
+@leip.command
+def hashbench(app, args):
+    """Show the hashing throughput (MB/s) of each read backend.
+
+    With fadvise (the default) the file pages are dropped after each
+    run, so every run reads from disk rather than the page cache.
+    """
+    total = sum(os.path.getsize(fn) for fn in args.file)
+    digests = checksum.parse_digests(
+        args.digests or app.conf['scan']['digests'])
+    print('# {} files, {}, {}'.format(len(args.file), nicesize(total),
+                                      ' '.join(digests)))
+    for backend in sorted(checksum.BACKENDS):
+        rates = []
+        for _ in range(args.repeat):
+            t0 = time.time()
+            for fn in args.file:
+                checksum.digest(fn, digests, blocksize=args.blocksize,
+                                backend=backend,
+                                fadvise=not args.no_fadvise)
+            rates.append(total / 1e6 / max(time.time() - t0, 1e-9))
+        print('{:10}\t{:>10.1f} MB/s\t(best {:.1f})'.format(
+            backend, sum(rates) / len(rates), max(rates)))
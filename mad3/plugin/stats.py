@@ -1,13 +1,18 @@
 
 
+from collections import defaultdict
 import logging
+import os
+import re
 
 import leip
 import pymongo
 
+from mad3.checksum import get_engine
 from mad3.db import get_db
 from mad3.util import persistent_cache, mongo_cache
-from mad3.util import key_info, nicesize, nicenumber
+from mad3.keywords import get_schema
+from mad3.util import nicesize, nicenumber
 
 lg = logging.getLogger(__name__)
 
@@ -87,7 +92,7 @@ def sum(app, args):
         print("     No Core records: ", db.transient.count())
         return
 
-    kname, kinfo = key_info(app.conf, args.key)
+    kname, kinfo = get_schema(app).resolve(args.key)
     res = _single_sum(app, group_by=kname, force=args.force)
     total_size = int(0)
     total_count = 0
@@ -131,6 +136,70 @@ def sum(app, args):
 
 
 
+def duplicate_candidates(app, basedir):
+    """Yield groups of records below basedir with equal fingerprints.
+
+    Only the fingerprint is compared, so a group holds candidate
+    duplicates, not necessarily files with equal content.
+    """
+    db = get_db(app)
+    query = [
+        {'$match': {
+            'hostname': app.conf['hostname'],
+            'filename': {'$regex': '^{}/'.format(re.escape(basedir))},
+            'fingerprint': {'$exists': True},
+            'size': {'$gt': 0}}},
+        {'$group': {
+            '_id': {'size': '$size', 'fingerprint': '$fingerprint'},
+            'files': {'$push': {'filename': '$filename',
+                                'sha256': '$sha256'}},
+            'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$sort': {'_id.size': -1}}]
+    for group in db.transient.aggregate(query, allowDiskUse=True):
+        yield group['_id']['size'], group['files']
+
+
+def verify_duplicates(app, files):
+    """Split candidate duplicates in groups of equal sha256.
+
+    Files without a checksum (quick records) are hashed.
+    """
+    def sha256(rec):
+        if rec['sha256'] != '0':
+            return rec['filename'], rec['sha256']
+        try:
+            app.counter.incr('verify')
+            digests, _ = get_engine(app).digest(
+                rec['filename'], os.stat(rec['filename']),
+                digests=['sha256'])
+            return rec['filename'], digests['sha256']
+        except OSError:
+            return rec['filename'], None
+
+    groups = defaultdict(list)
+    for filename, sha in get_engine(app).map(sha256, files):
+        if sha is not None:
+            groups[sha].append(filename)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+@leip.flag('-v', '--verify', help='confirm candidates with a full checksum')
+@leip.arg('dir', nargs='?', default='.', help='directory to search')
+@leip.command
+def dups(app, args):
+    """Find duplicate files by their partial content fingerprint."""
+    basedir = os.path.abspath(os.path.normpath(args.dir))
+    for size, files in duplicate_candidates(app, basedir):
+        if args.verify:
+            groups = verify_duplicates(app, files)
+        else:
+            groups = [[f['filename'] for f in files]]
+        for group in groups:
+            print('# {} x {}'.format(len(group), nicesize(size)))
+            for filename in group:
+                print(filename)
+
 
 FIND_WASTER_PIPELINE = [
     {"$project": {"filesize": 1,
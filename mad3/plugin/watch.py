@@ -0,0 +1,255 @@
+"""
+Keep transient records current by watching a tree with inotify.
+"""
+
+import logging
+import os
+import re
+import time
+
+import leip
+
+from mad3 import inotify
+from mad3.checksum import get_engine
+from mad3.db import get_db
+from mad3.exceptions import M3FileNotFound
+from mad3.madfile import MadFile, transient_id
+from mad3.diff import SIGNATURE, db_signature, signature
+from mad3.plugin.scan import print_counter
+from mad3.tombstone import get_deleter
+from mad3.walk import Walker, load_ignore
+
+lg = logging.getLogger(__name__)
+
+WATCH_MASK = (inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE
+              | inotify.IN_ATTRIB | inotify.IN_CREATE | inotify.IN_DELETE
+              | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+              | inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW)
+
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+class Watcher:
+    """Collect inotify events below a directory, and apply them in batches."""
+
+    def __init__(self, app, basedir: str, quick: bool=False,
+                 threads: int=8) -> None:
+        """Prepare the watcher (no watches are added yet)."""
+        self.app = app
+        self.basedir = os.path.abspath(basedir)
+        self.quick = quick
+        self.threads = threads
+        self.ignore = load_ignore()
+        self.inotify = inotify.Inotify()
+
+        self.wd2dir = {}       # type: dict
+        # path -> UPDATE or DELETE, only the last event counts
+        self.pending = {}      # type: dict
+        # directories removed or moved away
+        self.rmtrees = set()   # type: set
+        self.overflow = False
+
+    def ignored(self, path: str, isdir: bool=False) -> bool:
+        """Does a madignore pattern match this path?"""
+        if self.ignore is None:
+            return False
+        if isdir:
+            path += '/'
+        return self.ignore.search(path) is not None
+
+    def watch_tree(self, dirname: str):
+        """Watch all directories below dirname.
+
+        Yields the (path, stat) of all files found while doing so. Each
+        directory is watched before it is listed, so no file created
+        during the walk is missed (some may be reported twice).
+        """
+        walker = Walker(dirname, threads=self.threads, ignore=self.ignore,
+                        on_dir=self.add_watch)
+        yield from walker
+        self.app.counter['watches'] = len(self.wd2dir)
+
+    def add_watch(self, dirname: str):
+        """Watch one directory."""
+        try:
+            wd = self.inotify.add_watch(dirname, WATCH_MASK)
+        except OSError as e:
+            lg.warning("cannot watch %s: %s", dirname, e)
+            return
+        self.wd2dir[wd] = dirname
+
+    def unwatch_tree(self, dirname: str):
+        """Stop watching dirname and everything below."""
+        prefix = dirname + '/'
+        for wd, wdir in list(self.wd2dir.items()):
+            if wdir == dirname or wdir.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.wd2dir[wd]
+        self.app.counter['watches'] = len(self.wd2dir)
+
+    def handle(self, event):
+        """Register one inotify event."""
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            lg.warning("inotify queue overflow, rescan needed")
+            self.overflow = True
+            return
+
+        if event.mask & inotify.IN_IGNORED:
+            self.wd2dir.pop(event.wd, None)
+            return
+
+        dirname = self.wd2dir.get(event.wd)
+        if dirname is None or not event.name:
+            return
+
+        path = os.path.join(dirname, event.name)
+        if self.ignored(path, isdir=event.isdir):
+            return
+
+        self.app.counter['events'] += 1
+        if event.isdir:
+            if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                # a removal of an earlier tree at this path stays: removals
+                # are applied first, and the new files are stored after
+                for filename, st in self.watch_tree(path):
+                    self.pending[filename] = UPDATE
+            elif event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                self.unwatch_tree(path)
+                self.rmtrees.add(path)
+                prefix = path + '/'
+                for filename in list(self.pending):
+                    if filename.startswith(prefix):
+                        del self.pending[filename]
+        elif event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.pending[path] = DELETE
+        else:
+            self.pending[path] = UPDATE
+
+    def rescan(self):
+        """Compare the whole tree with the database.
+
+        Used after a queue overflow, when events have been lost. The
+        watches are renewed as well.
+        """
+        db = get_db(self.app)
+        self.app.counter['rescan'] += 1
+        dbfiles = {}
+        query = {'hostname': self.app.conf['hostname'],
+                 'filename': {'$regex': '^{}/'.format(
+                     re.escape(self.basedir))}}
+        for rec in db.transient.find(
+                query, projection=['filename'] + list(SIGNATURE)):
+            dbfiles[rec['filename']] = db_signature(rec)
+
+        for path, st in self.watch_tree(self.basedir):
+            if dbfiles.pop(path, None) != signature(st):
+                self.pending[path] = UPDATE
+        for filename in dbfiles:
+            self.pending[filename] = DELETE
+        self.overflow = False
+
+    def flush(self):
+        """Write all pending changes to the database."""
+        if self.overflow:
+            self.rescan()
+
+        app = self.app
+        db = get_db(app)
+        app.bulk_init()
+
+        deleter = get_deleter(app)
+        for dirname in self.rmtrees:
+            app.counter['rmtree'] += 1
+            for rec in db.transient.find({
+                    'hostname': app.conf['hostname'],
+                    'filename': {'$regex': '^{}/'.format(
+                        re.escape(dirname))}}, projection=['_id']):
+                deleter.add(rec['_id'])
+
+        for filename, what in self.pending.items():
+            if what == DELETE:
+                deleter.add(transient_id(app, filename))
+        deleter.close()
+
+        def load(filename):
+            try:
+                mfile = MadFile(app, filename, quick=self.quick)
+            except (M3FileNotFound, PermissionError) as e:
+                # gone again, or not for us
+                app.counter.incr('skip')
+                return None
+            app.counter.incr('update')
+            if mfile.dirty:
+                mfile.save()
+            return mfile
+
+        updates = [filename for filename, what in self.pending.items()
+                   if what == UPDATE and os.path.isfile(filename)]
+        for mfile in get_engine(app).map(load, updates):
+            pass
+
+        app.bulk_execute()
+        app.counter['batch'] += 1
+        self.pending = {}
+        self.rmtrees = set()
+
+    def run(self, debounce: float=2, max_delay: float=30,
+            batch_size: int=10000):
+        """Watch until interrupted.
+
+        Events are collected until nothing happened for `debounce`
+        seconds, the oldest pending event is `max_delay` seconds old, or
+        `batch_size` paths are pending.
+        """
+        for _ in self.watch_tree(self.basedir):
+            pass
+        lg.info("watching {} directories".format(len(self.wd2dir)))
+        print_counter(self.app.counter)
+
+        first = None
+        while True:
+            events = self.inotify.read(timeout=debounce)
+            for event in events:
+                self.handle(event)
+
+            if not (self.pending or self.rmtrees or self.overflow):
+                first = None
+                continue
+
+            now = time.time()
+            if first is None:
+                first = now
+            if not events or now - first > max_delay \
+                    or len(self.pending) >= batch_size:
+                self.flush()
+                print_counter(self.app.counter)
+                first = None
+
+
+@leip.flag('-q', '--quick', help='do not calculate shasums, do not store data '
+           'in the core database')
+@leip.arg('-j', '--threads', type=int, help='no of directory listing threads')
+@leip.arg('dir', nargs='?', default='.', help='directory to watch')
+@leip.command
+def watch(app, args):
+    """Keep the database current with changes below a directory."""
+    try:
+        watcher = Watcher(app, args.dir, quick=args.quick,
+                          threads=args.threads
+                          or int(app.conf['scan']['walk_threads']))
+    except OSError as e:
+        app.warning("Cannot start watching: {}".format(e))
+        exit(-1)
+
+    conf = app.conf['watch']
+    try:
+        watcher.run(debounce=float(conf['debounce']),
+                    max_delay=float(conf['max_delay']),
+                    batch_size=int(conf['batch_size']))
+    except KeyboardInterrupt:
+        watcher.flush()
+        print_counter(app.counter)
+        print()
+    finally:
+        watcher.inotify.close()
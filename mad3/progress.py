@@ -0,0 +1,196 @@
+"""
+Scan progress: rates, ETA and where the time goes.
+
+Progress is derived from the scan counters: `check`/`check_sz` are the
+files (and bytes) found to need processing, `changed`/`done_sz` the
+files (and bytes) processed. Time is split over the phases of a scan
+(walk, lookup, hash and write) with `phase`; times of parallel workers
+add up, so the split is a share of the total work, not of the wall
+clock time.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from mad3.util import nicesize
+
+lg = logging.getLogger(__name__)
+
+PHASES = ('walk', 'lookup', 'hash', 'write')
+
+
+def fmt_eta(seconds) -> str:
+    """Format a number of seconds (or None) as h:mm:ss."""
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(
+        seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+class Progress:
+    """Track and report the progress of a scan."""
+
+    def __init__(self, counter, json_path: str=None, interval: float=2,
+                 window: float=30, out=sys.stdout) -> None:
+        """Prepare the report.
+
+        Rates are averaged over the last `window` seconds. With a
+        `json_path`, every report is also written as a JSON snapshot.
+        """
+        self.counter = counter
+        self.json_path = json_path
+        self.interval = interval
+        self.window = window
+        self.out = out
+
+        self.starttime = time.time()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        # (time, files done, bytes done)
+        self.samples = deque()    # type: deque
+        self.last_change = self.starttime
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None       # type: threading.Thread
+
+    @contextmanager
+    def phase(self, name: str):
+        """Add the time spent in the block to a phase."""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] += time.time() - t0
+
+    def timed(self, name: str, iterable):
+        """Yield from iterable, adding the time spent waiting to a phase."""
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def snapshot(self) -> dict:
+        """Return the current progress as a dictionary."""
+        now = time.time()
+        c = self.counter
+        files, nbytes = c['changed'], c['done_sz']
+
+        if not self.samples or self.samples[-1][1:] != (files, nbytes):
+            self.last_change = now
+        self.samples.append((now, files, nbytes))
+        while len(self.samples) > 2 and \
+                now - self.samples[1][0] > self.window:
+            self.samples.popleft()
+
+        t0, files0, nbytes0 = self.samples[0]
+        dt = now - t0
+        files_rate = (files - files0) / dt if dt > 0 else 0
+        bytes_rate = (nbytes - nbytes0) / dt if dt > 0 else 0
+
+        remaining_files = max(0, c['check'] - files)
+        remaining_bytes = max(0, c['check_sz'] - nbytes)
+        if remaining_bytes and bytes_rate:
+            eta = remaining_bytes / bytes_rate
+        elif remaining_files and files_rate:
+            eta = remaining_files / files_rate
+        elif not remaining_files:
+            eta = 0
+        else:
+            eta = None
+
+        with self._lock:
+            phases = dict(self.phases)
+
+        return {
+            'time': datetime.now().isoformat(),
+            'elapsed': now - self.starttime,
+            'files_done': files,
+            'files_todo': c['check'],
+            'bytes_done': nbytes,
+            'bytes_todo': c['check_sz'],
+            'remaining_bytes': remaining_bytes,
+            'files_per_s': files_rate,
+            'bytes_per_s': bytes_rate,
+            'eta': eta,
+            'stalled': now - self.last_change,
+            'phases': phases,
+            'counters': dict(c)}
+
+    def line(self, snap: dict) -> str:
+        """Format a snapshot as a one line report."""
+        total = sum(snap['phases'].values())
+        split = ' '.join(
+            '{}:{:.0f}%'.format(k, 100 * v / total if total else 0)
+            for k, v in snap['phases'].items())
+        return '{}/{} files {:.1f}/s, {}/{} {}/s, eta {} ({})'.format(
+            snap['files_done'], snap['files_todo'], snap['files_per_s'],
+            nicesize(snap['bytes_done']), nicesize(snap['bytes_todo']),
+            nicesize(int(snap['bytes_per_s'])), fmt_eta(snap['eta']),
+            split)
+
+    def report(self):
+        """Print a report line, and write the JSON snapshot."""
+        snap = self.snapshot()
+        print('\r' + self.line(snap) + ' <<   ', end='', file=self.out)
+        self.out.flush()
+        if self.json_path:
+            self.write_json(snap)
+
+    def write_json(self, snap: dict):
+        """Write a snapshot to the JSON file (atomically)."""
+        tmp = self.json_path + '.tmp'
+        try:
+            with open(tmp, 'w') as F:
+                json.dump(snap, F, default=str)
+            os.replace(tmp, self.json_path)
+        except OSError as e:
+            lg.warning("cannot write %s: %s", self.json_path, e)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        """Report every `interval` seconds on a background thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='progress')
+        self._thread.start()
+
+    def stop(self):
+        """Stop reporting, after a final report."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+        print(file=self.out)
+
+
+@contextmanager
+def phase(app, name: str):
+    """Time a phase of the progress of an app (if it has one)."""
+    progress = getattr(app, 'progress', None)
+    if progress is None:
+        yield
+    else:
+        with progress.phase(name):
+            yield
+
+
+def timed(app, name: str, iterable):
+    """Time iterating, if the app has a progress."""
+    progress = getattr(app, 'progress', None)
+    if progress is None:
+        return iterable
+    return progress.timed(name, iterable)
@@ -143,15 +143,17 @@ class Relation:
             observe(NO_INPUT_OUTPUT_DATA, {})
             return tstate
 
+        madfiles = self.load_io()
         for io in self.data['io']:
-            if not os.path.exists(io['filename']):
+            if io['filename'] not in madfiles:
+                # not there, or not readable
                 observe(FILE_NOT_FOUND, io)
                 if io['category'] == 'input':
                     observe(INPUT_FILE_NOT_FOUND, io)
                 else:
                     observe(OUTPUT_FILE_NOT_FOUND, io)
             else:
-                mf = MadFile(self.app, io['filename'])
+                mf = madfiles[io['filename']]
                 if mf.sha256 != io['sha256']:
                     observe(FILE_CHANGED, io)
                     if io['category'] == 'input':
@@ -185,6 +187,20 @@ class Relation:
 
         return tstate
 
+    def load_io(self):
+        """Load the MadFiles of all existing IO files.
+
+        Db records are fetched in one go, and files are loaded (and, if
+        necessary, hashed) in parallel. Returns a dictionary filename ->
+        MadFile.
+        """
+        filenames = sorted(set(
+            io['filename'] for io in self.data.get('io', [])
+            if os.path.exists(io['filename'])))
+        return {filename: mf for filename, mf
+                in MadFile.load_many(self.app, filenames, parallel=True)
+                if mf is not None}
+
     def _get_io_struct(self):
         """Return array with structure of the io (cat/groups)."""
         rv = []
@@ -273,9 +289,10 @@ class Relation:
         if 'io' not in self.data:
             return
 
+        madfiles = self.load_io()
         for io in self.data['io']:
-            if os.path.exists(io['filename']):
-                mf = MadFile(self.app, io['filename'])
+            if io['filename'] in madfiles:
+                mf = madfiles[io['filename']]
                 if io['category'] == 'input':
                     if mf.sha256 != io['sha256']:
                         raise Exception(
@@ -0,0 +1,136 @@
+"""
+Removal of transient records, with tombstones.
+
+Records are removed in bounded chunks, so a large deletion does not
+produce a single huge `$in` query. For every removed record a compact
+tombstone (filename, hostname, sha256, size and deletion time) is kept
+in the `tombstone` collection, for consumers that follow deletions.
+Records of moved files get a tombstone with the new name (`moved_to`).
+
+Tombstones are upserted on (`transient_id`, `deleted`), so retrying a
+failed chunk does not store them twice. Old tombstones expire through a
+TTL index (`tombstone.ttl`, see `m3 create_index`) or are removed with
+`m3 prune`.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+import logging
+
+from pymongo import UpdateOne
+
+from mad3.db import get_db
+
+lg = logging.getLogger(__name__)
+
+TOMBSTONE_FIELDS = ['filename', 'hostname', 'sha256', 'size']
+
+
+class Deleter:
+    """Collect transient ids, and remove them in chunks."""
+
+    def __init__(self, app, chunk: int=1000, window: int=0) -> None:
+        """Prepare removing records in chunks of `chunk` records.
+
+        Up to `window` records can be held back, see `hold`.
+        """
+        self.app = app
+        self.chunk = chunk
+        self.window = window
+        self.db = get_db(app)
+        self.ids = []          # type: list
+        self.moved = {}        # type: dict
+        # deletion time of a chunk, kept until the chunk is removed
+        self.deleted = None    # type: datetime
+        # held id -> filename, in the order they were held
+        self.held = OrderedDict()   # type: OrderedDict
+
+    def hold(self, _id, filename: str):
+        """Schedule the removal of a transient record, but keep it for now.
+
+        Held records stay in the database until `close`, so a file that
+        is found later under a new name can still be matched to it (see
+        `mad3.moves`). Beyond `window` held records, the oldest are
+        removed.
+        """
+        self.held[_id] = filename
+        while len(self.held) > self.window:
+            self.add(self.held.popitem(last=False)[0])
+
+    def resume_position(self, position: str) -> str:
+        """Return a position to resume a walk from that sees all held records.
+
+        Records are held in walk order, so only the first one matters.
+        """
+        if not self.held:
+            return position
+        # anything sorting just before the first held filename
+        first = next(iter(self.held.values()))[:-1]
+        return first if position is None else min(position, first)
+
+    def add(self, _id, moved_to: str=None):
+        """Schedule the removal of a transient record."""
+        self.held.pop(_id, None)
+        self.ids.append(_id)
+        if moved_to is not None:
+            self.moved[_id] = moved_to
+        if len(self.ids) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        """Remove the scheduled records, and store their tombstones."""
+        if not self.ids:
+            return
+        ids, self.ids = self.ids, []
+        moved, self.moved = self.moved, {}
+        try:
+            n = self._remove(ids, moved)
+        except Exception:
+            # keep the chunk, a retry reuses its deletion time
+            moved.update(self.moved)
+            self.ids, self.moved = ids + self.ids, moved
+            raise
+        self.deleted = None
+        self.app.counter['rm'] += n
+        lg.debug("removed %d records", len(ids))
+
+    def _remove(self, ids: list, moved: dict) -> int:
+        """Store the tombstones of `ids` and remove the records.
+
+        Return the number of removed records that were not moved.
+        """
+        if moved and getattr(self.app, 'bulk_transient', None) is not None:
+            # store the new records of moved files before the old go
+            self.app.bulk_transient.flush()
+        if self.deleted is None:
+            self.deleted = datetime.utcnow()
+        ops = []
+        n = 0
+        for rec in self.db.transient.find({'_id': {'$in': ids}},
+                                          projection=TOMBSTONE_FIELDS):
+            tid = rec.pop('_id')
+            moved_to = moved.get(tid)
+            if moved_to is not None:
+                rec['moved_to'] = moved_to
+            else:
+                n += 1
+            ops.append(UpdateOne({'transient_id': tid,
+                                  'deleted': self.deleted},
+                                 {'$set': rec}, upsert=True))
+        if ops:
+            self.db.tombstone.bulk_write(ops, ordered=False)
+        self.db.transient.remove({'_id': {'$in': ids}})
+        return n
+
+    def close(self):
+        """Remove what is left, including the held records."""
+        for _id in list(self.held):
+            self.add(_id)
+        self.flush()
+
+
+def get_deleter(app) -> Deleter:
+    """Return a deleter with the configured chunk size and move window."""
+    conf = app.conf['scan']
+    return Deleter(app, chunk=int(conf['delete_chunk']),
+                   window=int(conf['move_window']))
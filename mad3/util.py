@@ -1,4 +1,5 @@
 
+from collections import Counter
 from datetime import datetime, timedelta
 import hashlib
 import logging
@@ -6,11 +7,10 @@ import math
 import os
 import pickle
 import sys
+import threading
 from typing import Type
 import uuid
 
-import leip
-
 
 lg = logging.getLogger(__name__)
 
@@ -70,6 +70,41 @@ def nicesize(val: int,
     return str(val)
 
 
+def parse_size(val: str) -> int:
+    """Convert a size like `500`, `20M` or `1.5Tb` to a number of bytes."""
+    val = str(val).strip().upper().rstrip('B')
+    for pw, metric in [(15, 'P'), (12, 'T'), (9, 'G'), (6, 'M'), (3, 'K')]:
+        if val.endswith(metric):
+            return int(float(val[:-1]) * (10 ** pw))
+    return int(float(val))
+
+
+def parse_duration(val: str) -> float:
+    """Convert a duration like `90`, `30m`, `8h` or `2d` to seconds."""
+    val = str(val).strip().lower()
+    for unit, seconds in [('d', 86400), ('h', 3600), ('m', 60), ('s', 1)]:
+        if val.endswith(unit):
+            return float(val[:-1]) * seconds
+    return float(val)
+
+
+class SafeCounter(Counter):
+    """Counter that can be incremented from several threads.
+
+    `counter[key] += n` is a read and a write, so increments from
+    worker threads use `incr`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def incr(self, key, n=1):
+        """Add n to key (atomically)."""
+        with self._lock:
+            self[key] += n
+
+
 def get_random_sha256():
     """Return a random 64 byte string equivalent to a sha256."""
     tid = hashlib.sha256()
@@ -115,32 +150,6 @@ datasetter = dict(one=setone,
                   set=setset)
 
 
-def key_info(conf, key):
-
-    if isinstance(conf, leip.app):
-        # in case we get the app (and not app.conf)
-        conf = conf.conf
-
-    info = conf['keywords'].get(key)
-
-    if info is None:
-        lg.warning("Bad key: {}".format(key))
-        exit(-1)
-
-    if info is None:
-        return info
-
-    if 'alias' in info:
-        return key_info(conf, info['alias'])
-
-    info['shape'] = str(info.get('shape', 'one'))
-    info['cat'] = info.get('cat', ['transient', 'core'])
-    info['type'] = info.get('type', 'str')
-    info['transformer'] = datatypes.get(info['type'], str)
-    info['setter'] = datasetter.get(info['shape'], setone)
-    return key, info
-
-
 def persistent_cache(path, cache_on, duration):
     """
     Disk persistent cache that reruns a function once every
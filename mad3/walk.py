@@ -0,0 +1,259 @@
+"""
+Parallel filesystem walker.
+
+Lists directories concurrently (os.scandir releases the GIL while
+waiting on the filesystem, which is what matters on NFS) and prunes
+directories matching `~/.madignore` instead of filtering afterwards.
+"""
+
+import logging
+import os
+import queue
+import re
+import threading
+
+lg = logging.getLogger(__name__)
+
+MADIGNORE = '~/.madignore'
+
+# marks the end of the walk on the output queue
+_DONE = object()
+
+
+def load_ignore(path: str=MADIGNORE):
+    """Compile the patterns in a madignore file into a single regex.
+
+    One pattern per line, matched anywhere in the path (like the
+    `grep -v -f ~/.madignore` this replaces). Returns None if there is
+    no ignore file or it has no patterns.
+    """
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return None
+
+    patterns = []
+    with open(path) as F:
+        for line in F:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            try:
+                re.compile(line)
+            except re.error:
+                lg.warning("invalid madignore pattern, matching literally: %s",
+                           line)
+                line = re.escape(line)
+            patterns.append('(?:{})'.format(line))
+
+    if not patterns:
+        return None
+    return re.compile('|'.join(patterns))
+
+
+def dirsignature(st) -> tuple:
+    """Return the change signature of a directory stat result.
+
+    Adding, removing or renaming an entry updates both mtime and ctime.
+    """
+    return (st.st_mtime_ns, st.st_ctime_ns)
+
+
+class Walker:
+    """Walk a directory tree with a pool of listing threads.
+
+    Iterating yields `(path, stat_result)` for every regular file
+    (symlinks are not followed, as with `find -type f`). Files arrive in
+    no particular order.
+    """
+
+    def __init__(self, basedir: str, threads: int=8, ignore=None,
+                 buffer: int=256, dircache: dict=None,
+                 recursive: bool=True, governor=None,
+                 on_dir=None) -> None:
+        """Prepare the walk - nothing happens until iteration.
+
+        `dircache` maps directory names to a `(signature, subdirs)`
+        tuple from an earlier walk. Directories with an unchanged
+        signature are not listed again; their files are not reported,
+        and the walk continues into the known subdirectories. Those
+        directories are collected in `skipped`.
+
+        If `recursive` is False, only the files directly in basedir are
+        reported. With a `governor`, each file stat is charged against
+        its `stat` limit. `on_dir(dirname)` is called for every
+        directory right before it is listed (possibly from several
+        threads).
+        """
+        self.basedir = os.path.abspath(basedir)
+        self.threads = max(1, threads)
+        self.ignore = ignore
+        self.buffer = buffer
+        self.dircache = dircache
+        self.recursive = recursive
+        self.governor = governor
+        self.on_dir = on_dir
+
+        # directory -> (signature, subdir names) of this walk
+        self.dirstate = {}     # type: dict
+        self.skipped = set()   # type: set
+
+        # statistics
+        self.dirs = 0
+        self.pruned = 0
+        self.errors = 0
+
+    def ignored(self, path: str, isdir: bool=False) -> bool:
+        """Does a madignore pattern match this path?
+
+        Directories are matched with a trailing slash so that a pattern
+        like `/\\.git/` prunes the whole subtree.
+        """
+        if self.ignore is None:
+            return False
+        if isdir:
+            path += '/'
+        return self.ignore.search(path) is not None
+
+    def listdir(self, dirname: str):
+        """List one directory, return (files, subdirs)."""
+        files = []
+        subdirs = []
+
+        if self.on_dir is not None:
+            self.on_dir(dirname)
+
+        try:
+            # stat before listing: a change during the listing then
+            # shows up as a changed signature on the next walk
+            signature = dirsignature(os.stat(dirname))
+        except OSError as e:
+            lg.debug("cannot stat %s: %s", dirname, e)
+            self.errors += 1
+            return files, subdirs
+
+        if self.dircache is not None:
+            cached = self.dircache.get(dirname)
+            if cached is not None and cached[0] == signature:
+                self.skipped.add(dirname)
+                self.dirstate[dirname] = cached
+                # the ignore patterns may have changed since
+                for d in cached[1]:
+                    path = os.path.join(dirname, d)
+                    if self.ignored(path, isdir=True):
+                        self.pruned += 1
+                    else:
+                        subdirs.append(path)
+                return files, subdirs
+
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.ignored(entry.path, isdir=True):
+                                self.pruned += 1
+                                continue
+                            subdirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            if self.ignored(entry.path):
+                                continue
+                            if self.governor is not None:
+                                self.governor.take('stat')
+                            files.append(
+                                (entry.path,
+                                 entry.stat(follow_symlinks=False)))
+                    except OSError as e:
+                        # vanished while listing, or no access
+                        lg.debug("cannot stat %s: %s", entry.path, e)
+                        self.errors += 1
+        except OSError as e:
+            lg.debug("cannot list %s: %s", dirname, e)
+            self.errors += 1
+            return files, subdirs
+
+        self.dirstate[dirname] = (
+            signature, [os.path.basename(d) for d in subdirs])
+        return files, subdirs
+
+    def sorted(self, after: str=None):
+        """Yield (path, stat_result) for each file, sorted by path.
+
+        Directories are listed one at a time, depth first, so only the
+        listings of the directories on the current path are held in
+        memory. Subdirectories sort as `name/`, which makes the output
+        order equal to a plain string sort of the full paths.
+
+        With `after`, only paths sorting after it are yielded, and
+        subtrees that sort before it entirely are not listed.
+        """
+        yield from self._sorted(self.basedir, after)
+
+    def _sorted(self, dirname: str, after: str=None):
+        files, subdirs = self.listdir(dirname)
+        self.dirs += 1
+        entries = [(os.path.basename(path), path, st) for path, st in files]
+        if self.recursive:
+            entries.extend((os.path.basename(path) + '/', path, None)
+                           for path in subdirs)
+        entries.sort(key=lambda x: x[0])
+        for name, path, st in entries:
+            if st is None:
+                # all paths below sort before `path + '0'` ('0' follows '/')
+                if after is None or after < path + '0':
+                    yield from self._sorted(path, after)
+            elif after is None or path > after:
+                yield path, st
+
+    def __iter__(self):
+        """Yield (path, stat_result) for each file below basedir."""
+        dirq = queue.Queue()     # type: queue.Queue
+        outq = queue.Queue(maxsize=self.buffer)     # type: queue.Queue
+        stop = threading.Event()
+        lock = threading.Lock()
+        pending = [1]
+
+        def worker():
+            while True:
+                dirname = dirq.get()
+                if dirname is None:
+                    return
+                if not stop.is_set():
+                    files, subdirs = self.listdir(dirname)
+                    if not self.recursive:
+                        subdirs = []
+                    with lock:
+                        self.dirs += 1
+                        pending[0] += len(subdirs)
+                    for subdir in subdirs:
+                        dirq.put(subdir)
+                    if files:
+                        outq.put(files)
+                with lock:
+                    pending[0] -= 1
+                    done = pending[0] == 0
+                if done:
+                    outq.put(_DONE)
+
+        workers = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(self.threads)]
+        for w in workers:
+            w.start()
+
+        dirq.put(self.basedir)
+        try:
+            while True:
+                batch = outq.get()
+                if batch is _DONE:
+                    break
+                yield from batch
+        finally:
+            # also reached when the consumer stops early: unblock
+            # the listing threads and let them exit
+            stop.set()
+            for _ in workers:
+                dirq.put(None)
+            while any(w.is_alive() for w in workers):
+                try:
+                    outq.get(timeout=0.05)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,103 @@
+"""Tests on the parallel filesystem walker."""
+
+import os
+
+import pytest
+
+from mad3.walk import Walker, load_ignore
+
+
+@pytest.fixture(scope='module')
+def testtree():
+    import tempfile
+    import shutil
+    testdir = tempfile.mkdtemp('m3_test')
+    for sub in ['a', 'a/b', 'a/.git', 'c']:
+        os.makedirs(os.path.join(testdir, sub))
+    for fn in ['x.txt', 'a/y.txt', 'a/b/z.txt', 'a/.git/HEAD',
+               'c/skip.tmp']:
+        with open(os.path.join(testdir, fn), 'w') as F:
+            F.write(fn)
+    yield testdir
+    shutil.rmtree(testdir)
+
+
+def test_walk_all(testtree):
+    found = sorted(os.path.relpath(p, testtree)
+                   for p, st in Walker(testtree, threads=3))
+    assert found == ['a/.git/HEAD', 'a/b/z.txt', 'a/y.txt',
+                     'c/skip.tmp', 'x.txt']
+
+
+def test_walk_stat(testtree):
+    for p, st in Walker(testtree):
+        assert st.st_size == len(os.path.relpath(p, testtree))
+
+
+def test_walk_ignore(testtree, tmpdir):
+    ignorefile = str(tmpdir.join('madignore'))
+    with open(ignorefile, 'w') as F:
+        F.write('/\\.git/\n\\.tmp$\n')
+    walker = Walker(testtree, ignore=load_ignore(ignorefile))
+    found = sorted(os.path.relpath(p, testtree) for p, st in walker)
+    assert found == ['a/b/z.txt', 'a/y.txt', 'x.txt']
+    assert walker.pruned == 1
+
+
+def test_walk_no_ignorefile(tmpdir):
+    assert load_ignore(str(tmpdir.join('nothere'))) is None
+
+
+def test_walk_dircache(testtree):
+    first = Walker(testtree)
+    assert len(list(first)) == 5
+    assert len(first.dirstate) == 5
+
+    # nothing changed: no files are listed, all dirs are skipped
+    second = Walker(testtree, dircache=first.dirstate)
+    assert list(second) == []
+    assert second.skipped == set(first.dirstate)
+
+    # a new file only causes its own directory to be listed
+    newfile = os.path.join(testtree, 'a', 'b', 'new.txt')
+    with open(newfile, 'w') as F:
+        F.write('new')
+    try:
+        third = Walker(testtree, dircache=second.dirstate)
+        found = sorted(os.path.relpath(p, testtree) for p, st in third)
+        assert found == ['a/b/new.txt', 'a/b/z.txt']
+        assert os.path.join(testtree, 'a', 'b') not in third.skipped
+    finally:
+        os.unlink(newfile)
+
+
+def test_walk_dircache_ignore(testtree, tmpdir):
+    first = Walker(testtree)
+    list(first)
+    ignorefile = str(tmpdir.join('madignore'))
+    with open(ignorefile, 'w') as F:
+        F.write('/a/b/\n')
+    # cached subdirectories are still pruned
+    second = Walker(testtree, ignore=load_ignore(ignorefile),
+                    dircache=first.dirstate)
+    assert list(second) == []
+    assert os.path.join(testtree, 'a', 'b') not in second.skipped
+    assert os.path.join(testtree, 'a', '.git') in second.skipped
+    assert second.pruned == 1
+
+
+def test_walk_sorted(testtree):
+    found = [p for p, st in Walker(testtree).sorted()]
+    assert found == sorted(found)
+    assert len(found) == 5
+
+
+def test_walk_sorted_after(testtree):
+    found = [p for p, st in Walker(testtree).sorted()]
+    for i, after in enumerate(found):
+        walker = Walker(testtree)
+        assert [p for p, st in walker.sorted(after=after)] == found[i + 1:]
+    # the .git subtree sorts before a/b/z.txt, it is not listed
+    walker = Walker(testtree)
+    list(walker.sorted(after=found[2]))
+    assert os.path.join(testtree, 'a', '.git') not in walker.dirstate
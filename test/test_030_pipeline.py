@@ -0,0 +1,41 @@
+"""Tests on the staged pipeline."""
+
+from mad3.pipeline import Pipeline, Stage
+
+
+def test_pipeline_stages():
+    pipeline = Pipeline(maxsize=2)
+    q1 = pipeline.queue()
+    q2 = pipeline.queue()
+    result = []
+
+    pipeline.add(Stage('source', source=range(100), outq=q1))
+    pipeline.add(Stage('square', lambda x: x * x, inq=q1, outq=q2,
+                       workers=4))
+    pipeline.add(Stage('collect', result.append, inq=q2))
+    pipeline.run()
+
+    assert sorted(result) == [x * x for x in range(100)]
+    assert set(pipeline.rates()) == {'source', 'square', 'collect'}
+    assert pipeline.stages[1].count == 100
+
+
+def test_pipeline_drop_and_error():
+    pipeline = Pipeline()
+    q1 = pipeline.queue()
+    result = []
+
+    def odd(x):
+        if x == 5:
+            raise ValueError(x)
+        return x if x % 2 else None
+
+    pipeline.add(Stage('source', odd, source=range(10), outq=q1))
+    pipeline.add(Stage('collect', result.append, inq=q1))
+    try:
+        pipeline.run()
+    except ValueError:
+        pass
+    else:
+        assert False, 'stage error not raised'
+    assert sorted(result) == [1, 3, 7, 9]
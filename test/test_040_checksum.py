@@ -0,0 +1,286 @@
+"""Tests on the checksum engine."""
+
+import errno
+import hashlib
+import os
+import threading
+
+import pytest
+
+import mad3.db
+from mad3.checksum import (BACKENDS, ChecksumEngine, InodeCache, checksum,
+                           digest, fingerprint, parse_digests)
+from mad3.plugin.backfill import budget_records, quick_records
+from mad3.util import SafeCounter, parse_duration, parse_size
+
+
+@pytest.fixture(scope='module')
+def testfiles(tmpdir_factory):
+    testdir = tmpdir_factory.mktemp('m3_test')
+    rv = []
+    for i in range(5):
+        fn = testdir.join('f{}.bin'.format(i))
+        fn.write_binary(bytes(range(256)) * (i * 5000 + 1))
+        rv.append(str(fn))
+    return rv
+
+
+def _expected(filename):
+    with open(filename, 'rb') as F:
+        data = F.read()
+    return (hashlib.sha1(data).hexdigest(),
+            hashlib.sha256(data).hexdigest(), len(data))
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_checksum(testfiles, backend):
+    for fn in testfiles:
+        assert checksum(fn, blocksize=4096, backend=backend) \
+            == _expected(fn)
+
+
+def test_direct_unaligned(testfiles):
+    sha1, sha256, size = _expected(testfiles[2])
+    assert digest(testfiles[2], blocksize=4097, backend='direct') \
+        == ({'sha1': sha1, 'sha256': sha256}, size)
+
+
+def test_direct_einval(testfiles, monkeypatch):
+    def refuse(F, blocksize):
+        raise OSError(errno.EINVAL, 'Invalid argument')
+        yield
+
+    monkeypatch.setitem(BACKENDS, 'direct', (BACKENDS['direct'][0] or 1,
+                                             refuse))
+    monkeypatch.setattr('mad3.checksum._open',
+                        lambda fn, backend: open(fn, 'rb', buffering=0))
+    assert digest(testfiles[1], backend='direct')[0]['sha256'] \
+        == _expected(testfiles[1])[1]
+
+
+def test_digest_throttle(testfiles):
+    blocks = []
+    digest(testfiles[4], blocksize=4096, throttle=blocks.append)
+    assert sum(blocks) == os.path.getsize(testfiles[4])
+    assert max(blocks) == 4096
+
+
+def test_checksum_empty(tmpdir):
+    empty = tmpdir.join('empty')
+    empty.write_binary(b'')
+    for backend in BACKENDS:
+        assert checksum(str(empty), backend=backend) == _expected(str(empty))
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_engine(testfiles, pool):
+    engine = ChecksumEngine(workers=3, pool=pool)
+    try:
+        result = list(engine.map(engine.checksum, testfiles))
+    finally:
+        engine.shutdown()
+    assert result == [_expected(fn) for fn in testfiles]
+
+
+def test_hardlinks(testfiles, tmpdir):
+    links = []
+    for i in range(4):
+        link = str(tmpdir.join('link{}'.format(i)))
+        os.link(testfiles[3], link)
+        links.append(link)
+
+    counter = SafeCounter()
+    engine = ChecksumEngine(workers=3, inodes=InodeCache(counter=counter))
+    try:
+        result = list(engine.map(
+            lambda fn: engine.checksum(fn, os.stat(fn)), links))
+    finally:
+        engine.shutdown()
+
+    sha1, sha256, size = _expected(testfiles[3])
+    assert [r[:2] for r in result] == [(sha1, sha256)] * 4
+    # read once, reused three times
+    assert sum(r[2] for r in result) == size
+    assert counter['linkreuse'] == 3
+    assert counter['linksaved_sz'] == 3 * size
+
+
+def test_inode_cache_persist(testfiles, tmpdir):
+    path = str(tmpdir.join('cache', 'inodes'))
+    st = os.stat(testfiles[1])
+    expected = _expected(testfiles[1])
+
+    cache = InodeCache(path=path)
+    assert cache.checksum(st, lambda: expected) == expected
+    cache.close()
+
+    cache = InodeCache(path=path)
+    assert cache.checksum(st, lambda: 1 / 0) == expected[:2] + (0,)
+    cache.close()
+
+
+def test_fingerprint(tmpdir):
+    data = bytearray(range(256)) * 4096
+    a = tmpdir.join('a')
+    a.write_binary(bytes(data))
+    fp = fingerprint(str(a), blocksize=1024, samples=4)
+
+    # same content, same fingerprint
+    b = tmpdir.join('b')
+    b.write_binary(bytes(data))
+    assert fingerprint(str(b), blocksize=1024, samples=4) == fp
+
+    # a change in an unsampled region goes unnoticed ...
+    data[2000] ^= 0xff
+    b.write_binary(bytes(data))
+    assert fingerprint(str(b), blocksize=1024, samples=4) == fp
+
+    # ... but a change in the head, tail or size does not
+    for pos in (0, len(data) - 1):
+        changed = bytearray(data)
+        changed[pos] ^= 0xff
+        b.write_binary(bytes(changed))
+        assert fingerprint(str(b), blocksize=1024, samples=4) != fp
+    b.write_binary(bytes(data[:-1]))
+    assert fingerprint(str(b), blocksize=1024, samples=4) != fp
+
+
+def test_digest(testfiles):
+    data = open(testfiles[2], 'rb').read()
+    digests, size = digest(testfiles[2], ('sha256', 'blake2b', 'md5'),
+                           blocksize=4096)
+    assert size == len(data)
+    assert digests == {'sha256': hashlib.sha256(data).hexdigest(),
+                       'blake2b': hashlib.blake2b(data).hexdigest(),
+                       'md5': hashlib.md5(data).hexdigest()}
+
+    assert parse_digests('blake2b') == ('blake2b', 'sha256')
+    with pytest.raises(ValueError):
+        parse_digests(['sha256', 'crc'])
+
+
+def test_engine_digests(testfiles, tmpdir):
+    link = str(tmpdir.join('link'))
+    os.link(testfiles[1], link)
+    engine = ChecksumEngine(workers=2, digests=['sha256'],
+                            inodes=InodeCache())
+    try:
+        digests, _ = engine.digest(link, os.stat(link))
+        # the inode cache holds the engine's digest set only
+        other, _ = engine.digest(link, os.stat(link), digests=['sha1'])
+    finally:
+        engine.shutdown()
+    sha1, sha256, _ = _expected(testfiles[1])
+    assert digests == {'sha256': sha256}
+    assert other == {'sha1': sha1}
+
+
+def test_safe_counter():
+    counter = SafeCounter()
+
+    def count():
+        for _ in range(10000):
+            counter.incr('n')
+            counter.incr('sz', 2)
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert counter == {'n': 40000, 'sz': 80000}
+
+
+class FakeCursor(list):
+    closed = False
+
+    def sort(self, keys):
+        for key, direction in reversed(keys):
+            super().sort(key=lambda r: r[key], reverse=direction < 0)
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransient:
+    def __init__(self, recs):
+        self.recs = recs
+
+    def find(self, query, no_cursor_timeout=False):
+        self.query = query
+        self.cursor = FakeCursor(
+            r for r in self.recs
+            if all(r.get(k) == v for k, v in query.items()
+                   if not isinstance(v, dict)))
+        return self.cursor
+
+
+class FakeDB:
+    def __init__(self, recs):
+        self.transient = FakeTransient(recs)
+
+
+class FakeApp:
+    def __init__(self):
+        self.conf = {'hostname': 'testhost'}
+        self.counter = SafeCounter()
+
+
+@pytest.fixture
+def backfill_app(monkeypatch):
+    recs = [{'filename': '/d/{}'.format(i), 'size': size,
+             'mtime': 10 - i, 'sha256': '0' if i != 2 else 'abc',
+             'hostname': 'testhost'}
+            for i, size in enumerate([30, 10, 5, 20, 40])]
+    monkeypatch.setattr(mad3.db, 'CLIENT', object())
+    monkeypatch.setattr(mad3.db, 'DB', FakeDB(recs))
+    return FakeApp()
+
+
+def _names(recs):
+    return [r['filename'][3:] for r in recs]
+
+
+def test_quick_records_order(backfill_app):
+    app = backfill_app
+    assert _names(quick_records(app, '/d')) == ['1', '3', '0', '4']
+    assert _names(quick_records(app, '/d', order='large')) \
+        == ['4', '0', '3', '1']
+    assert _names(quick_records(app, '/d', order='oldest')) \
+        == ['4', '3', '1', '0']
+    query = mad3.db.DB.transient.query
+    assert query['sha256'] == '0'
+    assert query['filename'] == {'$regex': '^/d/'}
+
+
+def test_quick_records_budget(backfill_app):
+    app = backfill_app
+    # stops before the file that does not fit
+    assert _names(quick_records(app, '/d', max_bytes=45)) == ['1', '3']
+    assert app.counter['budget_sz'] == 1
+    assert mad3.db.DB.transient.cursor.closed
+    assert _names(quick_records(app, '/d', max_time=-1)) == []
+    assert app.counter['budget_time'] == 1
+
+
+def test_budget_records(backfill_app):
+    app = backfill_app
+    recs = budget_records(app, '/d', {'sha256': 'abc'}, order='path')
+    assert _names(recs) == ['2']
+
+
+def test_parse_size():
+    assert parse_size('500') == 500
+    assert parse_size(500) == 500
+    assert parse_size('20M') == 20 * 10 ** 6
+    assert parse_size('1.5Tb') == 15 * 10 ** 11
+    assert parse_size(' 2k ') == 2000
+
+
+def test_parse_duration():
+    assert parse_duration('90') == 90
+    assert parse_duration('30m') == 1800
+    assert parse_duration('8H') == 8 * 3600
+    assert parse_duration('1.5d') == 1.5 * 86400
+    assert parse_duration('10s') == 10
@@ -0,0 +1,51 @@
+"""Tests on the streaming filesystem/database comparison."""
+
+from datetime import datetime
+import os
+
+from mad3.diff import (SIGNATURE, content_changed, merge_join, signature,
+                       unchanged)
+
+
+def test_merge_join():
+    fs = [('/a', 1, 1), ('/b', 1, 1), ('/d', 2, 2)]
+    db = [{'filename': '/b'}, {'filename': '/c'}, {'filename': '/d'},
+          {'filename': '/e'}]
+    result = [(f and f[0], d and d['filename'])
+              for f, d in merge_join(fs, db)]
+    assert result == [('/a', None), ('/b', '/b'), (None, '/c'),
+                      ('/d', '/d'), (None, '/e')]
+
+
+def test_merge_join_empty():
+    assert list(merge_join([], [])) == []
+    assert list(merge_join([('/a', 1, 1)], [])) == [(('/a', 1, 1), None)]
+
+
+def test_signature(tmpdir):
+    fn = tmpdir.join('a')
+    fn.write('hello')
+    st = os.stat(str(fn))
+    rec = dict(zip(SIGNATURE, signature(st)))
+    assert unchanged((str(fn),) + signature(st), rec)
+    assert not content_changed(rec, st)
+
+    # permission changes only touch ctime
+    fn.chmod(0o600)
+    st = os.stat(str(fn))
+    assert not unchanged((str(fn),) + signature(st), rec)
+    assert not content_changed(rec, st)
+
+    # a sub-second mtime change is noticed
+    os.utime(str(fn), ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert content_changed(rec, os.stat(str(fn)))
+
+
+def test_content_changed_legacy(tmpdir):
+    fn = tmpdir.join('a')
+    fn.write('hello')
+    st = os.stat(str(fn))
+    rec = {'size': 5, 'mtime': datetime.fromtimestamp(int(st.st_mtime))}
+    assert not content_changed(rec, st)
+    rec['size'] = 6
+    assert content_changed(rec, st)
@@ -0,0 +1,239 @@
+"""Tests on move detection and record removal with tombstones."""
+
+import os
+
+import pytest
+
+import mad3.db
+import mad3.tombstone
+from mad3.diff import SIGNATURE, signature
+from mad3.madfile import transient_id
+from mad3.moves import detect_moves, find_moves
+from mad3.tombstone import Deleter
+from mad3.util import SafeCounter
+
+
+def _match(doc, query):
+    for k, v in query.items():
+        if isinstance(v, dict) and '$in' in v:
+            if doc.get(k) not in v['$in']:
+                return False
+        elif doc.get(k) != v:
+            return False
+    return True
+
+
+class FakeCollection:
+    def __init__(self, db):
+        self.db = db
+        self.docs = {}
+
+    def find(self, query, projection=None):
+        for doc in list(self.docs.values()):
+            if _match(doc, query):
+                if projection is None:
+                    yield dict(doc)
+                else:
+                    yield {k: doc[k] for k in ['_id'] + list(projection)
+                           if k in doc}
+
+    def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            doc.setdefault('_id', len(self.docs))
+            self.docs[doc['_id']] = dict(doc)
+
+    def bulk_write(self, ops, ordered=True):
+        for query, update, upsert in ops:
+            doc = next(self.find(query), None)
+            if doc is None:
+                assert upsert
+                doc = dict(query, _id=len(self.docs))
+            doc.update(update['$set'])
+            self.docs[doc['_id']] = doc
+
+    def remove(self, query):
+        if self.db.fail:
+            self.db.fail -= 1
+            raise IOError('connection lost')
+        self.db.removed.append(sorted(self.docs))
+        for _id in [d['_id'] for d in self.find(query)]:
+            del self.docs[_id]
+
+
+class FakeDB:
+    def __init__(self):
+        self.removed = []
+        self.fail = 0
+        self.transient = FakeCollection(self)
+        self.tombstone = FakeCollection(self)
+
+
+class FakeBulk:
+    def __init__(self, coll):
+        self.coll = coll
+        self.ops = []
+
+    def upsert(self, _id, update):
+        self.ops.append((_id, update))
+
+    def flush(self):
+        for _id, update in self.ops:
+            doc = self.coll.docs.setdefault(_id, {'_id': _id})
+            doc.update(update['$set'])
+        self.ops = []
+
+
+class FakeApp:
+    def __init__(self, db):
+        self.conf = {'hostname': 'testhost'}
+        self.counter = SafeCounter()
+        self.bulk_transient = FakeBulk(db.transient)
+
+    def bulk_upsert(self, collection, _id, update):
+        assert collection == 'transient'
+        self.bulk_transient.upsert(_id, update)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(mad3.db, 'CLIENT', object())
+    monkeypatch.setattr(mad3.db, 'DB', db)
+    monkeypatch.setattr(mad3.tombstone, 'UpdateOne',
+                        lambda query, update, upsert: (query, update, upsert))
+    return db
+
+
+def _fsrec(path):
+    return (path,) + signature(os.stat(path))
+
+
+def _record(app, db, filename, fsrec, **kwargs):
+    rec = dict(zip(SIGNATURE, fsrec[1:]), _id=transient_id(app, filename),
+               filename=filename, hostname='testhost', sha256='abc')
+    rec.update(kwargs)
+    db.transient.docs[rec['_id']] = rec
+    return rec
+
+
+def test_find_moves(db, tmpdir):
+    app = FakeApp(db)
+    new = tmpdir.join('new')
+    new.write('hello')
+    fsrec = _fsrec(str(new))
+    old = _record(app, db, str(tmpdir.join('old')), fsrec)
+    _record(app, db, str(tmpdir.join('other')), fsrec, ino=fsrec[4] + 1)
+    moves = find_moves(app, [fsrec])
+    assert list(moves) == [str(new)]
+    assert moves[str(new)]['_id'] == old['_id']
+    assert find_moves(app, []) == {}
+
+
+def test_find_moves_hardlink(db, tmpdir):
+    app = FakeApp(db)
+    old = tmpdir.join('old')
+    old.write('hello')
+    os.link(str(old), str(tmpdir.join('new')))
+    fsrec = _fsrec(str(tmpdir.join('new')))
+    _record(app, db, str(old), fsrec)
+    # the old name still exists: a new hardlink, not a move
+    assert find_moves(app, [fsrec]) == {}
+
+
+def test_detect_moves(db, tmpdir):
+    app = FakeApp(db)
+    moved = tmpdir.join('moved')
+    moved.write('hello')
+    other = tmpdir.join('other')
+    other.write('world')
+    fsrecs = [_fsrec(str(moved)), _fsrec(str(other))]
+    old = _record(app, db, str(tmpdir.join('old')), fsrecs[0],
+                  sha256='x', project='p')
+    deleter = Deleter(app, chunk=10)
+
+    rv = detect_moves(app, fsrecs, deleter)
+    assert rv == {str(moved): old['_id']}
+    assert app.counter['moved'] == 1
+    deleter.close()
+
+    new_id = transient_id(app, str(moved))
+    # the new record was stored before the old one was removed
+    assert new_id in db.removed[0]
+    assert list(db.transient.docs) == [new_id]
+    rec = db.transient.docs[new_id]
+    assert rec['filename'] == str(moved)
+    assert (rec['sha256'], rec['project']) == ('x', 'p')
+    tombstone, = db.tombstone.docs.values()
+    assert tombstone['transient_id'] == old['_id']
+    assert tombstone['moved_to'] == str(moved)
+    assert app.counter['rm'] == 0
+
+
+def test_detect_moves_plan(db, tmpdir):
+    app = FakeApp(db)
+    moved = tmpdir.join('moved')
+    moved.write('hello')
+    fsrec = _fsrec(str(moved))
+    old = _record(app, db, str(tmpdir.join('old')), fsrec)
+    # without a deleter, moves are only reported
+    assert detect_moves(app, [fsrec]) == {str(moved): old['_id']}
+    assert list(db.transient.docs) == [old['_id']]
+    assert app.bulk_transient.ops == []
+
+
+def test_deleter_chunks(db):
+    app = FakeApp(db)
+    for i in range(5):
+        db.transient.docs[i] = {'_id': i, 'filename': '/d/{}'.format(i),
+                                'hostname': 'testhost', 'size': i}
+    deleter = Deleter(app, chunk=2)
+    for i in range(5):
+        deleter.add(i)
+    assert len(db.removed) == 2
+    deleter.close()
+    assert len(db.removed) == 3
+    assert db.transient.docs == {}
+    assert sorted(t['transient_id'] for t in db.tombstone.docs.values()) \
+        == list(range(5))
+    assert app.counter['rm'] == 5
+
+
+def test_deleter_hold(db):
+    app = FakeApp(db)
+    for i in 'abcd':
+        db.transient.docs[i] = {'_id': i, 'filename': '/d/' + i}
+    deleter = Deleter(app, chunk=1, window=2)
+    for i in 'abc':
+        deleter.hold(i, '/d/' + i)
+    # beyond the window, the oldest record is removed
+    assert sorted(db.transient.docs) == ['b', 'c', 'd']
+    assert deleter.resume_position('/d/z') == '/d/'
+    assert deleter.resume_position('/a') == '/a'
+
+    deleter.add('b', moved_to='/d/x')
+    assert list(deleter.held) == ['c']
+    deleter.close()
+    assert sorted(db.transient.docs) == ['d']
+    assert deleter.resume_position('/d/z') == '/d/z'
+    assert app.counter['rm'] == 2
+
+
+def test_deleter_retry(db):
+    app = FakeApp(db)
+    for i in range(3):
+        db.transient.docs[i] = {'_id': i, 'filename': '/d/{}'.format(i)}
+    deleter = Deleter(app, chunk=10)
+    for i in range(3):
+        deleter.add(i)
+    db.fail = 1
+    with pytest.raises(IOError):
+        deleter.flush()
+    assert len(db.tombstone.docs) == 3
+    assert app.counter['rm'] == 0
+    # the retry does not store the tombstones again
+    deleter.close()
+    assert db.transient.docs == {}
+    assert sorted(t['transient_id'] for t in db.tombstone.docs.values()) \
+        == [0, 1, 2]
+    assert len(set(t['deleted'] for t in db.tombstone.docs.values())) == 1
+    assert app.counter['rm'] == 3
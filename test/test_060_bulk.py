@@ -0,0 +1,120 @@
+"""Tests on the batched bulk writer."""
+
+import threading
+import time
+
+from mad3.bulk import BulkWriter
+from mad3.util import SafeCounter
+
+
+class FakeBulk:
+    def __init__(self, coll):
+        self.coll = coll
+        self.ops = []
+
+    def find(self, query):
+        self.query = query
+        return self
+
+    def upsert(self):
+        return self
+
+    def update(self, update):
+        self.ops.append((self.query['_id'], update))
+
+    def execute(self):
+        self.coll.batches.append(self.ops)
+
+
+class FakeCollection:
+    name = 'fake'
+
+    def __init__(self):
+        self.batches = []
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+
+class FakeApp:
+    def __init__(self):
+        self.counter = SafeCounter()
+
+
+def test_bulk_max_ops():
+    app, coll = FakeApp(), FakeCollection()
+    writer = BulkWriter(app, coll, max_ops=3)
+    for i in range(7):
+        writer.upsert(i, {'$set': {'a': i}})
+    writer.close()
+    assert [len(b) for b in coll.batches] == [3, 3, 1]
+    assert app.counter['flush'] == 3
+    assert app.counter['flush_ops'] == 7
+
+
+def test_bulk_merge_set():
+    app, coll = FakeApp(), FakeCollection()
+    writer = BulkWriter(app, coll)
+    writer.upsert('x', {'$set': {'a': 1}})
+    writer.upsert('x', {'$set': {'b': 2}})
+    writer.flush()
+    assert coll.batches == [[('x', {'$set': {'a': 1, 'b': 2}})]]
+    writer.close()
+
+
+def test_bulk_max_bytes():
+    app, coll = FakeApp(), FakeCollection()
+    writer = BulkWriter(app, coll, max_bytes=100)
+    for i in range(10):
+        writer.upsert(i, {'$set': {'a': 'x' * 40}})
+    writer.close()
+    assert len(coll.batches) > 1
+    assert sum(len(b) for b in coll.batches) == 10
+
+
+def test_bulk_conflict_order():
+    app, coll = FakeApp(), FakeCollection()
+    writer = BulkWriter(app, coll)
+    writer.upsert(1, {'$set': {'t': ['a']}})
+    writer.upsert(1, {'$set': {'size': 1}})
+    writer.upsert(1, {'$addToSet': {'t': {'$each': ['b']}}})
+    writer.close()
+    assert coll.batches == [
+        [(1, {'$set': {'t': ['a'], 'size': 1}})],
+        [(1, {'$addToSet': {'t': {'$each': ['b']}}})]]
+
+
+def test_bulk_conflict_threads():
+    app, coll = FakeApp(), FakeCollection()
+    writer = BulkWriter(app, coll)
+
+    def update(n):
+        for i in range(200):
+            writer.upsert(n, {'$set': {'t': [i]}})
+            writer.upsert(n, {'$addToSet': {'t': {'$each': [-i]}}})
+
+    threads = [threading.Thread(target=update, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    writer.close()
+    # per record, the updates arrive in the order they were made
+    for n in range(4):
+        ops = [op for b in coll.batches for _id, op in b if _id == n]
+        assert len(ops) == 400
+        for i in range(200):
+            assert ops[2 * i]['$set']['t'] == [i]
+
+
+def test_bulk_interval():
+    app, coll = FakeApp(), FakeCollection()
+    writer = BulkWriter(app, coll, interval=0.1)
+    writer.upsert(1, {'$set': {'a': 1}})
+    # written by the writer thread, without another upsert or flush
+    deadline = time.time() + 5
+    while not coll.batches and time.time() < deadline:
+        time.sleep(0.01)
+    assert coll.batches == [[(1, {'$set': {'a': 1}})]]
+    writer.close()
+    assert len(coll.batches) == 1
@@ -0,0 +1,75 @@
+"""Tests on the rate governor."""
+
+import os
+import signal
+import time
+
+from mad3.governor import Governor, TokenBucket
+
+
+def test_unlimited():
+    bucket = TokenBucket(rate=0)
+    t0 = time.monotonic()
+    for _ in range(10000):
+        bucket.take(10 ** 9)
+    assert time.monotonic() - t0 < 1
+
+
+def test_rate():
+    # 100/s with a burst of 0.1s: 50 tokens take ~0.4s
+    bucket = TokenBucket(rate=100, burst=0.1)
+    t0 = time.monotonic()
+    for _ in range(50):
+        bucket.take()
+    runtime = time.monotonic() - t0
+    assert 0.3 < runtime < 0.8
+
+
+def test_debt():
+    bucket = TokenBucket(rate=1000, burst=0)
+    assert 0.15 < bucket.take(200) < 0.25
+
+
+def test_control_file(tmpdir):
+    control = tmpdir.join('governor.yaml')
+    control.write('read: 50M\nstat: 1000\n')
+    governor = Governor({'bulk': 10}, control=str(control))
+    assert governor.limits == {'read': 50 * 10 ** 6, 'stat': 1000,
+                               'bulk': 10}
+
+    control.write('read: 0\n')
+    st = os.stat(str(control))
+    os.utime(str(control), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    governor.reload()
+    assert governor.limits['read'] == 0
+    assert governor.limits['stat'] == 1000
+
+
+def test_signal(tmpdir):
+    control = tmpdir.join('governor.yaml')
+    control.write('read: 1000\n')
+    governor = Governor(control=str(control))
+    old = signal.getsignal(signal.SIGUSR1)
+    try:
+        governor.install_signal()
+        control.write('read: 0\n')
+        # a signal while a bucket is locked must not deadlock
+        with governor.buckets['read']._lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+        assert governor.limits['read'] == 1000
+        governor.take('stat')
+        assert governor.limits['read'] == 0
+    finally:
+        signal.signal(signal.SIGUSR1, old)
+
+
+def test_share():
+    governor = Governor({'read': 1000, 'stat': 0})
+    governor.set_share(4)
+    assert governor.buckets['read'].rate == 250
+    assert governor.buckets['stat'].rate == 0
+    governor.set_limits({'read': 2000})
+    assert governor.buckets['read'].rate == 500
+    governor.set_share(0)
+    assert governor.buckets['read'].rate == 2000
+    assert governor.limits['read'] == 2000
@@ -0,0 +1,219 @@
+"""Tests on the scan progress report, plans and checkpoints."""
+
+from collections import Counter
+import io
+import json
+import time
+
+import pytest
+
+import mad3.db
+from mad3.checkpoint import (Checkpointer, checkpoint_id, clear_checkpoint,
+                             load_checkpoint)
+from mad3.plugin.scan import ordered, plan_scan
+from mad3.progress import Progress
+
+
+def test_snapshot(tmpdir):
+    counter = Counter(check=10, check_sz=1000)
+    path = str(tmpdir.join('progress.json'))
+    progress = Progress(counter, json_path=path, out=io.StringIO())
+    progress.snapshot()
+
+    counter.update(changed=5, done_sz=500)
+    with progress.phase('hash'):
+        time.sleep(0.05)
+    for _ in progress.timed('walk', range(3)):
+        pass
+    progress.report()
+
+    with open(path) as F:
+        snap = json.load(F)
+    assert snap['files_done'] == 5
+    assert snap['remaining_bytes'] == 500
+    assert snap['bytes_per_s'] > 0
+    # as many bytes to go as done, at a constant rate
+    assert abs(snap['eta'] - snap['elapsed']) < 0.05
+    assert snap['phases']['hash'] >= 0.05
+    assert snap['stalled'] == 0
+    assert '5/10 files' in progress.out.getvalue()
+
+
+def test_done():
+    progress = Progress(Counter(check=2, changed=2), out=io.StringIO())
+    assert progress.snapshot()['eta'] == 0
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = {}
+
+    def find_one(self, query):
+        return self.docs.get(query['_id'])
+
+    def update_one(self, query, update, upsert=False):
+        assert upsert
+        self.docs.setdefault(query['_id'], {'_id': query['_id']})\
+            .update(update['$set'])
+
+    def remove(self, query):
+        self.docs.pop(query['_id'], None)
+
+
+class FakeDB:
+    def __init__(self):
+        self.scancheckpoint = FakeCollection()
+
+
+class FakeBulk:
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+
+    def flush(self):
+        self.log.append(self.name)
+
+
+class FakeDeleter:
+    def __init__(self, log, held=None):
+        self.log = log
+        self.held = held
+
+    def flush(self):
+        self.log.append('deleter')
+
+    def resume_position(self, position):
+        return position if self.held is None else min(position, self.held)
+
+
+class FakeApp:
+    def __init__(self):
+        self.conf = {'hostname': 'testhost'}
+        self.counter = Counter(files=3)
+        self.log = []
+        self.bulk_transient = FakeBulk(self.log, 'transient')
+        self.bulk_core = FakeBulk(self.log, 'core')
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(mad3.db, 'CLIENT', object())
+    monkeypatch.setattr(mad3.db, 'DB', FakeDB())
+    return FakeApp()
+
+
+def test_checkpoint(app):
+    assert load_checkpoint(app, '/data') is None
+    checkpointer = Checkpointer(app, '/data', interval=3600,
+                                deleter=FakeDeleter(app.log))
+    # not due yet
+    checkpointer.update('/data/a')
+    assert load_checkpoint(app, '/data') is None
+
+    checkpointer.save('/data/b')
+    # the writes go before the removals
+    assert app.log == ['transient', 'core', 'deleter']
+    cp = load_checkpoint(app, '/data')
+    assert cp['position'] == '/data/b'
+    assert cp['counters'] == {'files': 3}
+    assert load_checkpoint(app, '/other') is None
+
+    checkpointer.interval = 0
+    checkpointer.update('/data/c')
+    assert load_checkpoint(app, '/data')['position'] == '/data/c'
+    assert app.counter['checkpoint'] == 2
+
+    clear_checkpoint(app, '/data')
+    assert load_checkpoint(app, '/data') is None
+
+
+def test_checkpoint_held(app):
+    # a resumed scan must see the records the deleter still holds
+    checkpointer = Checkpointer(app, '/data',
+                                deleter=FakeDeleter(app.log, '/data/a'))
+    checkpointer.save('/data/c')
+    assert load_checkpoint(app, '/data')['position'] == '/data/a'
+
+
+def test_checkpoint_id(app):
+    ids = {checkpoint_id(app, '/data'), checkpoint_id(app, '/data2')}
+    app.conf['hostname'] = 'otherhost'
+    ids.add(checkpoint_id(app, '/data'))
+    # one checkpoint per host and directory
+    assert len(ids) == 3
+
+
+def test_ordered():
+    files = [('/a', 3, 30), ('/b', 1, 10), ('/c', 2, 10), ('/d', 4, 40)]
+    assert list(ordered(iter(files))) == ['/a', '/b', '/c', '/d']
+    # equal sizes in path order
+    assert ordered(files, 'small') == ['/b', '/c', '/a', '/d']
+    assert ordered(files, 'large') == ['/d', '/a', '/b', '/c']
+
+
+class FakeEngine:
+    def __init__(self):
+        self.hashed = []
+
+    def map(self, func, items):
+        return map(func, items)
+
+    def digest(self, filename):
+        self.hashed.append(filename)
+        time.sleep(0.01)
+
+
+class PlanApp:
+    def __init__(self, samples=2):
+        self.conf = {'plan': {'samples': samples, 'sample_size': '1M'}}
+        self.checksum_engine = FakeEngine()
+
+
+def _plan(capsys, app, files, quick=False):
+    """Return the rows of a plan, without the header."""
+    plan_scan(app, files, quick=quick)
+    return [line.split() for line in
+            capsys.readouterr().out.splitlines()[1:]]
+
+
+def test_plan_buckets(tmpdir, capsys):
+    files = []
+    for i in range(5):
+        fn = tmpdir.join('s{}'.format(i))
+        fn.write('x' * 100)
+        files.append((str(fn), 0, 100))
+    big = tmpdir.join('big')
+    big.write('x' * 20000)
+    files.append((str(big), 0, 20000))
+    # too large to sample, estimated at the measured rate
+    files.append(('/huge', 0, 5 * 10 ** 8))
+    app = PlanApp()
+
+    rows = _plan(capsys, app, files)
+    # the empty buckets are left out
+    assert [row[1:3] for row in rows] == [
+        ['5', '500'], ['1', '20.00Kb'], ['1', '500.00Mb'],
+        ['7', '500.02Mb']]
+    assert rows[2][3] != '?'
+    assert rows[3][3] == rows[2][3]
+    # at most `samples` files per bucket, never the huge one
+    hashed = app.checksum_engine.hashed
+    assert len([fn for fn in hashed if fn != str(big)]) == 2
+    assert str(big) in hashed
+    assert '/huge' not in hashed
+
+
+def test_plan_quick(capsys):
+    files = [('/a', 0, 10), ('/b', 0, 10 ** 10)]
+    app = PlanApp()
+    rows = _plan(capsys, app, files, quick=True)
+    assert rows[1] == ['inf', '1', '10.00Gb', '0:00:00']
+    assert rows[2] == ['total', '2', '10.00Gb', '0:00:00']
+    assert app.checksum_engine.hashed == []
+
+
+def test_plan_unknown(capsys):
+    # nothing can be sampled, and there is no rate to extrapolate
+    rows = _plan(capsys, PlanApp(), [('/huge', 0, 5 * 10 ** 8)])
+    assert rows[0][3] == '?'
+    assert rows[1][3].endswith('+')
@@ -0,0 +1,51 @@
+"""Tests on record deltas."""
+
+from mad3.delta import delta, merge, snapshot
+
+
+def test_delta():
+    old = {'_id': 1, 'size': 10, 'tag': ['a', 'b'], 'gone': 1,
+           'owner': ['x']}
+    new = snapshot(old)
+    assert delta(old, new) == {}
+
+    new['size'] = 12
+    new['tag'].append('c')
+    new['owner'] = []
+    new['new'] = 'n'
+    del new['gone']
+    assert delta(old, new) == {
+        '$set': {'size': 12, 'new': 'n'},
+        '$addToSet': {'tag': {'$each': ['c']}},
+        '$pull': {'owner': {'$in': ['x']}},
+        '$unset': {'gone': ''}}
+
+
+def test_delta_replace_set():
+    # values added and removed: write the whole set
+    assert delta({'tag': ['a']}, {'tag': ['b']}) == {'$set': {'tag': ['b']}}
+
+
+def test_delta_large_set():
+    old = {'tag': list(range(100000))}
+    new = {'tag': old['tag'] + [-1]}
+    assert delta(old, new) == {'$addToSet': {'tag': {'$each': [-1]}}}
+
+
+def test_delta_unhashable():
+    old = {'rel': [{'sha256': 'a'}]}
+    new = {'rel': [{'sha256': 'a'}, {'sha256': 'b'}]}
+    assert delta(old, new) == {'$addToSet': {'rel': {'$each': [
+        {'sha256': 'b'}]}}}
+    assert delta(new, old) == {'$pull': {'rel': {'$in': [
+        {'sha256': 'b'}]}}}
+
+
+def test_merge():
+    assert merge({'$set': {'a': 1, 'b': 1}}, {'$set': {'a': 2}}) == \
+        {'$set': {'a': 2, 'b': 1}}
+    assert merge({'$set': {'a': 1}},
+                 {'$addToSet': {'t': {'$each': [1]}}}) == \
+        {'$set': {'a': 1}, '$addToSet': {'t': {'$each': [1]}}}
+    assert merge({'$set': {'t': [1]}},
+                 {'$addToSet': {'t': {'$each': [2]}}}) is None
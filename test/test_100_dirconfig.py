@@ -0,0 +1,42 @@
+"""Tests on the mad.config cache."""
+
+from collections import Counter
+import os
+
+from mad3.dirconfig import DirConfig
+
+
+def test_dirconfig(tmpdir):
+    tmpdir.join('mad.config').write('project: p1\nowner: a\n')
+    sub = tmpdir.mkdir('sub')
+    sub.join('mad.config').write('owner: b\n')
+    subsub = sub.mkdir('subsub')
+
+    counter = Counter()
+    dc = DirConfig(ttl=0, counter=counter)
+    assert dc.get(str(subsub)) == {'project': 'p1', 'owner': 'b'}
+    assert dc.get(str(tmpdir)) == {'project': 'p1', 'owner': 'a'}
+    assert dc.get(str(sub)) == {'project': 'p1', 'owner': 'b'}
+    assert counter['madconfig_parse'] == 2
+
+    sub.join('mad.config').write('owner: c\nextra: x\n')
+    st = os.stat(str(sub.join('mad.config')))
+    os.utime(str(sub.join('mad.config')),
+             ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert dc.get(str(subsub)) == {'project': 'p1', 'owner': 'c',
+                                   'extra': 'x'}
+    assert counter['madconfig_parse'] == 3
+
+
+def test_dirconfig_persistent(tmpdir):
+    tmpdir.join('mad.config').write('project: p1\n')
+    path = str(tmpdir.join('cache', 'madconfig'))
+    dc = DirConfig(path=path)
+    assert dc.get(str(tmpdir)) == {'project': 'p1'}
+    dc.close()
+
+    counter = Counter()
+    dc = DirConfig(path=path, counter=counter)
+    assert dc.get(str(tmpdir)) == {'project': 'p1'}
+    assert counter['madconfig_parse'] == 0
+    dc.close()
@@ -0,0 +1,44 @@
+"""Tests on the compiled keyword schema."""
+
+import os
+
+import pytest
+import yaml
+
+from mad3.exceptions import M3UnknownKey
+from mad3.keywords import Schema
+from mad3.util import setset
+
+
+KEYWORDS = os.path.join(os.path.dirname(__file__), '..', 'mad3', 'etc',
+                        'keywords.config')
+
+
+@pytest.fixture
+def schema():
+    with open(KEYWORDS) as F:
+        return Schema(yaml.safe_load(F))
+
+
+def test_alias(schema):
+    name, info = schema.resolve('p')
+    assert name == 'investigation'
+    assert schema.get('project') is info
+
+
+def test_defaults(schema):
+    name, info = schema.resolve('size')
+    assert info.transformer is int
+    assert info.cat == {'transient'}
+    _, info = schema.resolve('group')
+    assert info.setter is setset
+    assert info['shape'] == 'set'
+    with pytest.raises(AttributeError):
+        info.shape = 'one'
+
+
+def test_unknown(schema):
+    with pytest.raises(M3UnknownKey):
+        schema.resolve('no_such_key')
+    with pytest.raises(M3UnknownKey):
+        Schema({'a': {'alias': 'b'}, 'b': {'alias': 'a'}})
@@ -0,0 +1,187 @@
+"""Tests on the work units of distributed scans."""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import mad3.db
+from mad3.coordinator import Worker, create_units, job_status
+from mad3.util import SafeCounter
+
+
+def _match(doc, query):
+    for k, v in query.items():
+        if k == '$or':
+            if not any(_match(doc, q) for q in v):
+                return False
+        elif isinstance(v, dict):
+            if not _test(doc.get(k), v):
+                return False
+        elif doc.get(k) != v:
+            return False
+    return True
+
+
+def _test(value, cond):
+    for op, arg in cond.items():
+        if op == '$not':
+            if _test(value, arg):
+                return False
+        elif value is None:
+            return False
+        elif op == '$lt' and not value < arg:
+            return False
+        elif op == '$gt' and not value > arg:
+            return False
+    return True
+
+
+class Result:
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+
+    def insert_many(self, docs):
+        self.docs.extend(docs)
+
+    def find(self, query):
+        return FakeCursor([d for d in self.docs if _match(d, query)])
+
+    def distinct(self, key, query):
+        return list(set(d[key] for d in self.docs if _match(d, query)))
+
+    def _update(self, doc, update):
+        doc.update(update.get('$set', {}))
+        for k, v in update.get('$inc', {}).items():
+            doc[k] = doc.get(k, 0) + v
+
+    def update_one(self, query, update):
+        for doc in self.docs:
+            if _match(doc, query):
+                self._update(doc, update)
+                return Result(1)
+        return Result(0)
+
+    def find_one_and_update(self, query, update, return_document=None):
+        for doc in self.docs:
+            if _match(doc, query):
+                self._update(doc, update)
+                return dict(doc)
+
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda d: d[key]))
+
+
+class FakeDB:
+    def __init__(self):
+        self.scanunit = FakeCollection()
+
+
+class FakeApp:
+    def __init__(self):
+        self.conf = {
+            'hostname': 'node1',
+            'scan': {'lease': 300, 'max_attempts': 3, 'retry_backoff': 60},
+            'governor': {'read': 0, 'stat': 0, 'bulk': 0, 'control': ''}}
+        self.counter = SafeCounter()
+
+
+@pytest.fixture
+def app(monkeypatch, tmpdir):
+    monkeypatch.setattr(mad3.db, 'CLIENT', object())
+    monkeypatch.setattr(mad3.db, 'DB', FakeDB())
+    monkeypatch.setattr('mad3.coordinator.load_ignore', lambda: None)
+    for d in ('a/x', 'b'):
+        tmpdir.join(d).ensure(dir=True)
+    app = FakeApp()
+    app.job, n = create_units(app, str(tmpdir), depth=1)
+    assert n == 3
+    return app
+
+
+def _units(app):
+    return {u['dirname']: u for u in mad3.db.DB.scanunit.docs}
+
+
+def test_claim(app, tmpdir):
+    worker = Worker(app)
+    claimed = [worker.claim() for _ in range(3)]
+    assert sorted(u['dirname'] for u in claimed) == sorted(
+        str(tmpdir.join(d)) for d in ('', 'a', 'b'))
+    assert all(u['state'] == 'leased' and u['attempts'] == 1
+               for u in claimed)
+    # all leased
+    assert worker.claim() is None
+
+
+def test_lease_expiry(app):
+    worker = Worker(app)
+    unit = worker.claim()
+    while worker.claim() is not None:
+        pass
+    _units(app)[unit['dirname']]['lease_until'] = \
+        datetime.utcnow() - timedelta(seconds=1)
+    other = Worker(app)
+    other.owner = 'node2:1'
+    again = other.claim()
+    assert again['dirname'] == unit['dirname']
+    assert again['attempts'] == 2
+    # the first worker lost its lease
+    worker._finish(unit, state='done')
+    assert _units(app)[unit['dirname']]['state'] == 'leased'
+
+
+def test_retry(app, tmpdir):
+    failing = str(tmpdir.join('a'))
+    calls = []
+
+    def scanfunc(dirname, recursive):
+        calls.append(dirname)
+        app.counter.incr('files')
+        if dirname == failing:
+            raise ValueError('no luck')
+
+    Worker(app).run(scanfunc)
+    units = _units(app)
+    assert units[failing]['state'] == 'failed'
+    assert units[failing]['not_before'] > datetime.utcnow()
+    assert units[str(tmpdir.join('b'))]['counters'] == {'files': 1}
+
+    # retried only once the backoff has passed
+    assert Worker(app).claim() is None
+    units[failing]['not_before'] = datetime.utcnow()
+    calls.clear()
+    Worker(app).run(scanfunc)
+    assert calls == [failing]
+    assert units[failing]['attempts'] == 2
+
+    # up to max_attempts
+    units[failing]['attempts'] = 3
+    units[failing]['not_before'] = None
+    assert Worker(app).claim() is None
+
+    status, = job_status(app)
+    assert status['states'] == {'done': 2, 'failed': 1}
+
+
+def test_heartbeat_counters(app):
+    worker = Worker(app)
+    unit = worker.claim()
+    before = SafeCounter(app.counter)
+    app.counter.incr('files', 5)
+
+    class Stop:
+        n = 0
+
+        def wait(self, timeout):
+            self.n += 1
+            return self.n > 1
+
+    worker._heartbeat(unit, before, Stop())
+    assert _units(app)[unit['dirname']]['counters'] == {'files': 5}
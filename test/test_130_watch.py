@@ -0,0 +1,154 @@
+"""Tests on watching a tree with inotify."""
+
+import os
+import shutil
+import sys
+import threading
+
+import pytest
+
+import mad3.db
+from mad3 import inotify
+from mad3.diff import SIGNATURE, signature
+from mad3.util import SafeCounter
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'),
+                                reason='inotify is Linux only')
+
+watch = pytest.importorskip('mad3.plugin.watch')
+
+
+class FakeApp:
+    def __init__(self):
+        self.conf = {'hostname': 'testhost'}
+        self.counter = SafeCounter()
+
+
+@pytest.fixture
+def watcher(tmpdir, monkeypatch):
+    monkeypatch.setattr(watch, 'load_ignore', lambda: None)
+    tmpdir.join('sub').ensure(dir=True)
+    tmpdir.join('sub', 'a').write('a')
+    watcher = watch.Watcher(FakeApp(), str(tmpdir), threads=2)
+    found = sorted(path for path, st in watcher.watch_tree(str(tmpdir)))
+    assert found == [str(tmpdir.join('sub', 'a'))]
+    yield watcher
+    watcher.inotify.close()
+
+
+def _drain(watcher):
+    """Handle events until none arrive for a while."""
+    while True:
+        events = watcher.inotify.read(timeout=0.2)
+        if not events:
+            return
+        for event in events:
+            watcher.handle(event)
+
+
+def test_coalesce(watcher, tmpdir):
+    fn = tmpdir.join('sub', 'b')
+    fn.write('1')
+    fn.write('12')
+    tmpdir.join('sub', 'a').remove()
+    tmpdir.join('c').write('c')
+    tmpdir.join('c').remove()
+    _drain(watcher)
+    # one entry per path, the last event counts
+    assert watcher.pending == {
+        str(fn): watch.UPDATE,
+        str(tmpdir.join('sub', 'a')): watch.DELETE,
+        str(tmpdir.join('c')): watch.DELETE}
+    assert watcher.app.counter['events'] > 3
+
+
+def test_move(watcher, tmpdir):
+    os.rename(str(tmpdir.join('sub', 'a')), str(tmpdir.join('b')))
+    os.rename(str(tmpdir.join('sub')), str(tmpdir.join('sub2')))
+    tmpdir.join('sub2', 'c').write('c')
+    _drain(watcher)
+    # sub/a is covered by the removal of sub
+    assert watcher.pending == {
+        str(tmpdir.join('b')): watch.UPDATE,
+        str(tmpdir.join('sub2', 'c')): watch.UPDATE}
+    assert watcher.rmtrees == {str(tmpdir.join('sub'))}
+    assert str(tmpdir.join('sub2')) in watcher.wd2dir.values()
+
+
+def test_recreate(watcher, tmpdir):
+    sub = str(tmpdir.join('sub'))
+    shutil.rmtree(sub)
+    _drain(watcher)
+    assert watcher.rmtrees == {sub}
+    os.mkdir(sub)
+    tmpdir.join('sub', 'new').write('n')
+    _drain(watcher)
+    # the old tree is still removed, the new file is stored after that
+    assert watcher.rmtrees == {sub}
+    assert watcher.pending[str(tmpdir.join('sub', 'new'))] == watch.UPDATE
+    # and the new directory is watched
+    tmpdir.join('sub', 'later').write('l')
+    _drain(watcher)
+    assert watcher.pending[str(tmpdir.join('sub', 'later'))] == watch.UPDATE
+
+
+class FakeTransient:
+    def __init__(self, recs):
+        self.recs = recs
+
+    def find(self, query, projection=None):
+        return iter(self.recs)
+
+
+class FakeDB:
+    def __init__(self, recs):
+        self.transient = FakeTransient(recs)
+
+
+def test_overflow_rescan(watcher, tmpdir, monkeypatch):
+    a = str(tmpdir.join('sub', 'a'))
+    tmpdir.join('b').write('b')
+    recs = [dict(zip(SIGNATURE, signature(os.stat(a))), filename=a),
+            dict(zip(SIGNATURE, signature(os.stat(a))),
+                 filename=str(tmpdir.join('gone')))]
+    monkeypatch.setattr(mad3.db, 'CLIENT', object())
+    monkeypatch.setattr(mad3.db, 'DB', FakeDB(recs))
+
+    watcher.handle(inotify.Event(-1, inotify.IN_Q_OVERFLOW, 0, ''))
+    assert watcher.overflow
+    watcher.rescan()
+    assert not watcher.overflow
+    assert watcher.app.counter['rescan'] == 1
+    # unchanged files are left alone
+    assert watcher.pending == {
+        str(tmpdir.join('b')): watch.UPDATE,
+        str(tmpdir.join('gone')): watch.DELETE}
+
+
+class Done(Exception):
+    pass
+
+
+def test_debounce(watcher, tmpdir, monkeypatch):
+    batches = []
+
+    def flush():
+        batches.append(dict(watcher.pending))
+        watcher.pending = {}
+        if len(batches) == 2:
+            raise Done()
+
+    def touch():
+        for i in range(5):
+            tmpdir.join('f{}'.format(i)).write('x')
+        # the second batch only starts after a quiet period
+        threading.Timer(0.6, tmpdir.join('late').write, args=('x',)).start()
+
+    monkeypatch.setattr(watcher, 'flush', flush)
+    monkeypatch.setattr(watch, 'print_counter', lambda counter: None)
+    threading.Timer(0.1, touch).start()
+    with pytest.raises(Done):
+        watcher.run(debounce=0.3, max_delay=10)
+    assert sorted(batches[0]) == [
+        str(tmpdir.join('f{}'.format(i))) for i in range(5)]
+    assert list(batches[1]) == [str(tmpdir.join('late'))]